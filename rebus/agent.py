@@ -1,6 +1,7 @@
 from rebus.tools.registry import Registry
 from rebus.tools.config import get_output_altering_options
 from rebus.bus import DEFAULT_DOMAIN
+from rebus.descriptor import Descriptor
 from collections import defaultdict
 import logging
 import time
@@ -44,6 +45,11 @@ class Agent(object):
     #: overridden, every option except 'operationmode' will be considered as
     #: influencing the output.
     _output_altering_options_ = None
+    #: tuple of selector prefixes. Selectors accepted by selector_filter must
+    #: start with one of them; buses may then only send matching descriptors
+    #: to this agent. None if any selector may be accepted. The default
+    #: selector_filter accepts exactly these selectors.
+    _selector_prefixes_ = None
 
     @staticmethod
     def register(f):
@@ -105,9 +111,39 @@ class Agent(object):
     def get(self, desc_domain, selector):
         return self.bus.get(self.id, desc_domain, selector)
 
+    def get_descriptors(self, desc_domain, selectors, prefetch=False):
+        """
+        :param prefetch: see find_by_selector
+        """
+        descs = self.bus.get_descriptors(self.id, desc_domain, selectors)
+        if prefetch:
+            Descriptor.prefetch_values(descs)
+        return descs
+
     def find(self, domain, selector_regex, limit):
         return self.bus.find(self.id, domain, selector_regex, limit)
 
+    def find_by_selector(self, domain, selector_prefix, limit=0, offset=0,
+                         prefetch=False):
+        """
+        :param prefetch: if True, values of returned descriptors are fetched
+            using a single batched bus call
+        """
+        descs = self.bus.find_by_selector(self.id, domain, selector_prefix,
+                                          limit, offset)
+        if prefetch:
+            Descriptor.prefetch_values(descs)
+        return descs
+
+    def find_by_uuid(self, domain, uuid, prefetch=False):
+        """
+        :param prefetch: see find_by_selector
+        """
+        descs = self.bus.find_by_uuid(self.id, domain, uuid)
+        if prefetch:
+            Descriptor.prefetch_values(descs)
+        return descs
+
     def list_uuids(self, desc_domain):
         return self.bus.list_uuids(self.id, desc_domain)
 
@@ -280,6 +316,10 @@ class Agent(object):
                 descriptors.append(d)
                 senders.append(s)
                 additional_descs.append(a)
+        # fetch values of all descriptors at once
+        Descriptor.prefetch_values(
+            descriptors + [ad for extra in additional_descs
+                           for ad in extra.itervalues()])
         # process
         self.log.info("START Bulk processing %d descriptors", len(descriptors))
         self.processing_start_time = time.time()
@@ -422,7 +462,24 @@ class Agent(object):
         pass
 
     def selector_filter(self, selector):
-        return True
+        """
+        Returns a true value if this agent is interested in descriptors
+        having this selector. Accepts selectors starting with one of
+        self.selector_prefixes() if not overridden.
+        """
+        prefixes = self.selector_prefixes()
+        if prefixes is None:
+            return True
+        return any(selector.startswith(prefix) for prefix in prefixes)
+
+    def selector_prefixes(self):
+        """
+        Returns selector prefixes this agent is interested in (see
+        _selector_prefixes_). Called before init_agent; may be overridden if
+        they depend on self.config. An overridden selector_filter must only
+        accept selectors that start with one of them.
+        """
+        return self._selector_prefixes_
 
     def descriptor_filter(self, descriptor, **kwargs):
         return True
@@ -8,9 +8,7 @@ class DotRenderer(Agent):
     _name_ = "dotrenderer"
     _desc_ = "Render dot graphs as SVG files using graphviz"
     _operationmodes_ = ('automatic', 'interactive')
-
-    def selector_filter(self, selector):
-        return selector.startswith("/graph/dot/")
+    _selector_prefixes_ = ("/graph/dot/",)
 
     def process(self, descriptor, sender_id):
         dot = descriptor.value
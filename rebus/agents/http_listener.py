@@ -12,6 +12,7 @@ from rebus.descriptor import Descriptor
 class HTTPListener(Agent):
     _name_ = "httplistener"
     _desc_ = "Push any descriptor that gets POSTed to the bus"
+    _selector_prefixes_ = ()
 
     postprocessors = dict()
 
@@ -23,9 +24,6 @@ class HTTPListener(Agent):
         t.daemon = True
         t.start()
 
-    def selector_filter(self, selector):
-        return False
-
     def inject(self, desc):
         self.push(desc)
 
@@ -18,17 +18,16 @@ class LinkFinder(Agent):
             help="Only consider descriptors whose selector start with "
             "selector-prefix")
 
-    def selector_filter(self, selector):
-        if selector.startswith(self.prefix):
-            return True
+    def selector_prefixes(self):
+        return (self.config['selector_prefix'],)
 
     def init_agent(self):
         self.memories = defaultdict(set)
         self.prefix = self.config['selector_prefix']
         # make sure all known descriptors are recorded in self.memories
         # useful in case the agent is re-started
-        for desc in self.bus.find_by_selector(
-                self.id, self.domain, self.prefix):
+        for desc in self.find_by_selector(self.domain, self.prefix,
+                                          prefetch=True):
             pth, hsh = desc.selector.split('%', 1)
             val = self._calc_val(desc)
             key = (pth, val)
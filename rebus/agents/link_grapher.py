@@ -54,8 +54,10 @@ class LinkGrapher(Agent):
                 yield fmt % i
                 i += 1
 
-        for s in sels:
-            link = self.get(self.domain, s)
+        link_descs = self.get_descriptors(self.domain, list(sels),
+                                          prefetch=True)
+
+        for link in link_descs:
             uu1, uu2 = link.uuid, link.value["otherUUID"]
             linktype = link.value["linktype"]
             labels[uu1] = link.label
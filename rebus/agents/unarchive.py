@@ -17,6 +17,7 @@ class Unarchive(Agent):
     _name_ = "unarchive"
     _desc_ = "Extract archives and uncompress files"
     _operationmodes_ = ('automatic', 'interactive')
+    _selector_prefixes_ = ("/archive/", "/compressed/")
 
     def init_agent(self):
         self.cabextract = distutils.spawn.find_executable("cabextract")
@@ -25,10 +26,6 @@ class Unarchive(Agent):
             self.log.warning("cabextract executable not found - cab archives "
                              "will not be extracted")
 
-    def selector_filter(self, selector):
-        return selector.startswith("/archive/") or\
-            selector.startswith("/compressed/")
-
     @classmethod
     def add_arguments(cls, subparser):
         subparser.add_argument(
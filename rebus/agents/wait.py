@@ -24,7 +24,8 @@ class Wait(Agent):
         return False
 
     def process(self, descriptor, sender_id):
-        print repr(descriptor.value[:500])
+        # only fetch the beginning of byte string values from the bus
+        print repr(descriptor.value_range(0, 500)[:500])
 
     def run(self):
         self.wait_for += self.config['selectors']
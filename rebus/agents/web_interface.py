@@ -13,6 +13,9 @@ from rebus.descriptor import Descriptor
 import re
 import json
 
+#: Number of characters of descriptor values displayed in summaries
+PREVIEW_LENGTH = 80
+
 
 class AsyncProxy(object):
     """
@@ -69,8 +72,7 @@ class AsyncProxy(object):
         """
         descs = self._agent.bus.find_by_uuid(self._agent, *args)
         # force value retrieval
-        for desc in descs:
-            value = desc.value
+        Descriptor.prefetch_values(descs)
         self._agent.ioloop.add_callback(callback, descs)
         return False
 
@@ -383,8 +385,8 @@ class DescriptorStore(object):
         for desc in descriptors:
             printablevalue = desc.value if isinstance(desc.value, unicode) \
                 else ''
-            if len(printablevalue) > 80:
-                printablevalue = (printablevalue[:80] + '...')
+            if len(printablevalue) > PREVIEW_LENGTH:
+                printablevalue = (printablevalue[:PREVIEW_LENGTH] + '...')
 
             descrinfo = {
                 'hash': desc.hash,
@@ -1,3 +1,4 @@
+from rebus.descriptor import Descriptor
 from rebus.tools.registry import Registry
 import time
 
@@ -8,6 +9,14 @@ class BusRegistry(Registry):
     pass
 
 
+class BusError(Exception):
+    """
+    Raised when a bus call could not be completed, ex. its reply has been
+    lost.
+    """
+    pass
+
+
 class Bus(object):
     _name_ = "Bus"
     _desc_ = "N/A"
@@ -90,6 +99,19 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def get_descriptors(self, agent_id, desc_domain, selectors):
+        """
+        Returns a list containing several Descriptor objects, in the same
+        order, using a single round-trip if the bus supports it.
+        Descriptors that were not found are None.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptors being fetched belong to
+        :param selectors: list of selectors of the descriptors being fetched
+        """
+        return [self.get(agent_id, desc_domain, selector)
+                for selector in selectors]
+
     def get_value(self, agent_id, desc_domain, selector):
         """
         Returns a descriptor's value.
@@ -102,6 +124,36 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def get_values(self, agent_id, desc_domain, selectors):
+        """
+        Returns a list containing the values of several descriptors, in the
+        same order, using a single round-trip if the bus supports it.
+        Values of descriptors that were not found are None.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptors being fetched belong to
+        :param selectors: list of selectors of the descriptors being fetched
+        """
+        return [self.get_value(agent_id, desc_domain, selector)
+                for selector in selectors]
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        """
+        Returns at most length bytes of a descriptor's value, starting at
+        offset. Values that are not byte strings are returned whole.
+
+        Returns None if the descriptor was not found.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptor being fetched belongs to
+        :param selector: selector of the descriptor being fetched
+        :param offset: offset of the first byte to return
+        :param length: max number of bytes to return
+        """
+        value = self.get_value(agent_id, desc_domain, selector)
+        return Descriptor.slice_value(value, offset, length)
+
     def list_uuids(self, agent_id, desc_domain):
         """
         Returns a dictionary mapping known UUIDs to corresponding labels.
@@ -11,8 +11,11 @@ import gobject
 import logging
 from rebus.tools.config import get_output_altering_options
 from rebus.tools.serializer import b64serializer as serializer
+from rebus.buses.dbusbus.values import value_serializer, pack_value, \
+    pack_values, unpack_value, to_fd, from_fd
 from rebus.busmaster import BusMaster
 from rebus.tools.sched import Sched
+from rebus.tools.spool import spooled_path
 
 
 log = logging.getLogger("rebus.bus")
@@ -23,9 +26,12 @@ class DBusMaster(dbus.service.Object, BusMaster):
     _name_ = "dbus"
     _desc_ = "Use RabbitMQ to exchange messages"
 
-    def __init__(self, bus, objpath, store):
+    def __init__(self, bus, objpath, store, spool_dir=None):
         dbus.service.Object.__init__(self, bus, objpath)
         self.store = store
+        #: directory shared with bus slaves, in which they write large
+        #: descriptor values (see rebus.tools.spool)
+        self.spool_dir = spool_dir
         #: maps agentid (ex. inject-:1.234) to object path (ex:
         #: /agent/inject)
         self.clients = {}
@@ -105,7 +111,8 @@ class DBusMaster(dbus.service.Object, BusMaster):
                 self.store.list_unprocessed_by_agent(agent_name,
                                                      output_altering_options)
             self.descriptor_handled_count[name_config] = \
-                self.descriptor_count - len(unprocessed)
+                self.descriptor_count - self.store.count_unprocessed_by_agent(
+                    agent_name, output_altering_options)
             for dom, uuid, sel in unprocessed:
                 self.targeted_descriptor("storage", dom, uuid, sel,
                                          [agent_name], False)
@@ -170,14 +177,54 @@ class DBusMaster(dbus.service.Object, BusMaster):
                                               selector, agent_name))
 
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
-                         in_signature='ss', out_signature='b')
-    def push(self, agent_id, serialized_descriptor):
-        descriptor = Descriptor.unserialize(serializer,
-                                            str(serialized_descriptor))
+                         in_signature='ssay', out_signature='b',
+                         byte_arrays=True)
+    def push(self, agent_id, serialized_meta, serialized_value):
+        return self._push(agent_id, serialized_meta, str(serialized_value))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ssh', out_signature='b')
+    def push_fd(self, agent_id, serialized_meta, value_fd):
+        """
+        Same as push, for values that are too large to fit in a DBus message.
+        """
+        return self._push(agent_id, serialized_meta, from_fd(value_fd))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sss', out_signature='b')
+    def push_spooled(self, agent_id, serialized_meta, spooled_name):
+        """
+        Same as push, for descriptors whose value has been written to the
+        spool directory by the agent.
+        """
+        if self.spool_dir is None:
+            log.error("PUSH: %s sent a spooled value, but no spool directory "
+                      "has been set (--spool-dir)", agent_id)
+            return False
+        try:
+            path = spooled_path(self.spool_dir, str(spooled_name))
+        except ValueError as e:
+            log.error("PUSH: %s %s", agent_id, e)
+            return False
+        return self._push(agent_id, serialized_meta, spooled=path)
+
+    def _push(self, agent_id, serialized_meta, serialized_value=None,
+              spooled=None):
+        """
+        :param spooled: path of the spooled value file, None if
+            serialized_value contains the value
+        """
+        # sent by an agent: domain has to be checked
+        descriptor = Descriptor.unserialize(serializer, str(serialized_meta))
         desc_domain = str(descriptor.domain)
         uuid = str(descriptor.uuid)
         selector = str(descriptor.selector)
-        if self.store.add(descriptor):
+        if spooled is None:
+            descriptor.value = unpack_value(serialized_value)
+            added = self.store.add(descriptor)
+        else:
+            added = self.store.add_spooled(descriptor, spooled)
+        if added:
             self.descriptor_count += 1
             log.debug("PUSH: %s => %s:%s", agent_id, desc_domain, selector)
             if not self.exiting:
@@ -200,13 +247,48 @@ class DBusMaster(dbus.service.Object, BusMaster):
         return desc.serialize_meta(serializer)
 
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
-                         in_signature='sss', out_signature='s')
+                         in_signature='ssas', out_signature='as')
+    def get_descriptors(self, agent_id, desc_domain, selectors):
+        log.debug("GETDESCRIPTORS: %s %s (%d selectors)", agent_id,
+                  desc_domain, len(selectors))
+        descs = [self.store.get_descriptor(str(desc_domain), str(s))
+                 for s in selectors]
+        return ["" if desc is None else desc.serialize_meta(serializer)
+                for desc in descs]
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sss', out_signature='ay')
     def get_value(self, agent_id, desc_domain, selector):
         log.debug("GETVALUE: %s %s:%s", agent_id, desc_domain, selector)
         value = self.store.get_value(str(desc_domain), str(selector))
-        if value is None:
-            return ""
-        return serializer.dumps(value)
+        # FD_TAG if value has to be fetched using get_value_fd
+        return dbus.ByteArray(pack_value(value))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ssas', out_signature='aay')
+    def get_values(self, agent_id, desc_domain, selectors):
+        log.debug("GETVALUES: %s %s (%d selectors)", agent_id, desc_domain,
+                  len(selectors))
+        values = self.store.get_values(str(desc_domain),
+                                       [str(s) for s in selectors])
+        return [dbus.ByteArray(data) for data in pack_values(values)]
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sss', out_signature='h')
+    def get_value_fd(self, agent_id, desc_domain, selector):
+        log.debug("GETVALUEFD: %s %s:%s", agent_id, desc_domain, selector)
+        value = self.store.get_value(str(desc_domain), str(selector))
+        return to_fd(value_serializer.dumps(value))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ssstt', out_signature='ay')
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        log.debug("GETVALUERANGE: %s %s:%s (%d bytes at %d)", agent_id,
+                  desc_domain, selector, length, offset)
+        value = self.store.get_value_range(str(desc_domain), str(selector),
+                                           int(offset), int(length))
+        return dbus.ByteArray(pack_value(value))
 
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='ss', out_signature='a{ss}')
@@ -391,7 +473,7 @@ class DBusMaster(dbus.service.Object, BusMaster):
 
         bus = dbus.SessionBus()
         name = dbus.service.BusName("com.airbus.rebus.bus", bus)
-        svc = cls(bus, "/bus", store)
+        svc = cls(bus, "/bus", store, master_options.spool_dir)
 
         svc.mainloop = gobject.MainLoop()
         log.info("Entering main loop.")
@@ -427,7 +509,11 @@ class DBusMaster(dbus.service.Object, BusMaster):
     def add_arguments(subparser):
         # TODO allow specifying dbus address? Currently specified by local dbus
         # configuration file or environment variable
-        pass
+        subparser.add_argument(
+            "--spool-dir",
+            help="Directory shared with agents, in which they may write large "
+            "descriptor values. Should be on the same file system as the "
+            "storage, so that they can be adopted without being copied")
 
     def busthread_call(self, method, *args):
         gobject.idle_add(method, *args)
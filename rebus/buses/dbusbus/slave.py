@@ -12,6 +12,9 @@ from rebus.agent import Agent
 from rebus.bus import Bus, DEFAULT_DOMAIN
 from rebus.descriptor import Descriptor
 from rebus.tools.serializer import b64serializer as serializer
+from rebus.tools.spool import should_spool, spool_value, remove_spooled
+from rebus.buses.dbusbus.values import value_serializer, FD_THRESHOLD, \
+    FD_TAG, unpack_value, to_fd, from_fd
 log = logging.getLogger("rebus.bus.dbus")
 DEFAULT_BUS = "(local dbus instance)"
 
@@ -23,7 +26,7 @@ class DBus(Bus):
     machines.
 
     Known limitations: limited character range, so a base64 serializer has to
-    be used.
+    be used for metadata. Values are sent as byte arrays.
     DBus catches any exception that happens during processing, so SystemExit
     and KeyboardInterrupt cannot be properly caught.
     """
@@ -62,6 +65,12 @@ class DBus(Bus):
         self.loop = None
         self.main_thread_id = thread.get_ident()
 
+        #: byte string values larger than self.spool_threshold are written to
+        #: self.spool_dir, which is shared with the master, instead of being
+        #: sent in DBus messages
+        self.spool_dir = options.spool_dir
+        self.spool_threshold = options.spool_threshold
+
     def join(self, agent, agent_domain=DEFAULT_DOMAIN):
         self.agent = agent
         self.objpath = os.path.join("/agent", self.agent.name)
@@ -119,28 +128,75 @@ class DBus(Bus):
             self.busthread_call(self._push, str(agent_id), descriptor)
 
     def _push(self, agent_id, descriptor):
-        sd = descriptor.serialize(serializer)
-        # Arbitrary size based on the true limit of 134217728 bytes
-        # The true limit apply to the total size (message + header)
-        #  -> I don't know the size of the message header
-        if len(sd) > 134210000:
-            log.warning("Descriptor too long for Dbus : " + str(len(sd)) +
-                        " bytes")
-            return False
-        return bool(self.iface.push(str(agent_id), sd))
+        meta = descriptor.serialize_meta(serializer)
+        if self.spool_dir and should_spool(descriptor, self.spool_threshold):
+            name = spool_value(self.spool_dir, descriptor)
+            if self.iface.push_spooled(str(agent_id), meta, name):
+                return True
+            if not remove_spooled(self.spool_dir, name):
+                # adopted or removed by the master: descriptor was known
+                return False
+            log.warning("Spooled value has been rejected by the bus master, "
+                        "sending it in the DBus message instead")
+        value = descriptor.serialize_value(value_serializer)
+        if len(value) > FD_THRESHOLD:
+            # would not fit in a DBus message
+            return bool(self.iface.push_fd(str(agent_id), meta,
+                                           to_fd(value)))
+        return bool(self.iface.push(str(agent_id), meta,
+                                    dbus.ByteArray(value)))
+
+    def unserialize_descriptor(self, s):
+        """
+        Unserializes descriptor metadata sent by the bus master. It has been
+        checked when it was pushed, and is not checked again.
+        """
+        return Descriptor.unserialize(serializer, str(s), bus=self,
+                                      trusted=True)
 
     def get(self, agent_id, desc_domain, selector):
         result = str(self.iface.get(str(agent_id), desc_domain, selector))
         if result == "":
             return None
-        return Descriptor.unserialize(serializer, str(result), bus=self)
+        return self.unserialize_descriptor(result)
+
+    def get_descriptors(self, agent_id, desc_domain, selectors):
+        results = self.iface.get_descriptors(str(agent_id), desc_domain,
+                                             list(selectors))
+        return [None if str(result) == "" else
+                self.unserialize_descriptor(result) for result in results]
 
     def get_value(self, agent_id, desc_domain, selector):
-        result = str(self.iface.get_value(str(agent_id), desc_domain,
-                                          selector))
-        if result == "":
-            return None
-        return Descriptor.unserialize_value(serializer, result)
+        result = self.iface.get_value(str(agent_id), desc_domain, selector,
+                                      byte_arrays=True)
+        if result == FD_TAG:
+            # too large to fit in a DBus message
+            result = from_fd(self.iface.get_value_fd(str(agent_id),
+                                                     desc_domain, selector))
+        return unpack_value(result)
+
+    def get_values(self, agent_id, desc_domain, selectors):
+        results = self.iface.get_values(str(agent_id), desc_domain,
+                                        list(selectors), byte_arrays=True)
+        values = []
+        for selector, result in zip(selectors, results):
+            if result == FD_TAG:
+                # too large to fit in this reply
+                values.append(self.get_value(agent_id, desc_domain, selector))
+            else:
+                values.append(unpack_value(result))
+        return values
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        result = self.iface.get_value_range(str(agent_id), desc_domain,
+                                            selector, offset, length,
+                                            byte_arrays=True)
+        if result == FD_TAG:
+            return Descriptor.slice_value(
+                self.get_value(agent_id, desc_domain, selector), offset,
+                length)
+        return unpack_value(result)
 
     def list_uuids(self, agent_id, desc_domain):
         return {str(k): str(v) for k, v in
@@ -155,20 +211,17 @@ class DBus(Bus):
                          offset=0):
         dlist = self.iface.find_by_selector(
             str(agent_id), desc_domain, selector_prefix, limit, offset)
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                dlist]
+        return [self.unserialize_descriptor(s) for s in dlist]
 
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         dlist = self.iface.find_by_uuid(str(agent_id), desc_domain, uuid)
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                dlist]
+        return [self.unserialize_descriptor(s) for s in dlist]
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
                       value_regex):
         dlist = self.iface.find_by_value(
             str(agent_id), desc_domain, selector_prefix, value_regex)
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                dlist]
+        return [self.unserialize_descriptor(s) for s in dlist]
 
     def mark_processed(self, agent_id, desc_domain, selector):
         self.iface.mark_processed(str(agent_id), desc_domain, selector)
@@ -190,7 +243,7 @@ class DBus(Bus):
         return [(str(k), int(v)) for k, v in stats], int(total)
 
     def get_children(self, agent_id, desc_domain, selector, recurse=True):
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
+        return [self.unserialize_descriptor(s) for s in
                 self.iface.get_children(str(agent_id), desc_domain, selector,
                                         recurse)]
 
@@ -272,3 +325,12 @@ class DBus(Bus):
         subparser.add_argument(
             "--busaddr", help="URL of the dbus server",
             default=DEFAULT_BUS)
+        subparser.add_argument(
+            "--spool-dir",
+            help="Directory shared with the bus master (--spool-dir master "
+            "option), in which large values are written instead of being "
+            "sent through DBus")
+        subparser.add_argument(
+            "--spool-threshold", type=int, default=16*1024*1024,
+            help="Size in bytes above which values are written to the spool "
+            "directory")
@@ -0,0 +1,88 @@
+"""
+Transport of descriptor values between DBus bus slaves and master.
+
+Values are pickled, then sent as DBus byte arrays (signature 'ay'), which
+avoids base64 encoding. Values that are too large to fit in a DBus message
+are written to a temporary file, whose file descriptor is passed instead
+(signature 'h').
+"""
+import os
+import tempfile
+from rebus.tools.serializer import picklev2 as value_serializer
+
+__all__ = ['value_serializer', 'FD_THRESHOLD', 'FD_TAG', 'pack_value',
+           'pack_values', 'unpack_value', 'to_fd', 'from_fd']
+
+#: DBus messages are limited to 128MiB. Serialized values larger than this
+#: are passed through a file descriptor.
+FD_THRESHOLD = 64 * 1024 * 1024
+
+#: Returned by get_value and get_value_range instead of the serialized value
+#: if it has to be fetched using get_value_fd. Pickled values are never equal
+#: to FD_TAG, since they start with '\x80'.
+FD_TAG = 'f'
+
+
+def pack_value(value):
+    """
+    Returns value serialized as a string, '' if value is None, or FD_TAG if
+    it is too large to fit in a DBus message.
+    """
+    if value is None:
+        return ''
+    data = value_serializer.dumps(value)
+    if len(data) > FD_THRESHOLD:
+        return FD_TAG
+    return data
+
+
+def pack_values(values):
+    """
+    Returns the list of values serialized using pack_value. Values that would
+    make the list too large to fit in a DBus message are replaced with FD_TAG.
+    """
+    result = []
+    total = 0
+    for value in values:
+        data = pack_value(value)
+        if total + len(data) > FD_THRESHOLD:
+            data = FD_TAG
+        else:
+            total += len(data)
+        result.append(data)
+    return result
+
+
+def unpack_value(data):
+    """
+    Returns the value serialized by pack_value, None if data is ''. data must
+    not be FD_TAG.
+    """
+    data = str(data)
+    if data == '':
+        return None
+    return value_serializer.loads(data)
+
+
+def to_fd(data):
+    """
+    Returns a dbus UnixFd referring to an unlinked temporary file containing
+    data.
+    """
+    # imported here so that the other helpers can be used without dbus
+    import dbus
+    with tempfile.TemporaryFile() as fp:
+        fp.write(data)
+        fp.flush()
+        # UnixFd duplicates the file descriptor
+        return dbus.types.UnixFd(fp)
+
+
+def from_fd(unixfd):
+    """
+    Returns the contents of the file referred to by a dbus UnixFd.
+    """
+    with os.fdopen(unixfd.take(), 'rb') as fp:
+        # file offset is shared with the sender
+        fp.seek(0)
+        return fp.read()
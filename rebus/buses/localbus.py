@@ -3,6 +3,7 @@ import threading
 from collections import Counter, defaultdict, namedtuple
 from rebus.bus import Bus, DEFAULT_DOMAIN
 from rebus.storage_backends.ramstorage import RAMStorage
+from rebus.storage_backends.spillstorage import SpillStorage
 from rebus.storage import StorageRegistry
 from rebus.tools.config import get_output_altering_options
 from rebus.tools.sched import Sched
@@ -21,7 +22,11 @@ class LocalBus(Bus):
         self.locks = defaultdict(set)
         #: Next available agent id. Never decreases.
         self.agent_count = 0
-        self.store = RAMStorage()  # TODO add support for DiskStorage ?
+        if getattr(options, 'memory_budget', 0):
+            # values that do not fit in memory_budget are spilled to disk
+            self.store = SpillStorage(options)
+        else:
+            self.store = RAMStorage()  # TODO add support for DiskStorage ?
         # TODO save internal state at bus exit (only useful with DiskStorage)
         #: maps agentid (ex. inject-12) to agentdesc
         self.agent_descs = {}
@@ -105,6 +110,18 @@ class LocalBus(Bus):
         log.info("GET: %s %s:%s", agent_id, desc_domain, selector)
         return self.store.get_value(desc_domain, selector)
 
+    def get_values(self, agent_id, desc_domain, selectors):
+        log.info("GETVALUES: %s %s (%d selectors)", agent_id, desc_domain,
+                 len(selectors))
+        return self.store.get_values(desc_domain, selectors)
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        log.info("GETVALUERANGE: %s %s:%s (%d bytes at %d)", agent_id,
+                 desc_domain, selector, length, offset)
+        return self.store.get_value_range(desc_domain, selector, offset,
+                                          length)
+
     def list_uuids(self, agent_id, desc_domain):
         log.debug("LISTUUIDS: %s %s", agent_id, desc_domain)
         return self.store.list_uuids(desc_domain)
@@ -224,3 +241,15 @@ class LocalBus(Bus):
             new_descs = False
             for agent in self.agents.values():
                 new_descs = new_descs or agent.on_idle()
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--memory-budget", type=int, default=0,
+            help="Size in bytes of descriptor values kept in RAM. Least "
+            "recently used values are written to a spill directory. "
+            "Unlimited if 0")
+        subparser.add_argument(
+            "--spill-dir",
+            help="Directory in which a temporary spill directory is created "
+            "(defaults to the system's temporary directory)")
@@ -10,8 +10,12 @@ import logging
 from rebus.tools.config import get_output_altering_options
 import pika
 import rebus.tools.serializer as serializer
+from rebus.tools.serializer import get_bus_serializer
 from rebus.busmaster import BusMaster
 from rebus.tools.sched import Sched
+from rebus.tools.spool import spooled_path
+from rebus.buses.rabbitbus.routing import DESCRIPTOR_EXCHANGE, \
+    WORK_QUEUE_ARGUMENTS, routing_key, is_routed, work_queue_name
 
 log = logging.getLogger("rebus.bus")
 
@@ -21,15 +25,21 @@ class RabbitBusMaster(BusMaster):
     _name_ = "rabbit"
     _desc_ = "Use RabbitMQ to exchange messages"
 
-    def __init__(self, store, server_addr, heartbeat_interval=0):
+    def __init__(self, store, server_addr, heartbeat_interval=0,
+                 spool_dir=None):
         self.store = store
+        #: directory shared with bus slaves, in which they write large
+        #: descriptor values (see rebus.tools.spool)
+        self.spool_dir = spool_dir
         #: maps agent_id (ex. inject-:1.234) to object path (ex: /agent/inject)
         self.clients = {}
         self.exiting = False
-        #: locks[domain] is a set of (lockid, selector) whose processing
-        #: has started (might even be finished). Allows several agents that
-        #: perform the same stateless computation to run in parallel
-        self.locks = defaultdict(set)
+        #: locks[domain] maps (lockid, selector) whose processing has started
+        #: (might even be finished) to (agent_id, work_item), work_item being
+        #: True if the lock was taken for an item of a work queue. Allows
+        #: several agents that perform the same stateless computation to run
+        #: in parallel
+        self.locks = defaultdict(dict)
         signal.signal(signal.SIGTERM, self.sigterm_handler)
         #: maps agent_id to agent name
         self.agentnames = {}
@@ -38,6 +48,9 @@ class RabbitBusMaster(BusMaster):
         self.agents_output_altering_options = {}
         #: maps agent_id to agent's serialized configuration
         self.agents_full_config_txts = {}
+        #: maps agent_id to the serializer negotiated at registration, used
+        #: for descriptors and values exchanged with this agent
+        self.agent_serializers = {}
         #: monotonically increasing user request counter
         self.userrequestid = 0
         #: number of descriptors
@@ -47,6 +60,10 @@ class RabbitBusMaster(BusMaster):
         self.descriptor_handled_count = {}
         #: uniq_conf_clients[(agent_name, config_txt)] = [agent_id, ...]
         self.uniq_conf_clients = defaultdict(list)
+        #: selector_prefixes[(agent_name, config_txt)] = list of selector
+        #: prefixes declared by this agent, None if it receives all
+        #: descriptors
+        self.selector_prefixes = {}
         #: retry_counters[(agent_name, config_txt, domain, selector)] = \
         #:     number of remaining retries
         self.retry_counters = defaultdict(dict)
@@ -81,6 +98,9 @@ class RabbitBusMaster(BusMaster):
         # Create the exchange for signals publish(master)/subscribe(slave)
         self.signal_exchange = self.channel.exchange_declare(
             exchange='rebus_signals', type='fanout')
+        # Create the exchange for new_descriptor signals, routed by selector
+        self.channel.exchange_declare(exchange=DESCRIPTOR_EXCHANGE,
+                                      type='topic')
 
         # Create the rpc queue
         self.channel.queue_declare(queue='rebus_master_rpc_highprio')
@@ -115,7 +135,8 @@ class RabbitBusMaster(BusMaster):
             return False
         return True
 
-    def send_signal(self, signal_name, args):
+    def send_signal(self, signal_name, args, exchange='rebus_signals',
+                    routing_key=''):
         # Send a signal on the exchange
         body = {'signal_name': signal_name, 'args': args}
         body = serializer.dumps(body)
@@ -123,7 +144,7 @@ class RabbitBusMaster(BusMaster):
         while not b:
             try:
                 self.channel.basic_publish(
-                    exchange='rebus_signals', routing_key='', body=body,
+                    exchange=exchange, routing_key=routing_key, body=body,
                     properties=pika.BasicProperties(delivery_mode=2,))
                 b = True
             except pika.exceptions.ConnectionClosed:
@@ -139,8 +160,12 @@ class RabbitBusMaster(BusMaster):
              'lock': self.lock,
              'unlock': self.unlock,
              'push': self.push,
+             'push_spooled': self.push_spooled,
              'get': self.get,
+             'get_descriptors': self.get_descriptors,
              'get_value': self.get_value,
+             'get_values': self.get_values,
+             'get_value_range': self.get_value_range,
              'list_uuids': self.list_uuids,
              'find': self.find,
              'find_by_uuid': self.find_by_uuid,
@@ -162,11 +187,14 @@ class RabbitBusMaster(BusMaster):
         # Parse the rpc request
         body = serializer.loads(body)
 
-        func_name = body['func_name']
-        args = body['args']
-
-        # Call the function
-        ret = self.call_rpc_func(func_name, args)
+        if 'calls' in body:
+            # batch envelope: call functions in order, reply with the list
+            # of their results
+            ret = [self.call_rpc_func(func_name, args)
+                   for func_name, args in body['calls']]
+        else:
+            # Call the function
+            ret = self.call_rpc_func(body['func_name'], body['args'])
         ret = serializer.dumps(ret)
 
         # Push the result of the function on the return queue
@@ -209,9 +237,30 @@ class RabbitBusMaster(BusMaster):
                       self.descriptor_count, nbhandlings)
             self.on_idle()
 
-    def register(self, agent_id, agent_domain, pth, config_txt):
+    def _serializer(self, agent_id):
+        return self.agent_serializers.get(agent_id, serializer)
+
+    def register(self, agent_id, agent_domain, pth, config_txt,
+                 serializers=None, selector_prefixes=None, work_queue=False):
+        """
+        :param serializers: names of serializers supported by the agent, by
+            order of preference
+        :param selector_prefixes: selector prefixes the agent's signal queue
+            is bound to, None if it receives all descriptors
+        :param work_queue: True if the agent receives new descriptors through
+            the work queue shared by instances having the same configuration
+        Returns the name of the serializer that will be used for descriptors
+        and values, None if the default serializer will be used.
+        """
         if not self._check_agent_id(agent_id):
             return
+        chosen = None
+        for name in serializers or []:
+            ser = get_bus_serializer(name)
+            if ser is not None:
+                chosen = name
+                self.agent_serializers[agent_id] = ser
+                break
         # replenish id queue
         self.publish_ids(1)
         #: indicates whether another instance of the same agent is already
@@ -221,8 +270,9 @@ class RabbitBusMaster(BusMaster):
         output_altering_options = get_output_altering_options(str(config_txt))
 
         name_config = (agent_name, output_altering_options)
-        already_running = len(self.uniq_conf_clients[name_config]) > 1
+        already_running = len(self.uniq_conf_clients[name_config]) > 0
         self.uniq_conf_clients[name_config].append(agent_id)
+        self.selector_prefixes[name_config] = selector_prefixes
 
         self.clients[agent_id] = pth
         self.agents_output_altering_options[agent_id] = output_altering_options
@@ -237,10 +287,21 @@ class RabbitBusMaster(BusMaster):
                 self.store.list_unprocessed_by_agent(agent_name,
                                                      output_altering_options)
             self.descriptor_handled_count[name_config] = \
-                self.descriptor_count - len(unprocessed)
+                self.descriptor_count - self.store.count_unprocessed_by_agent(
+                    agent_name, output_altering_options)
+            if work_queue:
+                # queued descriptors are unprocessed, and sent below
+                self.purge_work_queue(agent_name, output_altering_options)
             for dom, uuid, sel in unprocessed:
                 self.targeted_descriptor("storage", dom, uuid, sel,
                                          [agent_name], False)
+        return chosen
+
+    def purge_work_queue(self, agent_name, output_altering_options):
+        name = work_queue_name(agent_name, str(output_altering_options))
+        self.channel.queue_declare(queue=name, durable=True,
+                                   arguments=WORK_QUEUE_ARGUMENTS)
+        self.channel.queue_purge(queue=name)
 
     def unregister(self, agent_id):
         log.info("Agent %s has unregistered", agent_id)
@@ -252,7 +313,9 @@ class RabbitBusMaster(BusMaster):
         self.uniq_conf_clients[name_config].remove(agent_id)
         if len(self.uniq_conf_clients[name_config]) == 0:
             del self.descriptor_handled_count[name_config]
+            del self.selector_prefixes[name_config]
         del self.clients[agent_id]
+        self.agent_serializers.pop(agent_id, None)
         self.check_idle()
         if self.exiting:
             if len(self.clients) == 0:
@@ -262,7 +325,15 @@ class RabbitBusMaster(BusMaster):
                 log.info("Expecting %u more agents to exit (ex. %s)",
                          len(self.clients), self.clients.keys()[0])
 
-    def lock(self, agent_id, lockid, desc_domain, selector):
+    def lock(self, agent_id, lockid, desc_domain, selector, work_item=False,
+             redelivered=False):
+        """
+        :param work_item: True if the descriptor has been received from a
+            work queue
+        :param redelivered: True if this work item has been redelivered by
+            rabbitmq. Its previous consumer has disconnected before
+            acknowledging it, so the lock it may have taken is taken over.
+        """
         if not self._check_agent_id(agent_id):
             return False
         objpath = self.clients[agent_id]
@@ -271,8 +342,13 @@ class RabbitBusMaster(BusMaster):
         log.debug("LOCK:%s %s(%s) => %r %s:%s ", lockid, objpath, agent_id,
                   key in locks, desc_domain, selector)
         if key in locks:
-            return False
-        locks.add(key)
+            holder_id, holder_work_item = locks[key]
+            if not (redelivered and holder_work_item):
+                return False
+            log.info("LOCK:%s %s(%s) takes over lock held by %s on %s:%s",
+                     lockid, objpath, agent_id, holder_id, desc_domain,
+                     selector)
+        locks[key] = (agent_id, work_item)
         return True
 
     def unlock(self, agent_id, lockid, desc_domain, selector,
@@ -286,7 +362,7 @@ class RabbitBusMaster(BusMaster):
                   processing_failed, retries, wait_time)
         if lkey not in locks:
             return
-        locks.remove(lkey)
+        del locks[lkey]
         # find agent_name, config_txt
         for (agent_name, config_txt), ids in self.uniq_conf_clients.items():
             if agent_id in ids:
@@ -304,16 +380,49 @@ class RabbitBusMaster(BusMaster):
     def push(self, agent_id, serialized_descriptor):
         if not self._check_agent_id(agent_id):
             return False
-        descriptor = Descriptor.unserialize(serializer,
+        # sent by an agent: domain has to be checked
+        descriptor = Descriptor.unserialize(self._serializer(agent_id),
                                             str(serialized_descriptor))
+        return self._push(agent_id, descriptor)
+
+    def push_spooled(self, agent_id, serialized_meta, spooled_name):
+        """
+        Same as push, for descriptors whose value has been written to the
+        spool directory by the agent.
+        """
+        if not self._check_agent_id(agent_id):
+            return False
+        if self.spool_dir is None:
+            log.error("PUSH: %s sent a spooled value, but no spool directory "
+                      "has been set (--spool-dir)", agent_id)
+            return False
+        try:
+            path = spooled_path(self.spool_dir, str(spooled_name))
+        except ValueError as e:
+            log.error("PUSH: %s %s", agent_id, e)
+            return False
+        descriptor = Descriptor.unserialize(self._serializer(agent_id),
+                                            str(serialized_meta))
+        return self._push(agent_id, descriptor, path)
+
+    def _push(self, agent_id, descriptor, spooled=None):
+        """
+        :param spooled: path of the spooled value file, None if descriptor
+            contains its value
+        """
         desc_domain = str(descriptor.domain)
         uuid = str(descriptor.uuid)
         selector = str(descriptor.selector)
-        if self.store.add(descriptor):
+        if spooled is None:
+            added = self.store.add(descriptor)
+        else:
+            added = self.store.add_spooled(descriptor, spooled)
+        if added:
             self.descriptor_count += 1
             log.debug("PUSH: %s => %s:%s", agent_id, desc_domain, selector)
             if not self.exiting:
                 self.new_descriptor(agent_id, desc_domain, uuid, selector)
+                self.mark_unrouted(desc_domain, selector)
                 # useful in case all agents are in idle/interactive mode
                 self.check_idle()
             return True
@@ -329,7 +438,18 @@ class RabbitBusMaster(BusMaster):
         desc = self.store.get_descriptor(str(desc_domain), str(selector))
         if desc is None:
             return ""
-        return desc.serialize_meta(serializer)
+        return desc.serialize_meta(self._serializer(agent_id))
+
+    def get_descriptors(self, agent_id, desc_domain, selectors):
+        log.debug("GETDESCRIPTORS: %s %s (%d selectors)", agent_id,
+                  desc_domain, len(selectors))
+        if not self._check_agent_id(agent_id):
+            return None
+        serializer = self._serializer(agent_id)
+        descs = [self.store.get_descriptor(str(desc_domain), str(s))
+                 for s in selectors]
+        return ["" if desc is None else desc.serialize_meta(serializer)
+                for desc in descs]
 
     def get_value(self, agent_id, desc_domain, selector):
         log.debug("GETVALUE: %s %s:%s", agent_id, desc_domain, selector)
@@ -338,7 +458,30 @@ class RabbitBusMaster(BusMaster):
         value = self.store.get_value(str(desc_domain), str(selector))
         if value is None:
             return ""
-        return serializer.dumps(value)
+        return self._serializer(agent_id).dumps(value)
+
+    def get_values(self, agent_id, desc_domain, selectors):
+        log.debug("GETVALUES: %s %s (%d selectors)", agent_id, desc_domain,
+                  len(selectors))
+        if not self._check_agent_id(agent_id):
+            return None
+        serializer = self._serializer(agent_id)
+        values = self.store.get_values(str(desc_domain),
+                                       [str(s) for s in selectors])
+        return ["" if value is None else serializer.dumps(value)
+                for value in values]
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        log.debug("GETVALUERANGE: %s %s:%s (%d bytes at %d)", agent_id,
+                  desc_domain, selector, length, offset)
+        if not self._check_agent_id(agent_id):
+            return None
+        value = self.store.get_value_range(str(desc_domain), str(selector),
+                                           offset, length)
+        if value is None:
+            return ""
+        return self._serializer(agent_id).dumps(value)
 
     def list_uuids(self, agent_id, desc_domain):
         log.debug("LISTUUIDS: %s %s", agent_id, desc_domain)
@@ -362,14 +505,16 @@ class RabbitBusMaster(BusMaster):
             return []
         descs = self.store.find_by_selector(
             str(desc_domain), str(selector_prefix), int(limit), int(offset))
-        return [desc.serialize_meta(serializer) for desc in descs]
+        ser = self._serializer(agent_id)
+        return [desc.serialize_meta(ser) for desc in descs]
 
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         log.debug("FINDBYUUID: %s %s:%s", agent_id, desc_domain, uuid)
         if not self._check_agent_id(agent_id):
             return []
         descs = self.store.find_by_uuid(str(desc_domain), str(uuid))
-        return [desc.serialize_meta(serializer) for desc in descs]
+        ser = self._serializer(agent_id)
+        return [desc.serialize_meta(ser) for desc in descs]
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
                       value_regex):
@@ -380,7 +525,8 @@ class RabbitBusMaster(BusMaster):
         descs = self.store.find_by_value(str(desc_domain),
                                          str(selector_prefix),
                                          str(value_regex))
-        return [desc.serialize_meta(serializer) for desc in descs]
+        ser = self._serializer(agent_id)
+        return [desc.serialize_meta(ser) for desc in descs]
 
     def mark_processed(self, agent_id, desc_domain, selector):
         if not self._check_agent_id(agent_id):
@@ -431,9 +577,10 @@ class RabbitBusMaster(BusMaster):
         log.debug("GET_CHILDREN: %s %s:%s", agent_id, desc_domain, selector)
         if not self._check_agent_id(agent_id):
             return []
-        return list(self.store.get_children(str(desc_domain), str(selector),
-                                            serializer=serializer,
-                                            recurse=bool(recurse)))
+        ser = self._serializer(agent_id)
+        return [desc.serialize_meta(ser) for desc in
+                self.store.get_children(str(desc_domain), str(selector),
+                                        recurse=bool(recurse))]
 
     def store_internal_state(self, agent_id, state):
         if not self._check_agent_id(agent_id):
@@ -467,7 +614,29 @@ class RabbitBusMaster(BusMaster):
     def new_descriptor(self, sender_id, desc_domain, uuid, selector):
         args = locals()
         args.pop('self', None)
-        self.send_signal("new_descriptor", args)
+        self.send_signal("new_descriptor", args, DESCRIPTOR_EXCHANGE,
+                         routing_key(selector))
+
+    def mark_unrouted(self, desc_domain, selector):
+        """
+        Marks a new descriptor as processed by running agents it has not been
+        routed to, since their selector_filter would reject it.
+
+        This is called for every pushed descriptor, and replaces the
+        mark_processed RPC each of these agents would otherwise have sent
+        after rejecting it. Storage backends keep processed state in memory
+        (DiskStorage buffers it in its journal until the next checkpoint), so
+        no disk write happens per call.
+        """
+        for name_config, prefixes in self.selector_prefixes.items():
+            if is_routed(prefixes, selector) or \
+                    name_config not in self.descriptor_handled_count:
+                continue
+            agent_name, options = name_config
+            isnew = self.store.mark_processed(desc_domain, selector,
+                                              agent_name, str(options))
+            if isnew:
+                self.descriptor_handled_count[name_config] += 1
 
     def targeted_descriptor(self, sender_id, desc_domain, uuid, selector,
                             targets, user_request):
@@ -528,6 +697,8 @@ class RabbitBusMaster(BusMaster):
                 self.channel.queue_declare(queue="registration_queue")
                 self.signal_exchange = self.channel.exchange_declare(
                     exchange='rebus_signals', type='fanout')
+                self.channel.exchange_declare(exchange=DESCRIPTOR_EXCHANGE,
+                                              type='topic')
                 self.channel.queue_declare(queue='rebus_master_rpc_highprio')
                 self.channel.basic_consume(
                     self.rpc_callback,
@@ -548,7 +719,8 @@ class RabbitBusMaster(BusMaster):
 
         server_addr = master_options.rabbitaddr
         heartbeat_interval = master_options.heartbeat
-        svc = cls(store, server_addr, heartbeat_interval)
+        svc = cls(store, server_addr, heartbeat_interval,
+                  master_options.spool_dir)
         log.info("Entering main loop.")
         try:
             while True:
@@ -605,6 +777,11 @@ class RabbitBusMaster(BusMaster):
         subparser.add_argument(
             "--heartbeat", help="Rabbitmq heartbeat interval, in seconds",
             default=0)
+        subparser.add_argument(
+            "--spool-dir",
+            help="Directory shared with agents, in which they may write large "
+            "descriptor values. Should be on the same file system as the "
+            "storage, so that they can be adopted without being copied")
 
     def busthread_call(self, method, *args):
         f = lambda: method(*args)
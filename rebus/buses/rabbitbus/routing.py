@@ -0,0 +1,82 @@
+"""
+Topic routing of descriptor signals between the rabbit bus master and slaves.
+
+new_descriptor signals are published to a topic exchange, using a routing key
+derived from the descriptor's selector: /binary/elf/%1234 is routed as
+binary.elf. Agents that declare selector prefixes (see
+Agent.selector_prefixes) only bind their signal queue to matching routing
+keys.
+
+Instances of an agent that share the same output altering options may
+consume new_descriptor signals from a shared durable work queue instead, so
+that each descriptor is delivered to a single instance.
+"""
+import hashlib
+
+#: Topic exchange new_descriptor signals are published to
+DESCRIPTOR_EXCHANGE = 'rebus_descriptors'
+
+#: AMQP routing keys are limited to 255 bytes
+MAX_KEY_LENGTH = 255
+
+#: Arguments of work queues. Work queues that are no longer consumed are
+#: deleted after a day; their descriptors are sent again when the agent
+#: registers.
+WORK_QUEUE_ARGUMENTS = {'x-expires': 24*3600*1000}
+
+
+def routing_key(selector):
+    """
+    Returns the routing key of descriptors having this selector. Trailing
+    words are dropped if the key would be too long.
+    """
+    words = [w for w in selector.split('%', 1)[0].split('/') if w]
+    key = '.'.join(words)
+    while len(key) > MAX_KEY_LENGTH:
+        words.pop()
+        key = '.'.join(words)
+    return key
+
+
+def prefix_words(selector_prefix):
+    """
+    Returns the complete words of selector_prefix: the last one may be
+    incomplete unless selector_prefix ends with '/', and is dropped.
+    """
+    return [w for w in selector_prefix.split('/')[:-1] if w]
+
+
+def binding_keys(selector_prefixes):
+    """
+    Returns the binding keys that match routing keys of all selectors
+    starting with one of selector_prefixes. None means all selectors.
+    """
+    if selector_prefixes is None:
+        return ['#']
+    return sorted(set('.'.join(prefix_words(p) + ['#'])
+                      for p in selector_prefixes))
+
+
+def is_routed(selector_prefixes, selector):
+    """
+    Returns True if descriptors having this selector are routed to agents
+    that declared selector_prefixes, i.e. if one of their binding keys
+    matches its routing key.
+    """
+    if selector_prefixes is None:
+        return True
+    key_words = routing_key(selector).split('.')
+    for prefix in selector_prefixes:
+        words = prefix_words(prefix)
+        if key_words[:len(words)] == words:
+            return True
+    return False
+
+
+def work_queue_name(agent_name, output_altering_options):
+    """
+    Returns the name of the work queue shared by instances of agent_name
+    having the same output altering options.
+    """
+    return 'work_%s_%s' % (agent_name,
+                           hashlib.md5(output_altering_options).hexdigest())
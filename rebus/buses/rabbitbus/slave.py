@@ -5,17 +5,53 @@ import logging
 import thread
 import time
 import uuid as m_uuid
+from collections import OrderedDict
 import pika
 from rebus.agent import Agent
-from rebus.bus import Bus, DEFAULT_DOMAIN
+from rebus.bus import Bus, BusError, DEFAULT_DOMAIN
 from rebus.descriptor import Descriptor
 import rebus.tools.serializer as serializer
+from rebus.tools.serializer import SerializerRegistry, \
+    bus_serializer_names
+from rebus.tools.spool import should_spool, spool_value, remove_spooled
+from rebus.buses.rabbitbus.routing import DESCRIPTOR_EXCHANGE, \
+    WORK_QUEUE_ARGUMENTS, binding_keys, work_queue_name
+from rebus.tools.config import get_output_altering_options
 
 
 log = logging.getLogger("rebus.bus.rabbitbus")
 DEFAULT_BUS = "(local dbus instance)"
 
 
+class RPCReply(object):
+    """
+    Reply to an RPC sent to the bus master, which may not have been received
+    yet. Its truth value is the truth value of the reply's value, which is
+    waited for.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self.done = False
+        self.value = None
+        #: reason why the reply will never be received, None if it has been
+        #: or may still be received
+        self.error = None
+
+    def result(self):
+        """
+        Waits for the reply to be received, then returns its value. Raises
+        BusError if the reply has been lost.
+        """
+        while not self.done:
+            self.bus.receive_rpc_reply()
+        if self.error is not None:
+            raise BusError(self.error)
+        return self.value
+
+    def __nonzero__(self):
+        return bool(self.result())
+
+
 @Bus.register
 class RabbitBus(Bus):
     _name_ = "rabbit"
@@ -53,7 +89,63 @@ class RabbitBus(Bus):
         self.agent = None
         self.main_thread_id = thread.get_ident()
 
+        #: serializer requested for descriptors and values
+        self.preferred_serializer = options.serializer
+        #: serializer used for descriptors and values, negotiated with the
+        #: master at registration
+        self.serializer = serializer
+
+        #: byte string values larger than self.spool_threshold are written to
+        #: self.spool_dir, which is shared with the master, instead of being
+        #: sent in RPC messages
+        self.spool_dir = options.spool_dir
+        self.spool_threshold = options.spool_threshold
+
+        #: RPC messages that have been sent, but whose reply has not been
+        #: received yet, in sending order: pending_rpcs[correlation id] is a
+        #: tuple (list of RPCReply objects, whether message is a batch)
+        self.pending_rpcs = OrderedDict()
+        #: routing key pending RPCs have been sent to
+        self.pending_routing_key = None
+        #: max number of RPCs in flight
+        self.rpc_window = max(1, options.rpc_window)
+
+        #: fire-and-forget RPCs that have not been sent yet: list of tuples
+        #: ((func_name, args), RPCReply)
+        self.rpc_batch = []
+        #: routing key of batched RPCs
+        self.rpc_batch_routing_key = None
+        #: id of the timeout that sends the current batch
+        self.rpc_batch_timer = None
+        #: max number of calls per batch
+        self.rpc_batch_size = options.rpc_batch_size
+        #: max time in seconds a fire-and-forget RPC may be kept in a batch
+        self.rpc_linger = options.rpc_linger
+
+        #: name of the work queue new descriptors are consumed from, None if
+        #: they are received through the signal queue
+        self.work_queue = None
+        self.work_queue_enabled = not options.no_work_queue
+        #: delivery method of the work item being handled, None outside of
+        #: work_handler
+        self.work_item = None
+
     # TODO: check if key exists
+    def work_handler(self, ch, method, properties, body):
+        """
+        Handles a new_descriptor signal received from the work queue, then
+        acknowledges it. Unacknowledged work items are delivered to another
+        instance of this agent if this one dies.
+        """
+        self.work_item = method
+        try:
+            self.signal_handler(ch, method, properties, body)
+        finally:
+            self.work_item = None
+        # make sure RPCs sent while processing reach the master first
+        self.send_rpc_batch()
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
     def signal_handler(self, ch, method, properties, body):
         f = {'new_descriptor': self.broadcast_wrapper,
              'targeted_descriptor': self.targeted_wrapper,
@@ -74,6 +166,7 @@ class RabbitBus(Bus):
 
                 self.queue_ret = self.channel.queue_declare(self.return_queue)
                 self.return_queue = self.queue_ret.method.queue
+                self.rpc_channel = self.connection.channel()
 
                 self.signal_exchange = self.channel.exchange_declare(
                     exchange='rebus_signals',
@@ -83,25 +176,86 @@ class RabbitBus(Bus):
                 self.signal_queue = self.ret_signal_queue.method.queue
                 self.channel.queue_bind(exchange='rebus_signals',
                                         queue=self.signal_queue)
+                self.bind_descriptor_signals()
                 self.channel.basic_consume(self.signal_handler,
                                            queue=self.signal_queue,
                                            no_ack=True)
+                if self.work_queue:
+                    self.channel.basic_consume(self.work_handler,
+                                               queue=self.work_queue)
                 b = True
             except pika.exceptions.ConnectionClosed:
                 log.info("Failed to reconnect to RabbitMQ. Retrying..")
                 time.sleep(0.5)
 
-    def send_rpc(self, func_name, args, high_priority=True):
-        # TODO catch any exception derived from pika.exceptions.AMQPError
-        # Call the remote function
-        body = serializer.dumps({'func_name': func_name, 'args': args})
-        corr_id = str(m_uuid.uuid4())
+    def send_rpc(self, func_name, args, high_priority=True, wait=True):
+        """
+        :param wait: if False, returns an RPCReply instead of waiting for the
+            reply. RPCs are executed by the master in the order they were
+            sent, whether their replies have been waited for or not.
+        """
         routing_key = 'rebus_master_rpc_highprio' if high_priority \
             else 'rebus_master_rpc_lowprio'
+        reply = RPCReply(self)
+        if not wait and self.rpc_batch_size > 1:
+            self.batch_rpc(routing_key, (func_name, args), reply)
+            return reply
+        # batched RPCs must be executed first
+        self.send_rpc_batch()
+        body = serializer.dumps({'func_name': func_name, 'args': args})
+        self.publish_rpc(routing_key, body, [reply], False)
+        if wait:
+            return reply.result()
+        return reply
+
+    def batch_rpc(self, routing_key, call, reply):
+        """
+        Adds call to the current batch, which is sent once it contains
+        self.rpc_batch_size calls, once self.rpc_linger seconds have elapsed,
+        or before any other RPC is sent.
+        """
+        if self.rpc_batch and routing_key != self.rpc_batch_routing_key:
+            self.send_rpc_batch()
+        if not self.rpc_batch:
+            self.rpc_batch_routing_key = routing_key
+            self.rpc_batch_timer = self.connection.add_timeout(
+                self.rpc_linger, self.send_rpc_batch)
+        self.rpc_batch.append((call, reply))
+        if len(self.rpc_batch) >= self.rpc_batch_size:
+            self.send_rpc_batch()
+
+    def send_rpc_batch(self):
+        """
+        Sends batched calls to the master in a single message. It replies
+        with the list of their results.
+        """
+        if not self.rpc_batch:
+            return
+        calls, replies = zip(*self.rpc_batch)
+        self.rpc_batch = []
+        self.connection.remove_timeout(self.rpc_batch_timer)
+        body = serializer.dumps({'calls': list(calls)})
+        self.publish_rpc(self.rpc_batch_routing_key, body, list(replies),
+                         True)
+
+    def publish_rpc(self, routing_key, body, replies, batched):
+        """
+        Publishes an RPC request, whose reply will be stored in replies.
+
+        :param batched: True if body is a batch envelope
+        """
+        if self.pending_rpcs and routing_key != self.pending_routing_key:
+            # the master does not preserve the order of RPCs sent to
+            # different queues
+            self.flush_rpcs()
+        while len(self.pending_rpcs) >= self.rpc_window:
+            self.receive_rpc_reply()
+        # TODO catch any exception derived from pika.exceptions.AMQPError
+        corr_id = str(m_uuid.uuid4())
         b = False
         while not b:
             try:
-                retpublish = self.channel.basic_publish(
+                retpublish = self.rpc_channel.basic_publish(
                     exchange='',
                     routing_key=routing_key,
                     body=body,
@@ -111,42 +265,77 @@ class RabbitBus(Bus):
             except pika.exceptions.ConnectionClosed:
                 log.info("Disconnected. Trying to reconnect")
                 self.reconnect()
-
-        # Wait for the return value
-        response = None
-        b = False
-        while not b:
-            try:
-                meth, props, resp = self.channel.basic_get(self.return_queue)
-            except pika.exceptions.ConnectionClosed:
-                log.info("Disconnected. Trying to reconnect")
-                self.reconnect()
-            if meth:
-                if corr_id == props.correlation_id:
-                    b = True
-                    response = str(resp)
-                    response = serializer.loads(response)
-                    self.channel.basic_ack(delivery_tag=meth.delivery_tag)
-                    # TODO try/reconnect + break if basic_ack impossible
-                else:
+        self.pending_rpcs[corr_id] = (replies, batched)
+        self.pending_routing_key = routing_key
+
+    def receive_rpc_reply(self):
+        """
+        Blocks until the reply to a pending RPC is received, then stores its
+        unserialized value in the matching RPCReply objects. Sends the current
+        batch first, so that its replies can be waited for.
+
+        Replies are consumed from self.rpc_channel. Unlike
+        connection.process_data_events, its consumer generator does not
+        dispatch messages received on self.channel, so that signals are not
+        handled while an RPC is in progress.
+        """
+        self.send_rpc_batch()
+        try:
+            for meth, props, resp in self.rpc_channel.consume(
+                    self.return_queue, no_ack=True):
+                pending = self.pending_rpcs.pop(props.correlation_id, None)
+                if pending is None:
                     log.warning("An RPC returned with a wrong correlation ID")
-            else:
-                time.sleep(0.001)
-        return response
-
-    def rpc_register(self, agent_id, agent_domain, pth, config_txt):
+                    continue
+                replies, batched = pending
+                values = serializer.loads(str(resp))
+                if not batched:
+                    values = [values]
+                for reply, value in zip(replies, values):
+                    reply.value = value
+                    reply.done = True
+                return
+        except pika.exceptions.ConnectionClosed:
+            log.info("Disconnected. Trying to reconnect")
+            self.reconnect()
+            # replies were sent to the previous connection's reply queue
+            log.error("Replies to %d RPC messages have been lost",
+                      len(self.pending_rpcs))
+            for replies, _ in self.pending_rpcs.itervalues():
+                for reply in replies:
+                    reply.error = "Connection to rabbitmq has been lost " \
+                        "before the RPC reply was received"
+                    reply.done = True
+            self.pending_rpcs.clear()
+
+    def flush_rpcs(self):
+        """
+        Sends the current batch, then waits until replies to all pending RPCs
+        have been received.
+        """
+        self.send_rpc_batch()
+        while self.pending_rpcs:
+            self.receive_rpc_reply()
+
+    def rpc_register(self, agent_id, agent_domain, pth, config_txt,
+                     serializers, selector_prefixes, work_queue):
         args = {'agent_id': agent_id, 'agent_domain': agent_domain,
-                'pth': pth, 'config_txt': config_txt}
+                'pth': pth, 'config_txt': config_txt,
+                'serializers': serializers,
+                'selector_prefixes': selector_prefixes,
+                'work_queue': work_queue}
         return self.send_rpc("register", args)
 
     def rpc_unregister(self, agent_id):
         args = {'agent_id': agent_id}
         return self.send_rpc("unregister", args)
 
-    def rpc_lock(self, agent_id, lockid, desc_domain, selector):
+    def rpc_lock(self, agent_id, lockid, desc_domain, selector, wait=True,
+                 work_item=False, redelivered=False):
         args = {'agent_id': agent_id, 'lockid': lockid,
-                'desc_domain': desc_domain, 'selector': selector}
-        return self.send_rpc("lock", args)
+                'desc_domain': desc_domain, 'selector': selector,
+                'work_item': work_item, 'redelivered': redelivered}
+        return self.send_rpc("lock", args, wait=wait)
 
     def rpc_unlock(self, agent_id, lockid, desc_domain, selector,
                    processing_failed, retries, wait_time):
@@ -154,17 +343,27 @@ class RabbitBus(Bus):
                 'desc_domain': desc_domain, 'selector': selector,
                 'processing_failed': processing_failed, 'retries': retries,
                 'wait_time': wait_time}
-        return self.send_rpc("unlock", args)
+        return self.send_rpc("unlock", args, wait=False)
 
     def rpc_push(self, agent_id, descriptor):
         args = {'agent_id': agent_id, 'serialized_descriptor': descriptor}
-        return self.send_rpc("push", args, False)
+        return self.send_rpc("push", args, False, wait=False)
+
+    def rpc_push_spooled(self, agent_id, serialized_meta, spooled_name):
+        args = {'agent_id': agent_id, 'serialized_meta': serialized_meta,
+                'spooled_name': spooled_name}
+        return self.send_rpc("push_spooled", args, False)
 
     def rpc_get(self, agent_id, desc_domain, selector):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
                 'selector': selector}
         return self.send_rpc("get", args)
 
+    def rpc_get_descriptors(self, agent_id, desc_domain, selectors):
+        args = {'agent_id': agent_id, 'desc_domain': desc_domain,
+                'selectors': selectors}
+        return self.send_rpc("get_descriptors", args)
+
     def rpc_get_value(self, agent_id, desc_domain, selector):
         # often called from Descriptor, which does not have a reference to the
         # agent, and cannot put the correct agent_id => override agent_id
@@ -172,6 +371,19 @@ class RabbitBus(Bus):
                 'selector': selector}
         return self.send_rpc("get_value", args)
 
+    def rpc_get_values(self, agent_id, desc_domain, selectors):
+        # see rpc_get_value
+        args = {'agent_id': self.agent.id, 'desc_domain': desc_domain,
+                'selectors': selectors}
+        return self.send_rpc("get_values", args)
+
+    def rpc_get_value_range(self, agent_id, desc_domain, selector, offset,
+                            length):
+        # see rpc_get_value
+        args = {'agent_id': self.agent.id, 'desc_domain': desc_domain,
+                'selector': selector, 'offset': offset, 'length': length}
+        return self.send_rpc("get_value_range", args)
+
     def rpc_list_uuids(self, agent_id, desc_domain):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain}
         return self.send_rpc("list_uuids", args)
@@ -204,12 +416,12 @@ class RabbitBus(Bus):
     def rpc_mark_processed(self, agent_id, desc_domain, selector):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
                 'selector': selector}
-        return self.send_rpc("mark_processed", args)
+        return self.send_rpc("mark_processed", args, wait=False)
 
     def rpc_mark_processable(self, agent_id, desc_domain, selector):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
                 'selector': selector}
-        return self.send_rpc("mark_processable", args)
+        return self.send_rpc("mark_processable", args, wait=False)
 
     def rpc_get_processable(self, agent_id, desc_domain, selector):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
@@ -232,7 +444,7 @@ class RabbitBus(Bus):
     def rpc_store_internal_state(self, agent_id, state):
         args = locals()
         args.pop('self', None)
-        return self.send_rpc("store_internal_state", args)
+        return self.send_rpc("store_internal_state", args, wait=False)
 
     def rpc_load_internal_state(self, agent_id):
         args = locals()
@@ -242,7 +454,7 @@ class RabbitBus(Bus):
     def rpc_request_processing(self, agent_id, desc_domain, selector, targets):
         args = locals()
         args.pop('self', None)
-        return self.send_rpc("request_processing", args)
+        return self.send_rpc("request_processing", args, wait=False)
 
     def join(self, agent, agent_domain=DEFAULT_DOMAIN):
         self.agent = agent
@@ -273,6 +485,10 @@ class RabbitBus(Bus):
             queue=ret_rpc_queue_name, exclusive=True)
         self.return_queue = self.queue_ret.method.queue
 
+        #: RPC requests are published, and their replies consumed, on this
+        #: channel
+        self.rpc_channel = self.connection.channel()
+
         # Declare the signal exchange and bind the signal queue on it
         self.signal_exchange = self.channel.exchange_declare(
             exchange='rebus_signals', type='fanout')
@@ -283,19 +499,65 @@ class RabbitBus(Bus):
         self.signal_queue = self.ret_signal_queue.method.queue
         self.channel.queue_bind(exchange='rebus_signals',
                                 queue=self.signal_queue)
+        self.selector_prefixes = self.agent.selector_prefixes()
+        if self.selector_prefixes is not None:
+            self.selector_prefixes = list(self.selector_prefixes)
+        # Instances sharing a work queue must process descriptors
+        # independently: agents that fill process slots are excluded, as well
+        # as agents that run on their own and do not consume signals
+        if self.work_queue_enabled and not agent._process_slots_ and \
+                agent.__class__.run == Agent.run:
+            self.work_queue = work_queue_name(
+                self.agent.name,
+                get_output_altering_options(self.agent.config_txt))
+        self.bind_descriptor_signals()
 
         # Register into the bus
-        self.rpc_register(self.agent_id, agent_domain, self.objpath,
-                          self.agent.config_txt)
+        chosen = self.rpc_register(self.agent_id, agent_domain, self.objpath,
+                                   self.agent.config_txt,
+                                   [self.preferred_serializer],
+                                   self.selector_prefixes,
+                                   self.work_queue is not None)
+        if chosen is not None:
+            self.serializer = SerializerRegistry.get(chosen)
 
         log.info("Agent %s registered with id %s on domain %s",
                  self.agent.name, self.agent_id, agent_domain)
 
         return self.agent_id
 
+    def bind_descriptor_signals(self):
+        """
+        Binds the work queue, or the signal queue, to the descriptor
+        exchange, so that only descriptors whose selector matches
+        self.selector_prefixes are received.
+        """
+        self.channel.exchange_declare(exchange=DESCRIPTOR_EXCHANGE,
+                                      type='topic')
+        queue = self.signal_queue
+        if self.work_queue:
+            self.channel.queue_declare(queue=self.work_queue, durable=True,
+                                       arguments=WORK_QUEUE_ARGUMENTS)
+            queue = self.work_queue
+        for key in binding_keys(self.selector_prefixes):
+            self.channel.queue_bind(exchange=DESCRIPTOR_EXCHANGE,
+                                    queue=queue, routing_key=key)
+
     def lock(self, agent_id, lockid, desc_domain, selector):
+        if self.work_item is None:
+            return bool(self.rpc_lock(str(agent_id), lockid, desc_domain,
+                                      selector))
+        if not self.work_item.redelivered:
+            # work items are delivered to a single instance: the lock is
+            # registered without waiting for the master's reply
+            self.rpc_lock(str(agent_id), lockid, desc_domain, selector,
+                          wait=False, work_item=True)
+            return True
+        # the instance this item was first delivered to has disconnected
+        # before acknowledging it: the master hands its lock over
         return bool(self.rpc_lock(str(agent_id), lockid, desc_domain,
-                                  selector))
+                                  selector, work_item=True,
+                                  redelivered=True))
 
     def unlock(self, agent_id, lockid, desc_domain, selector,
                processing_failed, retries, wait_time):
@@ -309,20 +571,65 @@ class RabbitBus(Bus):
             self.busthread_call(self._push, str(agent_id), descriptor)
 
     def _push(self, agent_id, descriptor):
-        sd = descriptor.serialize(serializer)
-        return bool(self.rpc_push(str(agent_id), sd))
+        """
+        Returns an RPCReply, unless the value has been spooled: the push is
+        pipelined, and testing the reply's truth value waits for the master's
+        answer (True if the descriptor was not already present).
+        """
+        if self.spool_dir and should_spool(descriptor, self.spool_threshold):
+            name = spool_value(self.spool_dir, descriptor)
+            if self.rpc_push_spooled(
+                    str(agent_id), descriptor.serialize_meta(self.serializer),
+                    name):
+                return True
+            if not remove_spooled(self.spool_dir, name):
+                # adopted or removed by the master: descriptor was known
+                return False
+            log.warning("Spooled value has been rejected by the bus master, "
+                        "sending it in the RPC message instead")
+        sd = descriptor.serialize(self.serializer)
+        return self.rpc_push(str(agent_id), sd)
+
+    def unserialize_descriptor(self, s):
+        """
+        Unserializes descriptor metadata sent by the bus master. It has been
+        checked when it was pushed, and is not checked again.
+        """
+        return Descriptor.unserialize(self.serializer, str(s), bus=self,
+                                      trusted=True)
 
     def get(self, agent_id, desc_domain, selector):
         result = str(self.rpc_get(str(agent_id), desc_domain, selector))
         if result == "":
             return None
-        return Descriptor.unserialize(serializer, result, bus=self)
+        return self.unserialize_descriptor(result)
+
+    def get_descriptors(self, agent_id, desc_domain, selectors):
+        results = self.rpc_get_descriptors(str(agent_id), desc_domain,
+                                           list(selectors))
+        return [None if str(result) == "" else
+                self.unserialize_descriptor(result) for result in results]
 
     def get_value(self, agent_id, desc_domain, selector):
         result = str(self.rpc_get_value(str(agent_id), desc_domain, selector))
         if result == "":
             return None
-        return Descriptor.unserialize_value(serializer, result)
+        return Descriptor.unserialize_value(self.serializer, result)
+
+    def get_values(self, agent_id, desc_domain, selectors):
+        results = self.rpc_get_values(str(agent_id), desc_domain,
+                                      list(selectors))
+        return [None if str(result) == "" else
+                Descriptor.unserialize_value(self.serializer, str(result))
+                for result in results]
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        result = str(self.rpc_get_value_range(str(agent_id), desc_domain,
+                                              selector, offset, length))
+        if result == "":
+            return None
+        return Descriptor.unserialize_value(self.serializer, result)
 
     def list_uuids(self, agent_id, desc_domain):
         return {str(k): v.encode('utf-8') for k, v in
@@ -337,20 +644,17 @@ class RabbitBus(Bus):
                          offset=0):
         dlist = self.rpc_find_by_selector(
             str(agent_id), desc_domain, selector_prefix, limit, offset)
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                dlist]
+        return [self.unserialize_descriptor(s) for s in dlist]
 
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         dlist = self.rpc_find_by_uuid(str(agent_id), desc_domain, uuid)
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                dlist]
+        return [self.unserialize_descriptor(s) for s in dlist]
 
     def find_by_value(self, agent_id, desc_domain, selector_prefix,
                       value_regex):
         dlist = self.rpc_find_by_value(
             str(agent_id), desc_domain, selector_prefix, value_regex)
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                dlist]
+        return [self.unserialize_descriptor(s) for s in dlist]
 
     def mark_processed(self, agent_id, desc_domain, selector):
         self.rpc_mark_processed(str(agent_id), desc_domain, selector)
@@ -372,9 +676,9 @@ class RabbitBus(Bus):
         return [(str(k), int(v)) for k, v in stats], int(total)
 
     def get_children(self, agent_id, desc_domain, selector, recurse=True):
-        return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
-                self.rpc_get_children(str(agent_id), desc_domain, selector,
-                                      recurse)]
+        return [self.unserialize_descriptor(s)
+                for s in self.rpc_get_children(str(agent_id), desc_domain,
+                                               selector, recurse)]
 
     def store_internal_state(self, agent_id, state):
         self.rpc_store_internal_state(str(agent_id), state)
@@ -398,6 +702,8 @@ class RabbitBus(Bus):
         log.debug("Unregistering...")
         self.rpc_unregister(self.agent_id)
         self.agent.save_internal_state()
+        self.flush_rpcs()
+        self.rpc_channel.close()
         self.channel.close()
         self.connection.close()
 
@@ -412,6 +718,10 @@ class RabbitBus(Bus):
             self.channel.basic_consume(self.signal_handler,
                                        queue=self.signal_queue,
                                        no_ack=True)
+            if self.work_queue:
+                # prefetch_count=1: work items are fairly distributed
+                self.channel.basic_consume(self.work_handler,
+                                           queue=self.work_queue)
             log.info("Entering agent loop")
             b = False
             while not b:
@@ -462,3 +772,34 @@ class RabbitBus(Bus):
         subparser.add_argument(
             "--heartbeat", help="Rabbitmq heartbeat interval, in seconds",
             default=0)
+        subparser.add_argument(
+            "--serializer", default="picklev2",
+            choices=bus_serializer_names(),
+            help="Serializer used for descriptors and values, if supported "
+            "by the bus master")
+        subparser.add_argument(
+            "--spool-dir",
+            help="Directory shared with the bus master (--spool-dir master "
+            "option), in which large values are written instead of being "
+            "sent through rabbitmq")
+        subparser.add_argument(
+            "--spool-threshold", type=int, default=16*1024*1024,
+            help="Size in bytes above which values are written to the spool "
+            "directory")
+        subparser.add_argument(
+            "--rpc-window", type=int, default=64,
+            help="Max number of RPCs whose result is not needed right away "
+            "(push, mark_processed...) that may be in flight. 1 disables "
+            "pipelining")
+        subparser.add_argument(
+            "--rpc-batch-size", type=int, default=100,
+            help="Max number of fire-and-forget RPCs sent to the master in a "
+            "single message. 1 disables batching")
+        subparser.add_argument(
+            "--rpc-linger", type=float, default=0.005,
+            help="Max time in seconds fire-and-forget RPCs are held back, to "
+            "be sent in a batch")
+        subparser.add_argument(
+            "--no-work-queue", action="store_true",
+            help="Receive every new descriptor, instead of sharing them with "
+            "other instances of the same agent through a work queue")
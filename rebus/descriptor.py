@@ -8,16 +8,35 @@ from random import SystemRandom
 log = logging.getLogger("rebus.descriptor")
 
 
+def intern_str(s):
+    """
+    Returns an interned copy of s if it is a byte string, so that equal
+    strings held by many descriptors (domain, agent name, uuid, precursor
+    selectors...) share a single object. Other values are returned as is.
+    """
+    if type(s) is str:
+        return intern(s)
+    return s
+
+
 class Descriptor(object):
 
+    #: No per-instance __dict__: large in-memory stores keep many descriptors
+    #: alive. The hash is not stored, it is read from the selector.
+    __slots__ = ('label', 'selector', 'domain', 'agent', 'precursors',
+                 'version', 'processing_time', 'uuid', 'bus', '_value')
+
     allowed_selector_chars = string.letters + string.digits + '~%/_-'
     allowed_domain_chars = string.letters + string.digits + '-'
+    #: characters removed from byte string domains, using str.translate
+    _domain_deletechars = string.maketrans('', '').translate(
+        None, allowed_domain_chars)
     NAMESPACE_REBUS = m_uuid.uuid5(m_uuid.NAMESPACE_DNS, "rebus.airbus.com")
 
     def __init__(self, label, selector, value=None, domain="default",
                  agent=None, precursors=None, version=0, processing_time=-1,
                  uuid=None, bus=None):
-        self.label = label
+        self.label = intern_str(label)
         """
         :param label: descriptor's label. Usually a file name, or
             human-understandable handle
@@ -36,49 +55,92 @@ class Descriptor(object):
 
         #: contains a list of parent descriptors' selectors. Typically contains
         #: 0 (ex. injected binaries), or (version+1) values
-        self.precursors = precursors if precursors is not None else []
+        self.precursors = [intern_str(p) for p in precursors] \
+            if precursors is not None else []
 
-        self.agent = agent
+        self.agent = intern_str(agent)
 
         self.bus = bus
 
         p = selector.rfind("%")
         if p >= 0:
-            self.hash = selector[(p + 1):]
+            hashvalue = selector[(p + 1):]
         else:
+            # hash parts one after the other, instead of hashing their
+            # concatenation, which would copy the value
+            h = hashlib.sha256()
             if self.agent and self.precursors:
                 if type(value) is unicode:
                     strvalue = value.encode('utf-8')
                 else:
                     strvalue = str(value)
-                v = str(self.agent) + str(self.precursors) + selector + \
-                    strvalue
+                h.update(str(self.agent))
+                h.update(str(self.precursors))
+                h.update(selector)
+                h.update(strvalue)
             else:
                 if value is None:
                     # v should only be None when Descriptor is instanciated
                     # from metadata only (implicit reference to stored value)
                     raise Exception('Hash value missing')
-                v = value
-            self.hash = hashlib.sha256(v).hexdigest()
-            selector = os.path.join(selector, "%" + self.hash)
-        self.selector = ''.join([c for c in selector if c in
-                                 Descriptor.allowed_selector_chars])
-        self.selector = selector
-        if self.bus is None:
-            self.value = value
-        self.domain = ''.join([c for c in domain if c in
-                               Descriptor.allowed_domain_chars])
+                h.update(value)
+            hashvalue = h.hexdigest()
+            selector = os.path.join(selector, "%" + hashvalue)
+        # interned, so that children's precursors share this string
+        self.selector = intern_str(selector)
+        self.value = value if self.bus is None else None
+        if type(domain) is str:
+            domain = domain.translate(None, self._domain_deletechars)
+        else:
+            domain = ''.join([c for c in domain if c in
+                              Descriptor.allowed_domain_chars])
+        self.domain = intern_str(domain)
         self.version = version
         #: if -1, will be set by agent when push() is called
         self.processing_time = processing_time
         if uuid is None:
-            uuid = str(m_uuid.uuid5(self.NAMESPACE_REBUS, self.hash))
+            uuid = str(m_uuid.uuid5(self.NAMESPACE_REBUS, hashvalue))
         #: A new uuid is generated for:
         #:
         #: * newly injected descriptors
         #: * descriptors that will have several versions
         #: * new versions of descriptors
-        self.uuid = uuid
+        self.uuid = intern_str(uuid)
+
+    @classmethod
+    def from_trusted(cls, label, selector, value=None, domain="default",
+                     agent=None, precursors=None, version=0,
+                     processing_time=-1, uuid=None, bus=None):
+        """
+        Builds a descriptor from metadata that has already been checked by
+        the constructor of another Descriptor, such as unserialized metadata.
+        Neither hashes the value nor filters the domain.
+        Falls back to the constructor if selector has no hash or uuid is
+        missing.
+        """
+        if uuid is None or '%' not in selector:
+            return cls(label, selector, value, domain, agent, precursors,
+                       version, processing_time, uuid, bus)
+        desc = cls.__new__(cls)
+        desc.label = intern_str(label)
+        desc.selector = intern_str(selector)
+        desc.domain = intern_str(domain)
+        desc.agent = intern_str(agent)
+        desc.precursors = [intern_str(p) for p in precursors] \
+            if precursors is not None else []
+        desc.version = version
+        desc.processing_time = processing_time
+        desc.uuid = intern_str(uuid)
+        desc.bus = bus
+        desc.value = value if bus is None else None
+        return desc
+
+    @property
+    def hash(self):
+        """
+        Hash part of the selector.
+        """
+        return self.selector[(self.selector.rfind("%") + 1):]
 
     @classmethod
     def new_with_randomhash(cls, label, selector, *args, **kwargs):
@@ -177,11 +239,19 @@ class Descriptor(object):
             uuid=otherdesc.uuid)
         return link1, link2
 
+    def meta_dict(self):
+        """
+        Returns a dictionary containing descriptor metadata.
+        """
+        return {"label": self.label, "selector": self.selector,
+                "domain": self.domain, "agent": self.agent,
+                "precursors": self.precursors, "version": self.version,
+                "processing_time": self.processing_time, "uuid": self.uuid}
+
     def serialize(self, serializer):
-        return serializer.dumps(
-            {k: getattr(self, k) for k in dir(self)
-             if k in ["label", "selector", "value", "domain", "agent",
-                      "precursors", "version", "processing_time", "uuid"]})
+        d = self.meta_dict()
+        d["value"] = self.value
+        return serializer.dumps(d)
 
     def serialize_meta(self, serializer):
         """
@@ -190,10 +260,7 @@ class Descriptor(object):
         # FIXME dumps may return non-ascii characters ("extended" ascii, "8-bit
         # ascii") which may result in invalid UTF-8, thus causing errors when
         # using dbus
-        return serializer.dumps(
-            {k: getattr(self, k) for k in dir(self)
-             if k in ["label", "selector", "domain", "agent", "precursors",
-                      "version", "processing_time", "uuid"]})
+        return serializer.dumps(self.meta_dict())
 
     def serialize_value(self, serializer):
         """
@@ -206,13 +273,62 @@ class Descriptor(object):
         return serializer.loads(s)
 
     @classmethod
-    def unserialize(cls, serializer, s, bus=None):
+    def unserialize(cls, serializer, s, bus=None, trusted=False):
+        """
+        :param trusted: if True, s is known to have been produced by
+            Descriptor.serialize (ex. metadata read from storage), and is not
+            checked again. Otherwise, s is checked as if it had been pushed by
+            an agent.
+        """
         unserialized = serializer.loads(s)
         if unserialized:
+            if trusted:
+                return cls.from_trusted(bus=bus, **unserialized)
             return cls(bus=bus, **unserialized)
         else:
             return None
 
+    @staticmethod
+    def slice_value(value, offset, length):
+        """
+        Returns value[offset:offset+length] if value is a byte string, else
+        the whole value.
+        """
+        if type(value) is str:
+            return value[offset:offset+length]
+        return value
+
+    @staticmethod
+    def prefetch_values(descriptors):
+        """
+        Fetches values of descriptors that have not been retrieved yet, using
+        one bus.get_values call per bus and domain instead of one
+        bus.get_value call per descriptor. Returns descriptors.
+        """
+        pending = {}
+        for desc in descriptors:
+            if desc is not None and desc.bus is not None:
+                pending.setdefault((desc.bus, desc.domain), []).append(desc)
+        for (bus, domain), descs in pending.iteritems():
+            values = bus.get_values(descs[0].agent, domain,
+                                    [d.selector for d in descs])
+            for desc, value in zip(descs, values):
+                desc._value = value
+                desc.bus = None
+        return descriptors
+
+    def value_range(self, offset, length):
+        """
+        Returns at most length bytes of this descriptor's value, starting at
+        offset. Values that are not byte strings are returned whole.
+        Only the requested range is fetched from the bus if the value has not
+        been retrieved yet.
+        """
+        if self.bus is None:
+            return self.slice_value(self._value, offset, length)
+        return self.bus.get_value_range(self.agent, self.domain,
+                                        self.selector, offset, length)
+
     @property
     def value(self):
         if self.bus is None:
@@ -233,8 +349,28 @@ class Descriptor(object):
             v = "[%i][%s...]" % (len(v), v[:22])
         return "%s:%s(%s)=%s" % (self.domain, self.selector, self.label.encode('utf-8'), v)
 
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        # state of descriptors pickled by older versions is their __dict__,
+        # which has a 'hash' key, and no '_value' key if bus was set
+        self.bus = None
+        self._value = None
+        for k in self.__slots__:
+            if k in state:
+                setattr(self, k, state[k])
+        for k in ('label', 'selector', 'domain', 'agent', 'uuid'):
+            setattr(self, k, intern_str(getattr(self, k)))
+        self.precursors = [intern_str(p) for p in self.precursors]
+
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Descriptor):
+            return False
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
         """
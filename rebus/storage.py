@@ -1,5 +1,8 @@
 #!/usr/bin/env python2
+import os
+from rebus.descriptor import Descriptor
 from rebus.tools.registry import Registry
+from rebus.tools.spool import read_spooled
 
 
 class StorageRegistry(Registry):
@@ -120,6 +123,31 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def get_values(self, domain, selectors):
+        """
+        Get values of several selectors, in the same order. Missing
+        descriptors' values are None.
+
+        :param domain: string, domain on which operations are performed
+        :param selectors: list of strings
+        """
+        return [self.get_value(domain, selector) for selector in selectors]
+
+    def get_value_range(self, domain, selector, offset, length):
+        """
+        Get at most length bytes of a selector's value, starting at offset.
+        Values that are not byte strings are returned whole.
+
+        Returns None if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        :param offset: int, offset of the first byte to return
+        :param length: int, max number of bytes to return
+        """
+        value = self.get_value(domain, selector)
+        return Descriptor.slice_value(value, offset, length)
+
     def get_children(self, domain, selector, recurse=True):
         """
         Return a set of children descriptors from given selector.
@@ -139,6 +167,22 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def add_spooled(self, descriptor, path):
+        """
+        Add new descriptor, whose value has been written to file path by a bus
+        slave (see rebus.tools.spool). This file is then removed, or adopted
+        by the storage. Return False if descriptor was already present, else
+        True.
+
+        Default implementation reads the value, then calls add().
+
+        :param descriptor: descriptor to be stored, without its value
+        :param path: path of the spooled value file
+        """
+        descriptor.value = read_spooled(path)
+        os.remove(path)
+        return self.add(descriptor)
+
     def mark_processed(self, domain, selector, agent_name, config_txt):
         """
         Mark given selector as having been processed by given agent whose
@@ -198,6 +242,30 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def count_processed(self, domain, agent_name, config_txt):
+        """
+        Returns the number of selectors of this domain that have been
+        processed by given agent whose configuration is serialized in
+        config_txt.
+
+        :param domain: string, domain on which operations are performed
+        :param agent_name: string, agent name
+        :param config_txt: string, serialized configuration of agent
+            describing output altering options
+        """
+        raise NotImplementedError
+
+    def count_unprocessed_by_agent(self, agent_name, config_txt):
+        """
+        Return the number of descriptors that have not been processed by this
+        agent, in every domain, i.e. len(list_unprocessed_by_agent(...)).
+
+        :param agent_name: string, agent name
+        :param config_txt: string, serialized configuration of agent
+            describing output altering options
+        """
+        return len(self.list_unprocessed_by_agent(agent_name, config_txt))
+
     def store_agent_state(self, agent_name, state):
         """
         Store serialized agent state.
@@ -225,7 +293,8 @@ class Storage(object):
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         """
         Return a list of (domain, uuid, selector) that have not been processed
-        by this agent, identified by its name.
+        by this agent, identified by its name, from oldest to newest in each
+        domain.
 
         :param agent_name: string, agent name
         :param config_txt: string, serialized configuration of agent
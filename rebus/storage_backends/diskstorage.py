@@ -1,6 +1,14 @@
+import argparse
+import copy
+import errno
+import hashlib
 import logging
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
 import threading
 import time
 from collections import defaultdict
@@ -8,14 +16,203 @@ from collections import OrderedDict
 from collections import Counter
 from rebus.storage import Storage
 from rebus.descriptor import Descriptor
+from rebus.tools.lru import LRUCache
+from rebus.tools.selector_index import SelectorIndex
 from rebus.tools.serializer import picklev2 as store_serializer
+from rebus.tools.serializer import compactmeta as meta_serializer
+from rebus.tools.values import RAW_VALUE_TAG, COMPRESSORS, DECOMPRESSORS, \
+    encode_value, compress_chunks, decompress_value, read_decompressed, \
+    decode_value
 log = logging.getLogger("rebus.storage.diskstorage")
 
+#: Version of the index snapshot format. Snapshots having another version are
+#: ignored.
+INDEX_FORMAT = 1
+#: Directories modified less than INDEX_MTIME_SLACK seconds before the index
+#: snapshot was taken are rescanned, to accommodate coarse file system
+#: timestamps.
+INDEX_MTIME_SLACK = 2
+
+
+def compress_prefix(text):
+    """
+    Parses PREFIX=ALGORITHM compression policy arguments.
+    """
+    prefix, _, algorithm = text.rpartition('=')
+    if not prefix or algorithm not in ('none',) + tuple(COMPRESSORS):
+        raise argparse.ArgumentTypeError(
+            "invalid compression policy %r, expected PREFIX=ALGORITHM where "
+            "ALGORITHM is one of none, %s" % (text, ', '.join(COMPRESSORS)))
+    return prefix, algorithm
+
+
+def plain_dict(dd):
+    """
+    Returns a copy of a two-level defaultdict, made of plain dicts that can be
+    pickled.
+    """
+    return dict((key, dict(value)) for key, value in dd.items())
+
+
+def replay_journal(processed, fname):
+    """
+    Applies records from the journal file fname to processed. Replaying a
+    journal several times yields the same result.
+    A truncated last record (ex. diskstorage was killed while writing it) is
+    ignored.
+    Returns the offset of the end of the last valid record.
+
+    :param processed: processed['domain']['/selector/%hash'] is a set of
+        (agent name, configuration text)
+    """
+    with open(fname, 'rb') as fp:
+        while True:
+            pos = fp.tell()
+            try:
+                records = store_serializer.load(fp)
+            except EOFError:
+                return pos
+            except Exception:
+                log.warning("Ignoring truncated record at the end of journal "
+                            "%s", fname)
+                return pos
+            for record in records:
+                if record[0] == 'add':
+                    _, dom, sel = record
+                    if sel not in processed[dom]:
+                        processed[dom][sel] = set()
+                elif record[0] == 'processed':
+                    _, dom, sel, agent_name, config_txt = record
+                    processed[dom].setdefault(sel, set()).add(
+                        (agent_name, config_txt))
+
+
+def discover_tree(basepath, relpath, state_extensions, existing_paths,
+                  descend, known):
+    """
+    Recursively lists descriptor files stored below relpath, checks their
+    consistency and yields unserialized metadata.
+
+    :param basepath: storage base path
+    :param relpath: starts and ends with a '/', relative to basepath
+    :param state_extensions: extensions of files that may be found in
+        basepath, describing storage state
+    :param existing_paths: set, visited directories are added to it
+    :param descend: function taking a subdirectory path relative to basepath,
+        returns False if it should not be visited
+    :param known: known['domain'] contains selectors that should be skipped
+    """
+    if relpath in ('/agent_intstate/', '/_blobs/', '/_tmp/'):
+        # Ignore internal state of agents, shared values and files being
+        # written
+        return
+
+    path = basepath + relpath
+    existing_paths.add(path)
+
+    for elem in os.listdir(path):
+        name = path + elem
+        relname = relpath + elem
+        if os.path.isdir(name):
+            if descend(relname + '/'):
+                for desc in discover_tree(basepath, relname + '/',
+                                          state_extensions, existing_paths,
+                                          descend, known):
+                    yield desc
+        elif os.path.isfile(name):
+            basename = name.rsplit('.', 1)[0]
+            if name.endswith('.value'):
+                # Serialized descriptor value
+                if not os.path.isfile(basename + '.meta'):
+                    raise Exception(
+                        'Missing associated metadata for %s' % relname)
+            elif name.endswith('.meta'):
+                # Serialized descriptor metadata
+                if not os.path.isfile(basename + '.value'):
+                    raise Exception(
+                        'Missing associated value for %s' % relname)
+                domain, _, selector = \
+                    relname.rsplit('.', 1)[0][1:].partition('/')
+                if '/' + selector in known.get(domain, ()):
+                    continue
+                with open(name, 'rb') as fp:
+                    try:
+                        desc = Descriptor.unserialize(meta_serializer,
+                                                      fp.read(), trusted=True)
+                    except:
+                        log.error(
+                            "Could not unserialize metadata from file %s",
+                            name)
+                        raise
+                    fname_selector = relname.rsplit('.')[0]
+                    # check consistency between file name and serialized
+                    # metadata
+                    fname_domain = fname_selector.split('/')[1]
+                    if fname_domain != desc.domain:
+                        raise Exception(
+                            'Filename domain %s does not match metadata '
+                            'domain %s for descriptor %s' %
+                            (fname_domain, desc.domain, fname_selector))
+                    fname_hash = fname_selector.rsplit('%', 1)[1]
+                    if fname_hash != desc.hash:
+                        raise Exception(
+                            'Filename hash %s does not match metadata hash'
+                            ' %s for descriptor %s' %
+                            (fname_hash, desc.domain, fname_selector))
+
+                    yield desc
+            elif name.endswith(state_extensions) and relpath == '/':
+                # Bus configuration, restored by load_state()
+                pass
+            else:
+                raise Exception(
+                    'Invalid file name - %s has an invalid extension '
+                    '(must be .value, .meta, .cfg or .journal)' % relname)
+        else:
+            raise Exception(
+                'Invalid file type - %s is neither a regular file nor a '
+                'directory' % name)
+
+
+def copy_meta(desc):
+    """
+    Returns a copy of desc that does not share mutable metadata with it, so
+    that either of them may be modified.
+    """
+    desc = copy.copy(desc)
+    desc.precursors = list(desc.precursors)
+    return desc
+
+
+def meta_entry(desc):
+    """
+    Returns the tuple of metadata that is needed to register desc in
+    DiskStorage indexes.
+    """
+    return (desc.domain, desc.selector, desc.version, desc.precursors,
+            desc.uuid, desc.label)
+
+
+def discover_worker(args):
+    """
+    Process pool worker, used to discover descriptors stored below relpath.
+    Returns (visited directories, list of meta_entry() tuples).
+
+    :param args: (basepath, relpath, state_extensions)
+    """
+    basepath, relpath, state_extensions = args
+    existing_paths = set()
+    entries = [meta_entry(desc) for desc in
+               discover_tree(basepath, relpath, state_extensions,
+                             existing_paths, lambda subpath: True, {})]
+    return existing_paths, entries
+
 
 class CheckpointThread(threading.Thread):
     """
-    Calls store_state periodically to avoid losing it completely in case
+    Calls checkpoint periodically to avoid losing processed state in case
     diskstorage gets killed ungracefully.
+    Journal compaction, if needed, also happens in this thread.
     """
     def __init__(self, storage):
         threading.Thread.__init__(self)
@@ -24,7 +221,7 @@ class CheckpointThread(threading.Thread):
     def run(self):
         while True:
             time.sleep(5)
-            self.storage.store_state()
+            self.storage.checkpoint()
 
 
 @Storage.register
@@ -37,6 +234,8 @@ class DiskStorage(Storage):
     STORES_INTSTATE = True
     selector_regex = re.compile('^[a-zA-Z0-9~%/_-]*$')
     domain_regex = re.compile('^[a-zA-Z0-9-]*$')
+    #: extensions of files describing processed state
+    state_extensions = ('.cfg', '.journal', '.journal.old', '.tmp')
 
     def __init__(self, options):
         self.basepath = options.path.rstrip('/')
@@ -45,6 +244,14 @@ class DiskStorage(Storage):
             raise IOError('Directory %s does not exist' % self.basepath)
         if not os.path.isdir(self.basepath + '/agent_intstate'):
             os.makedirs(self.basepath + '/agent_intstate')
+        #: Temporary files are written there, then renamed. Files left by a
+        #: previous run have not been renamed, and are removed
+        self.tmppath = self.basepath + '/_tmp'
+        if os.path.isdir(self.tmppath):
+            for name in os.listdir(self.tmppath):
+                os.unlink(os.path.join(self.tmppath, name))
+        else:
+            os.makedirs(self.tmppath)
 
         #: Set of existing descriptor storage directories, all starting and
         #: ending with '/'
@@ -68,9 +275,86 @@ class DiskStorage(Storage):
         #: access to self.processed must be protected using self.processedlock
         self.processed = defaultdict(OrderedDict)
 
-        self.unsavedprocessed = False
+        #: Records describing changes to self.processed, that have not yet
+        #: been appended to the journal file.
+        #: access to self.journal_buffer must be protected using
+        #: self.processedlock
+        self.journal_buffer = []
+
+        #: Processed state is saved to a snapshot, self.snapshot_fname,
+        #: and an append-only journal of subsequent changes,
+        #: self.journal_fname. The journal is merged into a new snapshot
+        #: once it grows larger than self.journal_max_size bytes.
+        self.snapshot_fname = self.basepath + '/_processed.cfg'
+        self.cursors_fname = self.basepath + '/_cursors.cfg'
+        self.journal_fname = self.basepath + '/_processed.journal'
+        self.journal_max_size = options.journal_max_size
+        self.journal_size = 0
+
+        #: Descriptor indexes (self.version_cache, self.edges, self.uuids,
+        #: self.labels...) are saved to self.index_fname when the storage is
+        #: stopped, when the journal is compacted, and by checkpoints at most
+        #: every self.index_interval seconds if descriptors have been added,
+        #: so that only directories that have been modified since have to be
+        #: scanned at next startup.
+        self.index_fname = self.basepath + '/_index.cfg'
+        self.index_interval = options.index_interval
+        self.index_time = time.time()
+
+        #: True if descriptors have been added to the journal since the index
+        #: snapshot was last written
+        self.index_dirty = False
+
+        #: serializes writes to self.index_fname
+        self.indexlock = threading.Lock()
+
+        #: If True, identical values are stored once, in _blobs/
+        self.dedup = options.dedup
+
+        #: Values larger than self.compress_min_size bytes are compressed
+        #: using self.compression ('none', 'zlib' or 'bz2'), unless their
+        #: selector starts with a prefix listed in self.compress_prefixes
+        self.compression = options.compress
+        self.compress_min_size = options.compress_min_size
+
+        #: list of (selector prefix, compression algorithm), longest
+        #: prefixes first
+        self.compress_prefixes = sorted(options.compress_prefix,
+                                        key=lambda p: len(p[0]), reverse=True)
+
+        #: Number of processes used to discover descriptors when no index
+        #: snapshot can be used. Discovery runs in the master process if 1.
+        self.discovery_workers = options.discovery_workers or \
+            multiprocessing.cpu_count()
+
+        #: self.meta_cache[('domain', '/selector/%hash')] is a metadata-only
+        #: Descriptor, which is copied before being returned by
+        #: get_descriptor()
+        self.meta_cache = LRUCache(options.meta_cache_size)
+
+        #: serializes calls to checkpoint
+        self.checkpointlock = threading.Lock()
+
+        #: self.processed_counts['domain'][(agent name, configuration text)]
+        #: is the number of selectors that have been processed by this agent.
+        #: access to self.processed_counts must be protected using
+        #: self.processedlock
+        self.processed_counts = defaultdict(Counter)
+
+        #: self.processed_name_counts['domain']['agent name'] is the number
+        #: of selectors that have been processed by this agent, summed over
+        #: all its configurations.
+        #: access to self.processed_name_counts must be protected using
+        #: self.processedlock
+        self.processed_name_counts = defaultdict(Counter)
 
-        #: protects access to self.processed
+        #: self.selector_index['domain'] indexes selectors present in
+        #: self.processed['domain'], allowing fast prefix lookups.
+        #: access to self.selector_index must be protected using
+        #: self.processedlock
+        self.selector_index = defaultdict(SelectorIndex)
+
+        #: protects access to self.processed, and associated indexes
         self.processedlock = threading.RLock()
 
         #: self.processable['domain']['/selector/%hash'] is a set of (agent
@@ -87,142 +371,273 @@ class DiskStorage(Storage):
         #: this UUID
         self.labels = defaultdict(lambda: defaultdict(str))
 
+        #: self.selector_uuids['domain']['/selector/%hash'] is the uuid of
+        #: this descriptor
+        self.selector_uuids = defaultdict(dict)
+
         # Enumerate existing files & dirs
         with self.processedlock:
-            self.discover('/')
+            # Restore processed state first, so that selectors keep the same
+            # order across restarts
+            cursors = self.load_state()
+            if not self.load_index():
+                self.discover_all()
+                # remove blobs whose descriptor has not been written
+                self.collect_blobs()
+            for domain, selectors in self.processed.items():
+                for selector, name_confs in selectors.iteritems():
+                    self.selector_index[domain].add(selector)
+                    for agent_name, config_txt in name_confs:
+                        self.processed_counts[domain][
+                            (agent_name, config_txt)] += 1
+                        self.processed_name_counts[domain][agent_name] += 1
+            # Restore unprocessed cursors, which refer to selectors' order
+            for domain, domain_cursors in cursors.items():
+                self.selector_index[domain].cursors.update(domain_cursors)
+
+        if options.recompress:
+            for domain in self.selector_index.keys():
+                self.recompress(domain)
 
         # start _processed flushing thread
         self.checkpointThread = CheckpointThread(self)
         self.checkpointThread.daemon = True
         self.checkpointThread.start()
 
-    def discover(self, relpath):
+    def discover(self, relpath, recurse=True):
         """
-        Recursively add existing files to storage.
+        Recursively add existing files to storage. Descriptors that are
+        already known are skipped.
 
         self.processedlock must be acquired prior to calling this function
 
         :param relpath: starts and ends with a '/', relative to self.basepath
+        :param recurse: if False, only descend into subdirectories that are
+            not in self.existing_paths
+        """
+        def descend(subpath):
+            return recurse or self.basepath + subpath not in \
+                self.existing_paths
+        for desc in discover_tree(self.basepath, relpath,
+                                  self.state_extensions, self.existing_paths,
+                                  descend, self.selector_uuids):
+            self.register_meta(desc)
+
+    def discover_all(self):
+        """
+        Add every existing file to storage. Selector subtrees (ex.
+        /domain/binary/) are scanned in parallel by a pool of
+        self.discovery_workers processes.
+
+        self.processedlock must be acquired prior to calling this function
         """
-        if relpath == '/agent_intstate/':
-            # Ignore internal state of agents
+        subtrees = []
+
+        def descend(subpath):
+            if subpath.count('/') <= 2:
+                # root or domain directory
+                return True
+            subtrees.append(subpath)
+            return False
+        for desc in discover_tree(self.basepath, '/', self.state_extensions,
+                                  self.existing_paths, descend, {}):
+            self.register_meta(desc)
+
+        workers = min(self.discovery_workers, len(subtrees))
+        if workers <= 1:
+            for subtree in subtrees:
+                self.discover(subtree)
             return
+        tasks = [(self.basepath, subtree, self.state_extensions) for subtree
+                 in subtrees]
+        pool = multiprocessing.Pool(workers)
+        try:
+            # results are merged in subtree order, so that selectors are
+            # registered in the same order as sequential discovery would
+            for paths, entries in pool.imap(discover_worker, tasks):
+                self.existing_paths.update(paths)
+                for entry in entries:
+                    self.register_entry(entry)
+        finally:
+            pool.terminate()
+            pool.join()
 
-        path = self.basepath + relpath
-        self.existing_paths.add(path)
-
-        for elem in os.listdir(path):
-            name = path + elem
-            relname = relpath + elem
-            if os.path.isdir(name):
-                self.discover(relname + '/')
-            elif os.path.isfile(name):
-                basename = name.rsplit('.', 1)[0]
-                if name.endswith('.value'):
-                    # Serialized descriptor value
-                    if not os.path.isfile(basename + '.meta'):
-                        raise Exception(
-                            'Missing associated metadata for %s' % relname)
-                elif name.endswith('.meta'):
-                    # Serialized descriptor metadata
-                    if not os.path.isfile(basename + '.value'):
-                        raise Exception(
-                            'Missing associated value for %s' % relname)
-                    with open(name, 'rb') as fp:
-                        try:
-                            desc = Descriptor.unserialize(store_serializer,
-                                                          fp.read())
-                        except:
-                            log.error(
-                                "Could not unserialize metadata from file %s",
-                                name)
-                            raise
-                        fname_selector = relname.rsplit('.')[0]
-                        # check consistency between file name and serialized
-                        # metadata
-                        fname_domain = fname_selector.split('/')[1]
-                        if fname_domain != desc.domain:
-                            raise Exception(
-                                'Filename domain %s does not match metadata '
-                                'domain %s for descriptor %s' %
-                                (fname_domain, desc.domain, fname_selector))
-                        fname_hash = fname_selector.rsplit('%', 1)[1]
-                        if fname_hash != desc.hash:
-                            raise Exception(
-                                'Filename hash %s does not match metadata hash'
-                                ' %s for descriptor %s' %
-                                (fname_hash, desc.domain, fname_selector))
-
-                        self.register_meta(desc)
-                elif name.endswith('.cfg') and relpath == '/':
-                    # Bus configuration
-                    # TODO periodically save this file. Use two file, overwrite
-                    # oldest.
-                    if elem == '_processed.cfg':
-                        with open(name, 'rb') as fp:
-                            # copy processed info to self.processed
-                            p = store_serializer.load(fp)
-                            for dom in p.keys():
-                                for sel, val in p[dom].items():
-                                    self.processed[dom][sel] = val
-                else:
-                    raise Exception(
-                        'Invalid file name - %s has an invalid extension '
-                        '(must be .value, .meta or .cfg)' % relname)
-            else:
-                raise Exception(
-                    'Invalid file type - %s is neither a regular file nor a '
-                    'directory' % name)
+    def load_state(self):
+        """
+        Restore processed state from disk: load snapshot, then replay
+        journals. Returns unprocessed cursors,
+        cursors['domain'][(agent name, configuration text)] = position.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        cursors = {}
+        if os.path.isfile(self.journal_fname + '.old'):
+            # Journal compaction had been interrupted
+            self.merge_journal(self.journal_fname + '.old')
+        if os.path.isfile(self.snapshot_fname):
+            with open(self.snapshot_fname, 'rb') as fp:
+                # copy processed info to self.processed
+                p = store_serializer.load(fp)
+                for dom in p.keys():
+                    for sel, val in p[dom].items():
+                        self.processed[dom][sel] = val
+            # cursors are only valid along with the processed state they were
+            # saved with, or an older one
+            if os.path.isfile(self.cursors_fname):
+                with open(self.cursors_fname, 'rb') as fp:
+                    cursors = store_serializer.load(fp)
+        if os.path.isfile(self.journal_fname):
+            self.journal_size = replay_journal(self.processed,
+                                               self.journal_fname)
+            if self.journal_size < os.path.getsize(self.journal_fname):
+                # drop truncated record, so that it does not hide records
+                # that will be appended
+                with open(self.journal_fname, 'r+b') as fp:
+                    fp.truncate(self.journal_size)
+        return cursors
+
+    def load_index(self):
+        """
+        Restore descriptor indexes from the index snapshot, then scan
+        directories that have been modified since it was taken. Returns False
+        if no usable snapshot was found.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        if not os.path.isfile(self.index_fname):
+            return False
+        try:
+            with open(self.index_fname, 'rb') as fp:
+                marker, index = store_serializer.load(fp)
+        except Exception:
+            log.warning("Could not load index snapshot %s, scanning all "
+                        "descriptors", self.index_fname)
+            return False
+        if marker.get('format') != INDEX_FORMAT or \
+                not self.check_index(index):
+            log.info("Index snapshot %s is outdated, scanning all "
+                     "descriptors", self.index_fname)
+            return False
+        self.restore_index(index)
+        self.refresh_index(marker)
+        # descriptors whose 'add' journal record has been lost
+        for domain, sel_uuids in self.selector_uuids.items():
+            for selector in sel_uuids:
+                if selector not in self.processed[domain]:
+                    self.processed[domain][selector] = set()
+                    self.journal_buffer.append(('add', domain, selector))
+        return True
+
+    def dump_index(self):
+        """
+        Returns descriptor indexes, as picklable objects.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        prefix_len = len(self.basepath)
+        return {
+            'version_cache': plain_dict(self.version_cache),
+            'edges': plain_dict(self.edges),
+            'uuids': plain_dict(self.uuids),
+            'labels': plain_dict(self.labels),
+            'selector_uuids': dict(self.selector_uuids),
+            'paths': [path[prefix_len:] for path in self.existing_paths],
+        }
+
+    def check_index(self, index):
+        """
+        Returns True if index, returned by dump_index(), can be completed by
+        calling refresh_index().
+        """
+        # descriptors are never removed: a missing directory means that
+        # storage contents have been modified externally
+        return all(os.path.isdir(self.basepath + relpath) for relpath in
+                   index['paths'])
+
+    def restore_index(self, index):
+        """
+        Load index, returned by dump_index(), into descriptor indexes.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        for name in ('version_cache', 'edges', 'uuids', 'labels',
+                     'selector_uuids'):
+            attr = getattr(self, name)
+            for domain, values in index[name].items():
+                attr[domain].update(values)
+        self.existing_paths.update(self.basepath + relpath for relpath in
+                                   index['paths'])
+
+    def refresh_index(self, marker):
+        """
+        Register descriptors that have been added since the index snapshot
+        described by marker was taken.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        prefix_len = len(self.basepath)
+        threshold = marker['time'] - INDEX_MTIME_SLACK
+        for path in list(self.existing_paths):
+            if os.stat(path).st_mtime >= threshold:
+                self.discover(path[prefix_len:], recurse=False)
+
+    def store_index(self):
+        """
+        Saves descriptor indexes to the index snapshot.
+        """
+        with self.indexlock:
+            with self.processedlock:
+                # directories modified from now on will be rescanned
+                marker = {'format': INDEX_FORMAT, 'time': time.time()}
+                index = self.dump_index()
+                self.index_dirty = False
+            with open(self.index_fname + '.tmp', 'wb') as fp:
+                store_serializer.dump((marker, index), fp)
+            os.rename(self.index_fname + '.tmp', self.index_fname)
+            self.index_time = marker['time']
 
     def register_meta(self, desc):
         """
         :param desc: Descriptor instance
         self.processedlock must be acquired prior to calling this function
         """
+        self.register_entry(meta_entry(desc))
 
-        domain = desc.domain
-        selector = desc.selector
-        self.version_cache[domain][selector.split('%')[0]][desc.version]\
-            = selector
-        for precursor in desc.precursors:
+    def register_entry(self, entry):
+        """
+        :param entry: descriptor metadata, as returned by meta_entry()
+        self.processedlock must be acquired prior to calling this function
+        """
+        domain, selector, version, precursors, uuid, label = entry
+        self.version_cache[domain][selector.split('%')[0]][version] = selector
+        for precursor in precursors:
             self.edges[domain][precursor].add(selector)
         if selector not in self.processed[domain]:
-            # If it has not been restored from processed.cfg
+            # If it has not been restored from processed state
             self.processed[domain][selector] = set()
-            self.unsavedprocessed = True
-        self.uuids[domain][desc.uuid].add(selector)
-        if not self.labels[domain][desc.uuid] or not desc.precursors:
+            self.journal_buffer.append(('add', domain, selector))
+        self.uuids[domain][uuid].add(selector)
+        self.selector_uuids[domain][selector] = uuid
+        if not self.labels[domain][uuid] or not precursors:
             # Heuristic for choosing uuid label : prefer label of a descriptor
             # that has no precursor
-            self.labels[domain][desc.uuid] = desc.label
+            self.labels[domain][uuid] = label
 
     def find(self, domain, selector_regex, limit=0, offset=0):
-        regex = re.compile(selector_regex)
-        sel_list = reversed(self.processed[domain].keys())
-        result = []
-
-        for k in sel_list:
-            if regex.match(k):
-                if offset > 0:
-                    offset -= 1
-                    continue
-                result.append(k)
-                if limit != 0 and len(result) >= limit:
-                    return result
-        return result
+        with self.processedlock:
+            if domain not in self.selector_index:
+                return []
+            return self.selector_index[domain].find_regex(selector_regex,
+                                                          limit, offset)
 
     def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
-        result = []
-        for selector in self.processed[domain].keys():
-            if selector.startswith(selector_prefix):
-                if offset > 0:
-                    offset -= 1
-                    continue
-                desc = self.get_descriptor(domain, selector)
-                result.append(desc)
-                if limit != 0 and len(result) >= limit:
-                    return result
-        return result
+        with self.processedlock:
+            if domain not in self.selector_index:
+                return []
+            selectors = self.selector_index[domain].find_prefix(
+                selector_prefix, limit, offset)
+        return [self.get_descriptor(domain, selector) for selector in
+                selectors]
 
     def find_by_uuid(self, domain, uuid):
         result = []
@@ -241,16 +656,92 @@ class DiskStorage(Storage):
             # open and run re.match() on every file matching *.value
             for name in os.listdir(path):
                 if os.path.isfile(path + name) and name.endswith('.value'):
-                    contents = Descriptor.unserialize_value(
-                        store_serializer,
-                        open(path + name, 'rb').read())
-                    if re.match(value_regex, contents):
+                    if self.match_value(path + name, value_regex):
                         selector = path[len(self.basepath)+len(domain)+1:] +\
                             name.split('.')[0]
                         desc = self.get_descriptor(domain, selector)
                         result.append(desc)
         return result
 
+    def match_value(self, fname, value_regex):
+        """
+        Returns True if the value stored in file fname matches value_regex,
+        using re.match(). Raw values are memory-mapped instead of being read.
+        """
+        with open(fname, 'rb') as fp:
+            raw = fp.read(1) == RAW_VALUE_TAG
+            if raw and os.fstat(fp.fileno()).st_size > 1:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return re.match(value_regex, buffer(mapped, 1)) is not None
+                finally:
+                    mapped.close()
+            fp.seek(0)
+            contents = decode_value(fp.read())
+        return re.match(value_regex, contents) is not None
+
+    def compression_for(self, selector):
+        """
+        Returns the name of the compression algorithm used for values of
+        selector that are larger than self.compress_min_size.
+        """
+        for prefix, algorithm in self.compress_prefixes:
+            if selector.startswith(prefix):
+                return algorithm
+        return self.compression
+
+    def compress(self, selector, chunks):
+        """
+        Returns a tuple of strings, containing chunks compressed according
+        to the compression policy for selector. Returns chunks if compression
+        is disabled, or if it does not save space.
+        """
+        algorithm = self.compression_for(selector)
+        size = sum(len(chunk) for chunk in chunks)
+        if algorithm == 'none' or size < self.compress_min_size:
+            return chunks
+        compressed = compress_chunks(chunks, algorithm)
+        if sum(len(chunk) for chunk in compressed) >= size:
+            return chunks
+        return compressed
+
+    def encode(self, descriptor):
+        """
+        Returns a tuple of strings, to be written consecutively in order to
+        store descriptor's value, compressed according to storage policy.
+        """
+        return self.compress(descriptor.selector, encode_value(descriptor))
+
+    def recompress(self, domain, selector_prefix='/'):
+        """
+        Rewrites stored values of descriptors whose selector starts with
+        selector_prefix, according to the current compression policy.
+        Values that are shared by several descriptors (see --dedup) are
+        skipped. Returns the number of rewritten values.
+        """
+        with self.processedlock:
+            if domain not in self.selector_index:
+                return 0
+            selectors = list(self.selector_index[domain].find_prefix(
+                selector_prefix))
+        rewritten = 0
+        for selector in selectors:
+            fname = self.pathFromSelector(domain, selector) + '.value'
+            if not os.path.isfile(fname) or os.stat(fname).st_nlink > 1:
+                continue
+            with open(fname, 'rb') as fp:
+                data = fp.read()
+            chunks = self.compress(selector, (decompress_value(data),))
+            if ''.join(chunks) == data:
+                continue
+            fd, tmpname = tempfile.mkstemp(dir=self.tmppath)
+            os.close(fd)
+            self.write_value(tmpname, chunks)
+            os.rename(tmpname, fname)
+            rewritten += 1
+        log.info("Recompressed %d values in domain %s", rewritten, domain)
+        return rewritten
+
     def list_uuids(self, domain):
         result = dict()
         for uuid in self.uuids[domain].keys():
@@ -287,11 +778,41 @@ class DiskStorage(Storage):
         if not selector:
             return None
 
+        desc = self.meta_cache.get((domain, selector))
+        if desc is None:
+            desc = self.load_descriptor(domain, selector)
+            if desc is None:
+                return None
+            self.meta_cache.put((domain, selector), desc)
+        return copy_meta(desc)
+
+    def cache_meta(self, descriptor):
+        """
+        Adds a metadata-only copy of descriptor to self.meta_cache.
+        """
+        desc = copy_meta(descriptor)
+        desc.bus = None
+        desc.value = None
+        self.meta_cache.put((desc.domain, desc.selector), desc)
+
+    def cache_stats(self):
+        """
+        Returns a dictionary describing usage of the metadata cache.
+        """
+        return {'meta': self.meta_cache.stats()}
+
+    def load_descriptor(self, domain, selector):
+        """
+        Reads descriptor metadata from disk, None if descriptor was not found.
+
+        :param selector: /selector/%hash
+        """
         fullpath = self.pathFromSelector(domain, selector) + ".meta"
         if not os.path.isfile(fullpath):
             return None
-        return Descriptor.unserialize(store_serializer,
-                                      open(fullpath, "rb").read())
+        return Descriptor.unserialize(meta_serializer,
+                                      open(fullpath, "rb").read(),
+                                      trusted=True)
 
     def get_value(self, domain, selector):
         """
@@ -304,14 +825,41 @@ class DiskStorage(Storage):
         fullpath = self.pathFromSelector(domain, selector) + ".value"
         if not os.path.isfile(fullpath):
             return None
-        try:
-            value = Descriptor.unserialize_value(store_serializer,
-                                                 open(fullpath, "rb").read())
-        except:
-            log.error("Could not unserialize value from file %s", fullpath)
-            raise
+        with open(fullpath, 'rb') as fp:
+            if fp.read(1) == RAW_VALUE_TAG:
+                return fp.read()
+            fp.seek(0)
+            try:
+                value = decode_value(fp.read())
+            except:
+                log.error("Could not unserialize value from file %s",
+                          fullpath)
+                raise
         return value
 
+    def get_value_range(self, domain, selector, offset, length):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+
+        fullpath = self.pathFromSelector(domain, selector) + ".value"
+        if not os.path.isfile(fullpath):
+            return None
+        with open(fullpath, 'rb') as fp:
+            tag = fp.read(1)
+            if tag == RAW_VALUE_TAG:
+                # only read requested bytes
+                fp.seek(1 + offset)
+                return fp.read(length)
+            if tag in DECOMPRESSORS:
+                # only decompress requested bytes, if value is raw
+                data = read_decompressed(fp, tag, 1 + offset + length)
+                if data[:1] == RAW_VALUE_TAG:
+                    return data[1 + offset:1 + offset + length]
+            fp.seek(0)
+            value = decode_value(fp.read())
+        return Descriptor.slice_value(value, offset, length)
+
     def get_children(self, domain, selector, recurse=True):
         result = set()
         with self.processedlock:
@@ -363,24 +911,119 @@ class DiskStorage(Storage):
             # File already exists
             return False
 
-        self.register_meta(descriptor)
-
-        serialized_meta = descriptor.serialize_meta(store_serializer)
-        serialized_value = descriptor.serialize_value(store_serializer)
+        serialized_meta = descriptor.serialize_meta(meta_serializer)
+        value_chunks = self.encode(descriptor)
 
         # Write meta
         with open(fname + '.meta', 'wb') as fp:
             fp.write(serialized_meta)
 
         # Write value
-        with open(fname + '.value', 'wb') as fp:
-            fp.write(serialized_value)
+        if self.dedup:
+            self.link_blob(fname + '.value', value_chunks)
+        else:
+            self.write_value(fname + '.value', value_chunks)
 
-        with self.processedlock:
-            self.processed[domain][selector] = set()
-            self.unsavedprocessed = True
+        self.publish(descriptor)
         return True
 
+    def add_spooled(self, descriptor, path):
+        """
+        Adopts the spooled value file by renaming it, unless stored values
+        have to be compressed or deduplicated.
+        """
+        selector = descriptor.selector
+        domain = descriptor.domain
+        if self.dedup or self.compression_for(selector) != 'none':
+            return Storage.add_spooled(self, descriptor, path)
+        fname = self.mkdirs(domain, selector)
+        if os.path.isfile(fname + '.meta'):
+            # File already exists
+            os.remove(path)
+            return False
+
+        # Write value first: metadata without value cannot be discovered
+        try:
+            os.rename(path, fname + '.value')
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # spool directory is on another file system
+            shutil.copyfile(path, fname + '.value')
+            os.remove(path)
+
+        with open(fname + '.meta', 'wb') as fp:
+            fp.write(descriptor.serialize_meta(meta_serializer))
+
+        self.publish(descriptor)
+        return True
+
+    def publish(self, descriptor):
+        """
+        Registers a descriptor whose files have been written, making it
+        visible to find() and get_descriptor(). Registration is journaled:
+        files are written first, so that journaled descriptors exist after a
+        crash.
+        """
+        with self.processedlock:
+            self.register_meta(descriptor)
+            self.selector_index[descriptor.domain].add(descriptor.selector)
+        self.cache_meta(descriptor)
+
+    def write_value(self, fname, value_chunks):
+        with open(fname, 'wb') as fp:
+            for chunk in value_chunks:
+                fp.write(chunk)
+
+    def link_blob(self, fname, value_chunks):
+        """
+        Stores a value in a blob, named after the SHA-256 of its contents and
+        shared by every descriptor having the same value, then hard links
+        fname to this blob. The number of descriptors referencing a blob is
+        its number of links minus one.
+        """
+        digest = hashlib.sha256()
+        for chunk in value_chunks:
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        blobdir = '%s/_blobs/%s' % (self.basepath, digest[:2])
+        blob = blobdir + '/' + digest
+        if not os.path.isfile(blob):
+            if not os.path.isdir(blobdir):
+                os.makedirs(blobdir)
+            fd, tmpname = tempfile.mkstemp(dir=blobdir)
+            os.close(fd)
+            self.write_value(tmpname, value_chunks)
+            os.rename(tmpname, blob)
+        try:
+            os.link(blob, fname)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            # file system limit on the number of links has been reached
+            self.write_value(fname, value_chunks)
+
+    def collect_blobs(self):
+        """
+        Removes blobs that are not referenced by any descriptor. Returns the
+        number of removed blobs.
+
+        Must not be called concurrently with add().
+        """
+        removed = 0
+        blobroot = self.basepath + '/_blobs/'
+        if not os.path.isdir(blobroot):
+            return 0
+        for subdir in os.listdir(blobroot):
+            for name in os.listdir(blobroot + subdir):
+                blob = blobroot + subdir + '/' + name
+                if os.stat(blob).st_nlink <= 1:
+                    os.remove(blob)
+                    removed += 1
+        if removed:
+            log.info("Removed %d unreferenced blobs", removed)
+        return removed
+
     def mark_processed(self, domain, selector, agent_name, config_txt):
         result = False
         key = (agent_name, config_txt)
@@ -389,7 +1032,13 @@ class DiskStorage(Storage):
             if key not in self.processed[domain][selector]:
                 result = True
                 self.processed[domain][selector].add(key)
-                self.unsavedprocessed = True
+                self.processed_counts[domain][key] += 1
+                self.processed_name_counts[domain][agent_name] += 1
+                index = self.selector_index[domain]
+                if index.cursors.get(key, 0) == index.position[selector]:
+                    index.advance_cursor(key, self.processed[domain])
+                self.journal_buffer.append(('processed', domain, selector,
+                                            agent_name, config_txt))
         # Remove from processable
         if selector in self.processable[domain]:
             if key in self.processable[domain][selector]:
@@ -422,12 +1071,23 @@ class DiskStorage(Storage):
         Returns a list of couples, (agent names, number of processed selectors)
         and the total amount of selectors in this domain.
         """
-        result = Counter()
         with self.processedlock:
-            processed = self.processed[domain]
-        for agentlist in processed.values():
-            result.update([name for name, _ in agentlist])
-        return result.items(), len(processed)
+            if domain not in self.processed:
+                return [], 0
+            return self.processed_name_counts[domain].items(), \
+                len(self.processed[domain])
+
+    def count_processed(self, domain, agent_name, config_txt):
+        with self.processedlock:
+            if domain not in self.processed_counts:
+                return 0
+            return self.processed_counts[domain][(agent_name, config_txt)]
+
+    def count_unprocessed_by_agent(self, agent_name, config_txt):
+        with self.processedlock:
+            return sum(len(self.processed[domain]) -
+                       self.count_processed(domain, agent_name, config_txt)
+                       for domain in self.version_cache.keys())
 
     def store_agent_state(self, agent_name, state):
         fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
@@ -444,39 +1104,102 @@ class DiskStorage(Storage):
             return fp.read()
 
     def store_state(self):
-        if self.unsavedprocessed:
+        """
+        Saves processed state and descriptor indexes.
+        """
+        self.checkpoint()
+        self.store_index()
+
+    def checkpoint(self):
+        """
+        Appends recent changes to the journal. Compacts the journal into a
+        new snapshot if it has grown too large. Saves descriptor indexes if
+        descriptors have been added and the index snapshot is older than
+        self.index_interval seconds, so that a crash does not force rescanning
+        every directory modified since the last clean stop.
+
+        self.processedlock is only held while fetching changes, so that
+        mark_processed is not blocked while writing to disk.
+        """
+        with self.checkpointlock:
             with self.processedlock:
-                with open(self.basepath + '/_processed.cfg', 'wb') as fp:
-                    store_serializer.dump(self.processed, fp)
-                self.unsavedprocessed = False
+                records = self.journal_buffer
+                self.journal_buffer = []
+                if any(record[0] == 'add' for record in records):
+                    self.index_dirty = True
+                compact = records and \
+                    self.journal_size >= self.journal_max_size
+                if compact:
+                    # cursors matching the state described by snapshot +
+                    # journal
+                    cursors = dict((domain, dict(index.cursors)) for
+                                   domain, index in
+                                   self.selector_index.items())
+            if records:
+                with open(self.journal_fname, 'ab') as fp:
+                    store_serializer.dump(records, fp)
+                    self.journal_size = fp.tell()
+            if compact:
+                self.compact_state(cursors)
+            elif self.index_dirty and \
+                    time.time() - self.index_time >= self.index_interval:
+                self.store_index()
+
+    def compact_state(self, cursors):
+        """
+        Merges the journal into a new snapshot. Does not use self.processed,
+        so that it can run without holding self.processedlock.
+
+        self.checkpointlock must be acquired prior to calling this function
+
+        :param cursors: unprocessed cursors that match the current snapshot
+            and journal
+        """
+        log.info("Compacting processed state journal (%d bytes)",
+                 self.journal_size)
+        old_journal = self.journal_fname + '.old'
+        os.rename(self.journal_fname, old_journal)
+        self.journal_size = 0
+        self.merge_journal(old_journal, cursors)
+        self.store_index()
+
+    def merge_journal(self, journal_fname, cursors=None):
+        """
+        Writes a new snapshot containing the current snapshot and changes
+        from journal_fname, then removes journal_fname.
+
+        :param cursors: unprocessed cursors that match the new snapshot. Saved
+            cursors are kept if None.
+        """
+        processed = defaultdict(OrderedDict)
+        if os.path.isfile(self.snapshot_fname):
+            with open(self.snapshot_fname, 'rb') as fp:
+                p = store_serializer.load(fp)
+                for dom in p.keys():
+                    processed[dom].update(p[dom])
+        replay_journal(processed, journal_fname)
+
+        # saved cursors remain valid if a crash happens after the snapshot has
+        # been written, but before cursors have been
+        with open(self.snapshot_fname + '.tmp', 'wb') as fp:
+            store_serializer.dump(processed, fp)
+        os.rename(self.snapshot_fname + '.tmp', self.snapshot_fname)
+        if cursors is not None:
+            with open(self.cursors_fname + '.tmp', 'wb') as fp:
+                store_serializer.dump(cursors, fp)
+            os.rename(self.cursors_fname + '.tmp', self.cursors_fname)
+        os.remove(journal_fname)
 
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         result = []
-        agent_nameconf = (agent_name, config_txt)
-        for domain in self.version_cache.keys():
-
-            # list all selectors
-            selectors = set()
-
-            # build temporary selector to uuids lookup table
-            # 1 selectors might belong in several uuids (or might in the
-            # future), add them all
-            sel_to_uuid = defaultdict(list)
-            for uuid, selset in self.uuids[domain].iteritems():
-                selectors.update(selset)
-                for sss in selset:
-                    sel_to_uuid[sss].append(uuid)
-            with self.processedlock:
-                for sel, name_confs in self.processed[domain].iteritems():
-                    if agent_nameconf not in name_confs:
-                        continue
-                    selectors.remove(sel)
-            # selectors now contains a list of selectors that have not been
-            # processed by this agent_nameconf
-
-            for sel in selectors:
-                for uuid in sel_to_uuid[sel]:
-                    result.append((domain, uuid, sel))
+        key = (agent_name, config_txt)
+        with self.processedlock:
+            for domain in self.version_cache.keys():
+                sel_uuids = self.selector_uuids[domain]
+                for sel in self.selector_index[domain].iter_unprocessed(
+                        key, self.processed[domain]):
+                    if sel in sel_uuids:
+                        result.append((domain, sel_uuids[sel], sel))
         return result
 
     @staticmethod
@@ -484,3 +1207,41 @@ class DiskStorage(Storage):
         subparser.add_argument(
             "--path", help="Disk storage path (defaults to /tmp/rebus)",
             default="/tmp/rebus")
+        subparser.add_argument(
+            "--journal-max-size", type=int, default=16*1024*1024,
+            help="Size in bytes above which the processed state journal is "
+            "compacted into a new snapshot")
+        subparser.add_argument(
+            "--index-interval", type=int, default=300,
+            help="Minimum number of seconds between two index snapshots "
+            "written while the storage is running")
+        subparser.add_argument(
+            "--discovery-workers", type=int, default=1,
+            help="Number of processes used to scan stored descriptors at "
+            "startup, when no index snapshot is available. Use 0 for the "
+            "number of CPUs. Defaults to 1 (no additional process)")
+        subparser.add_argument(
+            "--meta-cache-size", type=int, default=10000,
+            help="Number of descriptor metadata kept in memory to speed up "
+            "lookups. Disabled if 0")
+        subparser.add_argument(
+            "--dedup", action='store_true',
+            help="Store identical values only once, using hard links to "
+            "shared files (diskstorage only)")
+        subparser.add_argument(
+            "--compress", choices=('none',) + tuple(COMPRESSORS),
+            default='none',
+            help="Compression algorithm used for stored values")
+        subparser.add_argument(
+            "--compress-min-size", type=int, default=4096,
+            help="Size in bytes under which values are not compressed")
+        subparser.add_argument(
+            "--compress-prefix", type=compress_prefix, action='append',
+            default=[], metavar='PREFIX=ALGORITHM',
+            help="Compression algorithm used for values of selectors starting "
+            "with PREFIX, overriding --compress. May be repeated, ex. "
+            "--compress-prefix /text/=bz2 --compress-prefix /binary/=none")
+        subparser.add_argument(
+            "--recompress", action='store_true',
+            help="Rewrite stored values at startup, according to current "
+            "compression settings")
@@ -1,4 +1,5 @@
 from rebus.storage import Storage
+from rebus.tools.selector_index import SelectorIndex
 import re
 from collections import defaultdict
 from collections import OrderedDict
@@ -33,65 +34,65 @@ class RAMStorage(Storage):
         #: {RAM,Disk}storage implementations.
         self.processed = defaultdict(OrderedDict)
 
+        #: self.processed_counts['domain'][(agent name, configuration text)]
+        #: is the number of selectors that have been processed by this agent
+        self.processed_counts = defaultdict(Counter)
+
+        #: self.processed_name_counts['domain']['agent name'] is the number
+        #: of selectors that have been processed by this agent, summed over
+        #: all its configurations
+        self.processed_name_counts = defaultdict(Counter)
+
+        #: self.selector_index['domain'] indexes known selectors, allowing
+        #: fast prefix lookups
+        self.selector_index = defaultdict(SelectorIndex)
+
         #: self.processable['domain']['/selector/%hash'] is a set of (agent
         #: name, configuration text) that are running in interactive mode, and
         #: are able to process this descriptor.
         self.processable = defaultdict(lambda: defaultdict(set))
 
+        #: self.uuids['domain']['uuid'] is the set of selectors that belong to
+        #: descriptors having this uuid
+        self.uuids = defaultdict(lambda: defaultdict(set))
+
+        #: self.labels['domain']['uuid'] is the label of descriptors having
+        #: this UUID
+        self.labels = defaultdict(dict)
+
         #: internal state of agents
         self.internal_state = {}
 
     def find(self, domain, selector_regex, limit=0, offset=0):
-        regex = re.compile(selector_regex)
-        sel_list = reversed(self.processed[domain].keys())
-        result = []
-
-        for k in sel_list:
-            if regex.match(k):
-                if offset > 0:
-                    offset -= 1
-                    continue
-                result.append(k)
-                if limit != 0 and len(result) >= limit:
-                    return result
-        return result
+        if domain not in self.selector_index:
+            return []
+        return self.selector_index[domain].find_regex(selector_regex, limit,
+                                                      offset)
 
     def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
-        result = []
-        for selector in self.processed[domain].keys():
-            if selector.startswith(selector_prefix):
-                if offset > 0:
-                    offset -= 1
-                    continue
-                desc = self.dstore[domain][selector]
-                result.append(desc)
-                if limit != 0 and len(result) >= limit:
-                    return result
-        return result
+        if domain not in self.selector_index:
+            return []
+        selectors = self.selector_index[domain].find_prefix(selector_prefix,
+                                                            limit, offset)
+        return [self.load_descriptor(domain, selector)
+                for selector in selectors]
 
     def find_by_uuid(self, domain, uuid):
-        result = []
-        for _, desc in self.dstore[domain].iteritems():
-            if desc.uuid == uuid:
-                result.append(desc)
-        return result
+        if uuid not in self.uuids[domain]:
+            return []
+        return [self.load_descriptor(domain, selector) for selector in
+                self.uuids[domain][uuid]]
 
     def find_by_value(self, domain, selector_prefix, value_regex):
         result = []
-        for _, desc in self.dstore[domain].iteritems():
-            if desc.selector.startswith(selector_prefix) and \
-                    re.match(value_regex, desc.value):
-                result.append(desc)
+        for selector in self.dstore[domain].keys():
+            if selector.startswith(selector_prefix) and \
+                    re.match(value_regex, self.get_value(domain, selector)):
+                result.append(self.load_descriptor(domain, selector))
         return result
 
     def list_uuids(self, domain):
-        result = dict()
-        for desc in self.dstore[domain].values():
-            # Heuristic for choosing uuid label : prefer label of a descriptor
-            # that has no precursor
-            if desc.uuid not in result or not desc.precursors:
-                result[desc.uuid] = desc.label
-        return result
+        return dict(self.labels[domain])
 
     def _version_lookup(self, domain, selector):
         """
@@ -121,6 +122,12 @@ class RAMStorage(Storage):
         # Check whether domain & selector are known
         if domain not in self.dstore or selector not in self.dstore[domain]:
             return None
+        return self.load_descriptor(domain, selector)
+
+    def load_descriptor(self, domain, selector):
+        """
+        Returns the descriptor stored for this hash selector.
+        """
         return self.dstore[domain][selector]
 
     def get_value(self, domain, selector):
@@ -136,7 +143,7 @@ class RAMStorage(Storage):
         if selector not in self.dstore[domain]:
             return result
         for child in self.edges[domain][selector]:
-            result.add(self.dstore[domain][child])
+            result.add(self.load_descriptor(domain, child))
             if recurse:
                 result |= self.get_children(child, domain, recurse)
         return result
@@ -152,6 +159,13 @@ class RAMStorage(Storage):
         for precursor in descriptor.precursors:
             self.edges[domain][precursor].add(selector)
         self.processed[domain][selector] = set()
+        self.selector_index[domain].add(selector)
+        self.uuids[domain][descriptor.uuid].add(selector)
+        if descriptor.uuid not in self.labels[domain] or \
+                not descriptor.precursors:
+            # Heuristic for choosing uuid label : prefer label of a descriptor
+            # that has no precursor
+            self.labels[domain][descriptor.uuid] = descriptor.label
         return True
 
     def mark_processed(self, domain, selector, agent_name, config_txt):
@@ -161,6 +175,11 @@ class RAMStorage(Storage):
         if key not in self.processed[domain][selector]:
             result = True
             self.processed[domain][selector].add(key)
+            self.processed_counts[domain][key] += 1
+            self.processed_name_counts[domain][agent_name] += 1
+            index = self.selector_index[domain]
+            if index.cursors.get(key, 0) == index.position[selector]:
+                index.advance_cursor(key, self.processed[domain])
         # Remove from processable
         if selector in self.processable[domain]:
             if key in self.processable[domain][selector]:
@@ -190,23 +209,28 @@ class RAMStorage(Storage):
         Returns a list of couples, (agent names, number of processed selectors)
         and the total amount of selectors in this domain.
         """
-        result = Counter()
-        processed = self.processed[domain]
-        for agentlist in processed.values():
-            result.update([name for name, _ in agentlist])
-        return result.items(), len(processed)
+        if domain not in self.processed:
+            return [], 0
+        return self.processed_name_counts[domain].items(), \
+            len(self.processed[domain])
+
+    def count_processed(self, domain, agent_name, config_txt):
+        if domain not in self.processed_counts:
+            return 0
+        return self.processed_counts[domain][(agent_name, config_txt)]
+
+    def count_unprocessed_by_agent(self, agent_name, config_txt):
+        return sum(len(self.processed[domain]) -
+                   self.count_processed(domain, agent_name, config_txt)
+                   for domain in self.dstore.keys())
 
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         result = []
+        key = (agent_name, config_txt)
         for domain in self.dstore.keys():
-            selectors = set(self.dstore[domain].keys())
-            processed_selectors = set([sel for sel, name_confs in
-                                       self.processed[domain].items() if
-                                       (agent_name, config_txt) in
-                                       name_confs])
-            unprocessed_sels = selectors - processed_selectors
-            result.extend([(domain, self.dstore[domain][sel].uuid, sel)
-                           for sel in unprocessed_sels])
+            for sel in self.selector_index[domain].iter_unprocessed(
+                    key, self.processed[domain]):
+                result.append((domain, self.dstore[domain][sel].uuid, sel))
         return result
 
     def store_agent_state(self, agent_name, state):
@@ -0,0 +1,360 @@
+import logging
+import os
+import re
+import struct
+import threading
+from collections import defaultdict, OrderedDict
+from rebus.storage import Storage
+from rebus.descriptor import Descriptor
+from rebus.storage_backends.diskstorage import DiskStorage
+from rebus.tools.values import RAW_VALUE_TAG, decode_value
+from rebus.tools.serializer import compactmeta as meta_serializer
+log = logging.getLogger("rebus.storage.segmentstorage")
+
+#: Each record starts with a magic string, followed by the length of
+#: serialized metadata, then the length of serialized value
+RECORD_HEADER = struct.Struct('<4sIQ')
+RECORD_MAGIC = 'RBSG'
+
+
+@Storage.register
+class SegmentStorage(DiskStorage):
+    """
+    Disk storage of descriptor objects, packed into large append-only segment
+    files instead of one .meta and one .value file per descriptor.
+
+    Segment files are named segments/00000000.seg, segments/00000001.seg...
+    The offset of each descriptor is indexed in memory; this index is rebuilt
+    by scanning segments at startup.
+    Processed state and agents' internal state are stored as in DiskStorage.
+    """
+
+    _name_ = "segmentstorage"
+
+    def __init__(self, options):
+        #: A new segment is started once the current one has grown larger
+        #: than self.segment_size bytes
+        self.segment_size = options.segment_size
+
+        #: self.locations['domain']['/selector/%hash'] is a tuple (segment
+        #: number, offset of serialized metadata, metadata length, value
+        #: length). Serialized value immediately follows metadata.
+        #: access to self.locations must be protected using self.segmentlock
+        self.locations = defaultdict(dict)
+
+        #: self.readers[segment number] is a file object opened for reading,
+        #: least recently used first. At most self.max_readers are kept open.
+        #: access to self.readers must be protected using self.segmentlock
+        self.readers = OrderedDict()
+        self.max_readers = options.max_open_segments
+
+        #: file object of the segment descriptors are appended to, and its
+        #: number
+        self.writer = None
+        self.writer_segment = 0
+
+        #: (segment number, offset): records that precede this position
+        #: have been indexed
+        self.scanned = (0, 0)
+
+        #: protects access to segment files and self.locations
+        self.segmentlock = threading.Lock()
+
+        DiskStorage.__init__(self, options)
+        if self.dedup:
+            log.warning("Value deduplication is not supported by this "
+                        "backend, ignoring --dedup")
+            self.dedup = False
+
+    def segment_path(self, segment):
+        return '%s/segments/%08d.seg' % (self.basepath, segment)
+
+    def discover_all(self):
+        """
+        Index descriptors stored in segment files.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        self.scan_segments()
+
+    def scan_segments(self):
+        """
+        Index descriptors stored in segment files, starting from
+        self.scanned. Opens the last segment for appending.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        segdir = self.basepath + '/segments'
+        if not os.path.isdir(segdir):
+            os.makedirs(segdir)
+        first, offset = self.scanned
+        segments = sorted(int(name[:-4]) for name in os.listdir(segdir)
+                          if re.match(r'^[0-9]+\.seg$', name))
+        segments = [segment for segment in segments if segment >= first]
+        for segment in segments:
+            end = self.scan_segment(segment,
+                                    offset if segment == first else 0)
+            fname = self.segment_path(segment)
+            if end < os.path.getsize(fname):
+                if segment != segments[-1]:
+                    raise Exception('Segment %s is corrupted at offset %d' %
+                                    (fname, end))
+                # storage was killed while appending the last record
+                log.warning("Dropping truncated record at the end of "
+                            "segment %s", fname)
+                with open(fname, 'r+b') as fp:
+                    fp.truncate(end)
+        if segments:
+            self.writer_segment = segments[-1]
+        self.writer = open(self.segment_path(self.writer_segment), 'ab')
+
+    def scan_segment(self, segment, start=0):
+        """
+        Registers metadata of descriptors stored in segment, from offset
+        start. Returns the offset of the end of the last complete record.
+
+        self.processedlock must be acquired prior to calling this function
+        """
+        fname = self.segment_path(segment)
+        size = os.path.getsize(fname)
+        with open(fname, 'rb') as fp:
+            fp.seek(start)
+            while True:
+                pos = fp.tell()
+                header = fp.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return pos
+                magic, meta_len, value_len = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    return pos
+                meta_offset = pos + RECORD_HEADER.size
+                if meta_offset + meta_len + value_len > size:
+                    return pos
+                try:
+                    desc = Descriptor.unserialize(meta_serializer,
+                                                  fp.read(meta_len),
+                                                  trusted=True)
+                except Exception:
+                    log.error("Could not unserialize metadata from segment %s"
+                              " at offset %d", fname, pos)
+                    raise
+                fp.seek(value_len, os.SEEK_CUR)
+                self.locations[desc.domain][desc.selector] = \
+                    (segment, meta_offset, meta_len, value_len)
+                self.register_meta(desc)
+
+    def store_index(self):
+        # records must not be appended while indexes are being dumped
+        with self.segmentlock:
+            DiskStorage.store_index(self)
+
+    def dump_index(self):
+        """
+        self.processedlock and self.segmentlock must be acquired prior to
+        calling this function
+        """
+        index = DiskStorage.dump_index(self)
+        index['locations'] = dict(self.locations)
+        index['scanned'] = (self.writer_segment, self.writer.tell())
+        return index
+
+    def check_index(self, index):
+        segment, offset = index['scanned']
+        fname = self.segment_path(segment)
+        return os.path.isfile(fname) and os.path.getsize(fname) >= offset
+
+    def restore_index(self, index):
+        DiskStorage.restore_index(self, index)
+        for domain, locations in index['locations'].items():
+            self.locations[domain].update(locations)
+        self.scanned = index['scanned']
+
+    def refresh_index(self, marker):
+        self.scan_segments()
+
+    def _read(self, segment, offset, length):
+        """
+        self.segmentlock must be acquired prior to calling this function
+        """
+        fp = self.readers.pop(segment, None)
+        if fp is None:
+            fp = open(self.segment_path(segment), 'rb')
+            while self.readers and len(self.readers) >= self.max_readers:
+                self.readers.popitem(last=False)[1].close()
+        # move to most recently used position
+        self.readers[segment] = fp
+        fp.seek(offset)
+        return fp.read(length)
+
+    def close_readers(self):
+        """
+        self.segmentlock must be acquired prior to calling this function
+        """
+        while self.readers:
+            self.readers.popitem()[1].close()
+
+    def store_state(self):
+        DiskStorage.store_state(self)
+        with self.segmentlock:
+            self.close_readers()
+
+    def load_descriptor(self, domain, selector):
+        with self.segmentlock:
+            location = self.locations[domain].get(selector)
+            if location is None:
+                return None
+            segment, meta_offset, meta_len, _ = location
+            serialized_meta = self._read(segment, meta_offset, meta_len)
+        return Descriptor.unserialize(meta_serializer, serialized_meta,
+                                      trusted=True)
+
+    def get_value(self, domain, selector):
+        """
+        Returns descriptor value, None if descriptor was not found.
+        """
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+
+        with self.segmentlock:
+            location = self.locations[domain].get(selector)
+            if location is None:
+                return None
+            segment, meta_offset, meta_len, value_len = location
+            serialized_value = self._read(segment, meta_offset + meta_len,
+                                          value_len)
+        try:
+            value = decode_value(serialized_value)
+        except Exception:
+            log.error("Could not unserialize value of %s from segment %d",
+                      selector, segment)
+            raise
+        return value
+
+    def get_values(self, domain, selectors):
+        """
+        Reads values in segment order, holding self.segmentlock once.
+        """
+        selectors = [self._version_lookup(domain, s) for s in selectors]
+        serialized = {}
+        with self.segmentlock:
+            locations = [s and self.locations[domain].get(s)
+                         for s in selectors]
+            for location in sorted(set(l for l in locations if l)):
+                segment, meta_offset, meta_len, value_len = location
+                serialized[location] = self._read(
+                    segment, meta_offset + meta_len, value_len)
+        return [decode_value(serialized[location]) if location else None
+                for location in locations]
+
+    def get_value_range(self, domain, selector, offset, length):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+
+        with self.segmentlock:
+            location = self.locations[domain].get(selector)
+            if location is None:
+                return None
+            segment, meta_offset, meta_len, value_len = location
+            value_offset = meta_offset + meta_len
+            if self._read(segment, value_offset, 1) == RAW_VALUE_TAG:
+                # only read requested bytes
+                offset = min(offset, value_len - 1)
+                length = min(length, value_len - 1 - offset)
+                return self._read(segment, value_offset + 1 + offset, length)
+            serialized_value = self._read(segment, value_offset, value_len)
+        value = decode_value(serialized_value)
+        return Descriptor.slice_value(value, offset, length)
+
+    def find_by_value(self, domain, selector_prefix, value_regex):
+        result = []
+        with self.processedlock:
+            if domain not in self.selector_index:
+                return []
+            selectors = self.selector_index[domain].find_prefix(
+                selector_prefix)
+        for selector in selectors:
+            contents = self.get_value(domain, selector)
+            if contents is not None and re.match(value_regex, contents):
+                result.append(self.get_descriptor(domain, selector))
+        return result
+
+    def recompress(self, domain, selector_prefix='/'):
+        log.warning("Segments are append-only, values cannot be "
+                    "recompressed")
+        return 0
+
+    def add(self, descriptor):
+        """
+        serialized_descriptor is not used by this backend.
+        """
+        if descriptor.selector in self.locations[descriptor.domain]:
+            return False
+        value_chunks = self.encode(descriptor)
+        value_len = sum(len(chunk) for chunk in value_chunks)
+        return self.append(descriptor, value_chunks, value_len)
+
+    def add_spooled(self, descriptor, path):
+        """
+        Copies the spooled value file to the current segment, without reading
+        it whole, unless stored values have to be compressed.
+        """
+        if self.compression_for(descriptor.selector) != 'none':
+            return Storage.add_spooled(self, descriptor, path)
+        with open(path, 'rb') as fp:
+            value_chunks = iter(lambda: fp.read(1024*1024), '')
+            added = self.append(descriptor, value_chunks,
+                                os.fstat(fp.fileno()).st_size)
+        os.remove(path)
+        return added
+
+    def append(self, descriptor, value_chunks, value_len):
+        """
+        Appends a record containing descriptor's metadata, followed by
+        value_len bytes of stored value, read from iterable value_chunks.
+        Returns False if descriptor was already present.
+        """
+        selector = descriptor.selector
+        domain = descriptor.domain
+        serialized_meta = descriptor.serialize_meta(meta_serializer)
+
+        with self.segmentlock:
+            if selector in self.locations[domain]:
+                # added concurrently
+                return False
+            if self.writer.tell() >= self.segment_size:
+                self.writer.close()
+                self.writer_segment += 1
+                self.writer = open(self.segment_path(self.writer_segment),
+                                   'ab')
+            pos = self.writer.tell()
+            self.writer.write(RECORD_HEADER.pack(RECORD_MAGIC,
+                                                 len(serialized_meta),
+                                                 value_len))
+            self.writer.write(serialized_meta)
+            for chunk in value_chunks:
+                self.writer.write(chunk)
+            # make record readable through self.readers
+            self.writer.flush()
+            self.locations[domain][selector] = \
+                (self.writer_segment, pos + RECORD_HEADER.size,
+                 len(serialized_meta), value_len)
+
+            # register while holding self.segmentlock, so that index
+            # snapshots never contain partially registered descriptors
+            with self.processedlock:
+                self.register_meta(descriptor)
+                self.selector_index[domain].add(selector)
+        self.cache_meta(descriptor)
+        return True
+
+    @staticmethod
+    def add_arguments(subparser):
+        DiskStorage.add_arguments(subparser)
+        subparser.add_argument(
+            "--segment-size", type=int, default=256*1024*1024,
+            help="Size in bytes above which a new segment file is started")
+        subparser.add_argument(
+            "--max-open-segments", type=int, default=32,
+            help="Maximum number of segment files kept open for reading")
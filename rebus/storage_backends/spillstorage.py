@@ -0,0 +1,227 @@
+import atexit
+import copy
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from rebus.storage import Storage
+from rebus.descriptor import Descriptor
+from rebus.storage_backends.ramstorage import RAMStorage
+from rebus.tools.values import RAW_VALUE_TAG, decode_value
+from rebus.tools.serializer import picklev2 as store_serializer
+log = logging.getLogger("rebus.storage.spillstorage")
+
+
+class SpilledValueLoader(object):
+    """
+    Set as the bus of descriptors returned by SpillStorage, so that their value
+    is fetched from storage when it is first accessed.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_value(self, agent_id, desc_domain, selector):
+        return self.storage.get_value(desc_domain, selector)
+
+    def get_values(self, agent_id, desc_domain, selectors):
+        return self.storage.get_values(desc_domain, selectors)
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        return self.storage.get_value_range(desc_domain, selector, offset,
+                                            length)
+
+
+@Storage.register
+class SpillStorage(RAMStorage):
+    """
+    RAM storage of descriptor metadata and indexes. Descriptor values are kept
+    in RAM within a memory budget: least recently used values are evicted to a
+    spill directory, and loaded back when they are needed.
+    """
+
+    _name_ = "spillstorage"
+
+    def __init__(self, options=None):
+        RAMStorage.__init__(self, options)
+
+        #: Max size in bytes of values kept in RAM
+        self.memory_budget = options.memory_budget
+
+        #: self.values[('domain', '/selector/%hash')] is a tuple (value, size
+        #: in bytes), least recently used first
+        #: access to self.values must be protected using self.valueslock
+        self.values = OrderedDict()
+
+        #: Sum of sizes of values in self.values
+        self.values_size = 0
+
+        #: set of ('domain', '/selector/%hash') whose value has been written to
+        #: the spill directory. Values are never modified, so they are only
+        #: written once.
+        #: access to self.spilled must be protected using self.valueslock
+        self.spilled = set()
+
+        self.valueslock = threading.Lock()
+
+        #: Spilled values are only useful while this storage is running
+        self.spill_dir = tempfile.mkdtemp(prefix='rebus-spill-',
+                                          dir=options.spill_dir)
+        atexit.register(shutil.rmtree, self.spill_dir, True)
+
+        self.loader = SpilledValueLoader(self)
+
+    def spill_path(self, domain, selector):
+        digest = hashlib.sha1(domain + selector).hexdigest()
+        return os.path.join(self.spill_dir, digest[:2], digest)
+
+    def load_descriptor(self, domain, selector):
+        # dstore only contains metadata
+        desc = copy.copy(self.dstore[domain][selector])
+        desc.bus = self.loader
+        return desc
+
+    def keep_value(self, domain, selector, value, size):
+        """
+        Adds value to RAM, then evicts least recently used values until the
+        memory budget is respected.
+        """
+        with self.valueslock:
+            previous = self.values.pop((domain, selector), None)
+            if previous is not None:
+                # kept concurrently
+                self.values_size -= previous[1]
+            self.values[(domain, selector)] = (value, size)
+            self.values_size += size
+            while self.values_size > self.memory_budget:
+                (dom, sel), (val, sz) = self.values.popitem(last=False)
+                self.values_size -= sz
+                if (dom, sel) not in self.spilled:
+                    self.spill(dom, sel, val)
+
+    def spill(self, domain, selector, value):
+        """
+        Writes value to the spill directory.
+
+        self.valueslock must be acquired prior to calling this function
+        """
+        fname = self.spill_path(domain, selector)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'wb') as fp:
+            if type(value) is str:
+                fp.write(RAW_VALUE_TAG)
+                fp.write(value)
+            else:
+                fp.write(store_serializer.dumps(value))
+        self.spilled.add((domain, selector))
+
+    def get_value(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+
+        # Check whether domain & selector are known
+        if domain not in self.dstore or selector not in self.dstore[domain]:
+            return None
+        key = (domain, selector)
+        with self.valueslock:
+            entry = self.values.pop(key, None)
+            if entry is not None:
+                # mark as most recently used
+                self.values[key] = entry
+                return entry[0]
+        with open(self.spill_path(domain, selector), 'rb') as fp:
+            data = fp.read()
+        value = decode_value(data)
+        if data[:1] == RAW_VALUE_TAG:
+            size = len(data) - 1
+        else:
+            size = len(data)
+        self.keep_value(domain, selector, value, size)
+        return value
+
+    def get_value_range(self, domain, selector, offset, length):
+        selector = self._version_lookup(domain, selector)
+
+        if domain not in self.dstore or selector not in self.dstore[domain]:
+            return None
+        with self.valueslock:
+            entry = self.values.get((domain, selector))
+        if entry is not None:
+            return Descriptor.slice_value(entry[0], offset, length)
+        # do not load the whole value back into RAM
+        with open(self.spill_path(domain, selector), 'rb') as fp:
+            if fp.read(1) == RAW_VALUE_TAG:
+                fp.seek(1 + offset)
+                return fp.read(length)
+            fp.seek(0)
+            value = decode_value(fp.read())
+        return Descriptor.slice_value(value, offset, length)
+
+    def add(self, descriptor):
+        if descriptor.selector in self.dstore[descriptor.domain]:
+            return False
+        value = descriptor.value
+        if type(value) in (str, unicode):
+            size = len(value)
+        else:
+            size = len(store_serializer.dumps(value))
+        # value must be available before metadata is published: get_value
+        # may be called as soon as the descriptor is in self.dstore
+        self.keep_value(descriptor.domain, descriptor.selector, value, size)
+        meta = copy.copy(descriptor)
+        meta.bus = None
+        meta.value = None
+        return RAMStorage.add(self, meta)
+
+    def add_spooled(self, descriptor, path):
+        """
+        Adopts the spooled value file as a spilled value, without loading it
+        into RAM.
+        """
+        domain = descriptor.domain
+        selector = descriptor.selector
+        if selector in self.dstore[domain]:
+            os.remove(path)
+            return False
+        fname = self.spill_path(domain, selector)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        try:
+            os.rename(path, fname)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # spool directory is on another file system
+            shutil.copyfile(path, fname)
+            os.remove(path)
+        with self.valueslock:
+            self.spilled.add((domain, selector))
+        meta = copy.copy(descriptor)
+        meta.bus = None
+        meta.value = None
+        return RAMStorage.add(self, meta)
+
+    def cache_stats(self):
+        """
+        Returns a dictionary describing usage of the memory budget.
+        """
+        with self.valueslock:
+            return {'values': {'size': self.values_size,
+                               'budget': self.memory_budget,
+                               'count': len(self.values),
+                               'spilled': len(self.spilled)}}
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--memory-budget", type=int, default=256*1024*1024,
+            help="Size in bytes of descriptor values kept in RAM. Least "
+            "recently used values are written to the spill directory")
+        subparser.add_argument(
+            "--spill-dir",
+            help="Directory in which a temporary spill directory is created "
+            "(defaults to the system's temporary directory)")
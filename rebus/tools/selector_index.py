@@ -0,0 +1,234 @@
+"""
+In-memory selector index, shared by storage backends.
+
+Selectors are kept both in insertion order and in a sorted list, so that
+prefix lookups can be answered using bisection, without scanning every known
+selector.
+"""
+import re
+from bisect import bisect_left, insort
+from rebus.tools.lru import LRUCache
+
+#: regex metacharacters that end a literal prefix
+_REGEX_SPECIAL = '.^$*+?{}[]|()'
+
+#: maps selector regexes to (compiled regex, literal prefix)
+_regex_cache = LRUCache(256)
+
+
+def has_toplevel_alternation(pattern):
+    """
+    Returns True if pattern contains a '|' that is neither escaped, nor part of
+    a character class, nor enclosed in a group.
+    """
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1
+        elif c == '[':
+            # skip character class. ']' is literal if first in class
+            i += 1
+            if pattern[i:i+1] == '^':
+                i += 1
+            if pattern[i:i+1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                if pattern[i] == '\\':
+                    i += 1
+                i += 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def regex_literal_prefix(pattern):
+    """
+    Returns the longest literal string that any string matched by
+    re.match(pattern) must start with. Returns '' if no such prefix could be
+    determined.
+
+    Example: '/link/.*' returns '/link/'
+    """
+    if '(?' in pattern or has_toplevel_alternation(pattern):
+        # inline flags such as (?i) may appear anywhere and change the meaning
+        # of the whole pattern
+        return ''
+    prefix = []
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i+1:i+2]
+            if not escaped or escaped.isalnum():
+                # character class (\d, \w...), anchor or backreference
+                break
+            literal, step = escaped, 2
+        elif c in _REGEX_SPECIAL:
+            break
+        else:
+            literal, step = c, 1
+        following = pattern[i+step:i+step+1]
+        if following and following in '*?{':
+            # literal may be absent from matching strings
+            break
+        prefix.append(literal)
+        if following == '+':
+            break
+        i += step
+    return ''.join(prefix)
+
+
+def compile_selector_regex(selector_regex):
+    """
+    Returns (compiled regex, literal prefix) for selector_regex. Results are
+    cached.
+    """
+    cached = _regex_cache.get(selector_regex)
+    if cached is None:
+        cached = (re.compile(selector_regex),
+                  regex_literal_prefix(selector_regex))
+        _regex_cache.put(selector_regex, cached)
+    return cached
+
+
+class SelectorIndex(object):
+    """
+    Index of the selectors of a single domain.
+    """
+
+    def __init__(self):
+        #: selectors, in insertion order
+        self.selectors = []
+        #: self.position['/selector/%hash'] is the insertion rank of this
+        #: selector
+        self.position = {}
+        #: selectors, sorted
+        self.sorted_selectors = []
+        #: self.cursors[(agent name, configuration text)] is the insertion rank
+        #: of the oldest selector that may not have been processed by this
+        #: agent: every older selector has been processed.
+        self.cursors = {}
+
+    def __len__(self):
+        return len(self.selectors)
+
+    def __contains__(self, selector):
+        return selector in self.position
+
+    def add(self, selector):
+        """
+        Add selector to index. Returns False if it was already present.
+        """
+        if selector in self.position:
+            return False
+        self.position[selector] = len(self.selectors)
+        self.selectors.append(selector)
+        insort(self.sorted_selectors, selector)
+        return True
+
+    def prefix_range(self, selector_prefix):
+        """
+        Returns (start, end) indices of selectors starting with
+        selector_prefix in self.sorted_selectors.
+        """
+        sels = self.sorted_selectors
+        start = bisect_left(sels, selector_prefix)
+        end = start
+        # Binary search for the first selector that does not start with
+        # selector_prefix
+        hi = len(sels)
+        while end < hi:
+            mid = (end + hi) // 2
+            if sels[mid].startswith(selector_prefix):
+                end = mid + 1
+            else:
+                hi = mid
+        return start, end
+
+    def _ordered_range(self, start, end, reverse=False):
+        """
+        Returns selectors self.sorted_selectors[start:end], sorted by insertion
+        order (oldest first, or newest first if reverse is True).
+        """
+        if end - start == len(self.selectors):
+            # every selector is in range - no need to sort
+            if reverse:
+                return reversed(self.selectors)
+            return self.selectors
+        return sorted(self.sorted_selectors[start:end],
+                      key=self.position.__getitem__, reverse=reverse)
+
+    def find_prefix(self, selector_prefix, limit=0, offset=0):
+        """
+        Returns the list of selectors starting with selector_prefix, from
+        oldest to newest.
+
+        :param limit: int, max number of selectors to return. Unlimited if 0.
+        :param offset: int, number of matching selectors to skip.
+        """
+        start, end = self.prefix_range(selector_prefix)
+        matches = self._ordered_range(start, end)
+        if limit:
+            return matches[offset:offset+limit]
+        return matches[offset:]
+
+    def find_regex(self, selector_regex, limit=0, offset=0):
+        """
+        Returns the list of selectors matching selector_regex (using
+        re.match), from newest to oldest.
+        Only selectors starting with the regex's literal prefix are matched
+        against the regex.
+
+        :param limit: int, max number of selectors to return. Unlimited if 0.
+        :param offset: int, number of matching selectors to skip.
+        """
+        regex, prefix = compile_selector_regex(selector_regex)
+        start, end = self.prefix_range(prefix)
+        result = []
+        for selector in self._ordered_range(start, end, reverse=True):
+            if regex.match(selector):
+                if offset > 0:
+                    offset -= 1
+                    continue
+                result.append(selector)
+                if limit != 0 and len(result) >= limit:
+                    return result
+        return result
+
+    def advance_cursor(self, key, processed):
+        """
+        Moves key's cursor past selectors that have been processed by key.
+        Returns the new cursor value.
+
+        :param key: (agent name, configuration text)
+        :param processed: maps selectors to the set of (agent name,
+            configuration text) that have processed them
+        """
+        pos = self.cursors.get(key, 0)
+        selectors = self.selectors
+        while pos < len(selectors) and key in processed[selectors[pos]]:
+            pos += 1
+        if pos:
+            self.cursors[key] = pos
+        return pos
+
+    def iter_unprocessed(self, key, processed):
+        """
+        Yields selectors that have not been processed by key, from oldest to
+        newest. Only selectors that follow key's cursor are considered.
+
+        :param key: (agent name, configuration text)
+        :param processed: maps selectors to the set of (agent name,
+            configuration text) that have processed them
+        """
+        pos = self.advance_cursor(key, processed)
+        for selector in self.selectors[pos:]:
+            if key not in processed[selector]:
+                yield selector
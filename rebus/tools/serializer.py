@@ -1,6 +1,8 @@
 import logging
 import logging.handlers
+import marshal
 from base64 import b64decode, b64encode
+from rebus.tools.registry import Registry
 
 log = logging.getLogger("rebus.serializer")
 
@@ -36,7 +38,37 @@ def load(fname):
     return serializer.load(fname)
 
 
+class SerializerRegistry(Registry):
+    pass
+
+
+def register(cls):
+    return SerializerRegistry.register_ref(cls, key="_name_")
+
+
+def get_bus_serializer(name):
+    """
+    Returns the serializer registered as name, None if it is unknown or must
+    not be used to decode data received from the bus.
+    """
+    ser = SerializerRegistry.get(name)
+    if ser is None or getattr(ser, '_local_', False):
+        return None
+    return ser
+
+
+def bus_serializer_names():
+    """
+    Returns the sorted names of serializers that may be used on the bus.
+    """
+    return sorted(name for name in SerializerRegistry.iterkeys()
+                  if get_bus_serializer(name) is not None)
+
+
+@register
 class picklev2(object):
+    _name_ = "picklev2"
+
     @staticmethod
     def loads(string):
         return serializer.loads(string)
@@ -54,7 +86,10 @@ class picklev2(object):
         return serializer.dump(obj, fname)
 
 
+@register
 class b64serializer(object):
+    _name_ = "b64"
+
     @staticmethod
     def loads(string):
         return serializer.loads(b64decode(string))
@@ -62,3 +97,65 @@ class b64serializer(object):
     @staticmethod
     def dumps(obj, protocol=2):
         return b64encode(serializer.dumps(obj, protocol))
+
+
+#: Fields of descriptor metadata (output of Descriptor.serialize_meta), in
+#: the order they are packed by compactmeta
+META_FIELDS = ("label", "selector", "domain", "agent", "uuid", "precursors",
+               "version", "processing_time")
+META_KEYS = frozenset(META_FIELDS)
+#: Keys of dictionaries produced by Descriptor.serialize()
+DESC_KEYS = META_KEYS | frozenset(["value"])
+META_TAG = 'M'
+
+
+@register
+class compactmeta(object):
+    """
+    Packs descriptor metadata (output of Descriptor.serialize_meta or
+    Descriptor.serialize) as a marshalled tuple of fields in a fixed order,
+    which is smaller than a pickled dictionary. Descriptor values and any
+    other object are pickled.
+
+    loads() also accepts data produced by picklev2, which always starts with
+    '\x80'.
+
+    marshal is not safe against maliciously crafted data: this serializer is
+    only used for metadata written by the storage itself, never for data
+    received from the bus.
+    """
+    _name_ = "compactmeta"
+    _local_ = True
+
+    @staticmethod
+    def dumps(obj):
+        if type(obj) is not dict or \
+                (len(obj) != len(META_KEYS) and len(obj) != len(DESC_KEYS)) \
+                or not META_KEYS.issubset(obj):
+            return picklev2.dumps(obj)
+        fields = [obj[k] for k in META_FIELDS]
+        if 'value' in obj:
+            fields.append(picklev2.dumps(obj['value']))
+        try:
+            return META_TAG + marshal.dumps(tuple(fields), 2)
+        except ValueError:
+            # field types that are not supported by marshal
+            return picklev2.dumps(obj)
+
+    @staticmethod
+    def loads(string):
+        if string[:1] != META_TAG:
+            return picklev2.loads(string)
+        fields = marshal.loads(string[1:])
+        obj = dict(zip(META_FIELDS, fields))
+        if len(fields) > len(META_FIELDS):
+            obj['value'] = picklev2.loads(fields[-1])
+        return obj
+
+    @classmethod
+    def load(cls, fp):
+        return cls.loads(fp.read())
+
+    @classmethod
+    def dump(cls, obj, fp):
+        return fp.write(cls.dumps(obj))
@@ -0,0 +1,70 @@
+"""
+Out-of-band transfer of large descriptor values, through a spool directory
+that is shared by bus slaves and the bus master (local, or NFS).
+
+A bus slave writes the value to a new file in the spool directory, then
+pushes the descriptor's metadata along with this file's name. The bus master
+hands this file to its storage backend, which adopts it (see
+Storage.add_spooled).
+Values are written using the format storage backends store values in (see
+rebus.tools.values), so that they can adopt spooled files by renaming them.
+"""
+import errno
+import os
+import tempfile
+from rebus.tools.values import encode_value, decode_value
+
+SPOOL_SUFFIX = '.spool'
+
+
+def should_spool(descriptor, threshold):
+    """
+    Returns True if descriptor's value is a byte string larger than threshold
+    bytes.
+    """
+    value = descriptor.value
+    return type(value) is str and len(value) > threshold
+
+
+def spool_value(spool_dir, descriptor):
+    """
+    Writes descriptor's value to a new file in spool_dir. Returns its name,
+    relative to spool_dir.
+    """
+    fd, path = tempfile.mkstemp(suffix=SPOOL_SUFFIX, dir=spool_dir)
+    with os.fdopen(fd, 'wb') as fp:
+        for chunk in encode_value(descriptor):
+            fp.write(chunk)
+    return os.path.basename(path)
+
+
+def spooled_path(spool_dir, name):
+    """
+    Returns the path of spooled file name. Raises ValueError if name does not
+    refer to a spooled file located in spool_dir.
+    """
+    if os.path.basename(name) != name or not name.endswith(SPOOL_SUFFIX):
+        raise ValueError("Invalid spooled value name %r" % name)
+    return os.path.join(spool_dir, name)
+
+
+def remove_spooled(spool_dir, name):
+    """
+    Removes spooled file name, if it has not been adopted or removed by the
+    bus master. Returns True if it was still present.
+    """
+    try:
+        os.remove(spooled_path(spool_dir, name))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def read_spooled(path):
+    """
+    Returns the value contained in spooled file path.
+    """
+    with open(path, 'rb') as fp:
+        return decode_value(fp.read())
@@ -0,0 +1,90 @@
+"""
+Format of stored descriptor values, shared by storage backends and the spool
+directory.
+
+A stored value is either a raw byte string preceded by RAW_VALUE_TAG, or a
+pickled value. It may then be compressed, and preceded by the tag of the
+compression algorithm.
+"""
+import bz2
+import zlib
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import picklev2 as store_serializer
+
+#: First byte of stored values that are raw byte strings, which can be read
+#: partially. Other stored values are pickled, and start with the pickle
+#: protocol 2 opcode '\x80'.
+RAW_VALUE_TAG = 'r'
+
+
+#: First byte of compressed stored values, for each compression algorithm.
+#: It is followed by compressed data, which has been returned by
+#: encode_value().
+COMPRESSION_TAGS = {'zlib': 'z', 'bz2': 'b'}
+COMPRESSORS = {'zlib': zlib.compressobj, 'bz2': bz2.BZ2Compressor}
+DECOMPRESSORS = {'z': zlib.decompressobj, 'b': bz2.BZ2Decompressor}
+
+
+def encode_value(descriptor):
+    """
+    Returns a tuple of strings, to be written consecutively in order to store
+    descriptor's value.
+    """
+    value = descriptor.value
+    if type(value) is str:
+        return RAW_VALUE_TAG, value
+    return (descriptor.serialize_value(store_serializer),)
+
+
+def compress_chunks(chunks, algorithm):
+    """
+    Returns a tuple of strings containing compressed chunks, preceded by the
+    tag of algorithm.
+    """
+    compressor = COMPRESSORS[algorithm]()
+    result = [COMPRESSION_TAGS[algorithm]]
+    for chunk in chunks:
+        result.append(compressor.compress(chunk))
+    result.append(compressor.flush())
+    return tuple(result)
+
+
+def decompress_value(data):
+    """
+    Returns data, which has been written using encode_value(), and may have
+    been compressed using compress_chunks().
+    """
+    if data[:1] in DECOMPRESSORS:
+        decompressor = DECOMPRESSORS[data[:1]]()
+        return decompressor.decompress(buffer(data, 1))
+    return data
+
+
+def read_decompressed(fp, tag, size):
+    """
+    Reads compressed data from file object fp, until at least size bytes of
+    decompressed data are available. Returns decompressed data.
+
+    :param tag: tag of the compression algorithm
+    """
+    decompressor = DECOMPRESSORS[tag]()
+    result = []
+    available = 0
+    while available < size:
+        chunk = fp.read(65536)
+        if not chunk:
+            break
+        result.append(decompressor.decompress(chunk))
+        available += len(result[-1])
+    return ''.join(result)
+
+
+def decode_value(data):
+    """
+    Returns the value stored in data, which has been written using
+    encode_value(), and may have been compressed.
+    """
+    data = decompress_value(data)
+    if data[:1] == RAW_VALUE_TAG:
+        return data[1:]
+    return Descriptor.unserialize_value(store_serializer, data)
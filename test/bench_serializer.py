@@ -0,0 +1,28 @@
+#! /usr/bin/env python
+"""
+Compares registered serializers on typical descriptor metadata.
+Run using python test/bench_serializer.py
+"""
+import sys
+import timeit
+from rebus.descriptor import Descriptor
+from rebus.tools.serializer import SerializerRegistry
+
+
+def benchmark(number=100000):
+    parent = Descriptor(u'sample.exe', '/binary/pe', 'MZ' + 'A' * 1000,
+                        'default')
+    desc = parent.spawn_descriptor('/signature/md5', 'a' * 32, 'hasher')
+    for name, ser in sorted(SerializerRegistry.iteritems()):
+        meta = desc.serialize_meta(ser)
+        dumps = timeit.timeit(lambda: desc.serialize_meta(ser),
+                              number=number)
+        loads = timeit.timeit(
+            lambda: Descriptor.unserialize(ser, meta, trusted=True),
+            number=number)
+        print("%-12s %4d bytes  serialize_meta %.2fus  unserialize %.2fus" % (
+            name, len(meta), dumps * 1e6 / number, loads * 1e6 / number))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,64 @@
+import imp
+import os
+import tempfile
+import rebus
+
+# This file implements unit tests for the packing of descriptor values sent
+# through the DBus bus - no DBus connection is needed.
+
+# values.py does not depend on dbus, but its package does: load it on its own
+values = imp.load_source(
+    'rebus_dbusbus_values',
+    os.path.join(os.path.dirname(rebus.__file__), 'buses', 'dbusbus',
+                 'values.py'))
+FD_TAG = values.FD_TAG
+pack_value = values.pack_value
+pack_values = values.pack_values
+unpack_value = values.unpack_value
+from_fd = values.from_fd
+
+
+def test_pack_value():
+    for value in ('value', '', u'unicode \xe9', {'a': [1, 2]}, 0):
+        data = pack_value(value)
+        assert data not in ('', FD_TAG)
+        assert unpack_value(data) == value
+        # received as byte arrays
+        assert unpack_value(bytearray(data)) == value
+    assert pack_value(None) == ''
+    assert unpack_value('') is None
+
+
+def test_pack_value_too_large(monkeypatch):
+    monkeypatch.setattr(values, 'FD_THRESHOLD', 100)
+    assert pack_value('A' * 200) == FD_TAG
+    assert unpack_value(pack_value('A' * 50)) == 'A' * 50
+
+
+def test_pack_values(monkeypatch):
+    monkeypatch.setattr(values, 'FD_THRESHOLD', 100)
+    packed = pack_values(['A' * 40, None, 'B' * 20, 'C' * 40, 'D' * 200,
+                          'E'])
+    assert [unpack_value(data) for data in packed[:3]] == \
+        ['A' * 40, None, 'B' * 20]
+    # reply would not fit in a DBus message anymore
+    assert packed[3:5] == [FD_TAG, FD_TAG]
+    # small values still fit
+    assert unpack_value(packed[5]) == 'E'
+    assert pack_values([]) == []
+
+
+def test_from_fd():
+    class FakeUnixFd(object):
+        def __init__(self, fd):
+            self.fd = fd
+
+        def take(self):
+            return self.fd
+
+    fp = tempfile.TemporaryFile()
+    fp.write(pack_value('value'))
+    fp.flush()
+    data = from_fd(FakeUnixFd(os.dup(fp.fileno())))
+    fp.close()
+    assert unpack_value(data) == 'value'
@@ -0,0 +1,510 @@
+from collections import OrderedDict, defaultdict
+import pika
+import pytest
+import rebus.tools.serializer as serializer
+from rebus.bus import BusError
+from rebus.buses.rabbitbus.master import RabbitBusMaster
+from rebus.buses.rabbitbus.slave import RabbitBus, RPCReply
+
+
+# This file implements unit tests for the RPC layer of the rabbitmq bus - the
+# broker and the bus master are simulated, no rabbitmq server is needed.
+
+
+class FakeProperties(object):
+    def __init__(self, correlation_id):
+        self.correlation_id = correlation_id
+
+
+class FakeRPCChannel(object):
+    """
+    Records published RPC requests. Replies computed by master are returned
+    by consume(), in publishing order.
+    """
+    def __init__(self, master):
+        self.master = master
+        self.published = []
+        self.replies = []
+        self.closed = False
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, serializer.loads(body)))
+        self.replies.append((None, FakeProperties(properties.correlation_id),
+                             serializer.dumps(self.master(body))))
+
+    def consume(self, queue, no_ack):
+        while self.replies:
+            if self.closed:
+                raise pika.exceptions.ConnectionClosed()
+            yield self.replies.pop(0)
+        raise AssertionError("waiting for a reply that will never come")
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.timeouts = {}
+
+    def add_timeout(self, deadline, callback):
+        timeout_id = len(self.timeouts)
+        self.timeouts[timeout_id] = (deadline, callback)
+        return timeout_id
+
+    def remove_timeout(self, timeout_id):
+        self.timeouts.pop(timeout_id, None)
+
+
+def master(body):
+    """
+    Simulated bus master: every RPC returns its func_name.
+    """
+    body = serializer.loads(body)
+    if 'calls' in body:
+        return [func_name for func_name, _ in body['calls']]
+    return body['func_name']
+
+
+def new_bus(rpc_window=64, rpc_batch_size=1, rpc_linger=0.05):
+    """
+    Returns a RabbitBus instance that is not connected to rabbitmq.
+    """
+    bus = RabbitBus.__new__(RabbitBus)
+    bus.serializer = serializer
+    bus.connection = FakeConnection()
+    bus.rpc_channel = FakeRPCChannel(master)
+    bus.return_queue = 'rpc_ret_test'
+    bus.pending_rpcs = OrderedDict()
+    bus.pending_routing_key = None
+    bus.rpc_window = rpc_window
+    bus.rpc_batch = []
+    bus.rpc_batch_routing_key = None
+    bus.rpc_batch_timer = None
+    bus.rpc_batch_size = rpc_batch_size
+    bus.rpc_linger = rpc_linger
+    bus.work_item = None
+    bus.reconnect = lambda: None
+    return bus
+
+
+def test_lost_reply():
+    bus = new_bus()
+    reply = bus.send_rpc('push', {}, False, wait=False)
+    assert isinstance(reply, RPCReply)
+    bus.rpc_channel.closed = True
+    with pytest.raises(BusError):
+        reply.result()
+    assert not bus.pending_rpcs
+    # truth value of a lost reply cannot be known either
+    with pytest.raises(BusError):
+        bool(reply)
+
+
+def test_reply_truth_value():
+    bus = new_bus()
+    reply = bus.send_rpc('push', {}, False, wait=False)
+    assert not reply.done
+    # waits for the reply
+    assert reply
+    assert reply.done
+    bus.rpc_channel.master = lambda body: False
+    assert not bus.send_rpc('push', {}, False, wait=False)
+
+
+def test_rpc_reply_futures():
+    bus = new_bus()
+    assert bus.send_rpc('get', {}) == 'get'
+    first = bus.send_rpc('mark_processed', {}, wait=False)
+    second = bus.send_rpc('unlock', {}, wait=False)
+    assert len(bus.pending_rpcs) == 2
+    # replies are dispatched using their correlation id
+    bus.rpc_channel.replies.reverse()
+    # unknown correlation id: ignored
+    bus.rpc_channel.replies.insert(
+        0, (None, FakeProperties('unknown'), serializer.dumps('x')))
+    assert first.result() == 'mark_processed'
+    assert second.done
+    assert second.result() == 'unlock'
+    assert not bus.pending_rpcs
+    assert [key for key, _ in bus.rpc_channel.published] == \
+        ['rebus_master_rpc_highprio'] * 3
+
+
+def test_rpc_batch_envelope():
+    bus = new_bus(rpc_batch_size=3)
+    replies = [bus.send_rpc('mark_processed', {'selector': str(i)},
+                            wait=False) for i in range(2)]
+    # batched, not sent yet
+    assert bus.rpc_channel.published == []
+    assert len(bus.connection.timeouts) == 1
+    replies.append(bus.send_rpc('unlock', {}, wait=False))
+    # batch is full
+    assert bus.rpc_channel.published == [
+        ('rebus_master_rpc_highprio',
+         {'calls': [('mark_processed', {'selector': '0'}),
+                    ('mark_processed', {'selector': '1'}),
+                    ('unlock', {})]})]
+    assert bus.connection.timeouts == {}
+    assert bus.rpc_batch == []
+    assert [reply.result() for reply in replies] == \
+        ['mark_processed', 'mark_processed', 'unlock']
+
+
+def test_rpc_batch_flush():
+    bus = new_bus(rpc_batch_size=10)
+    bus.send_rpc('mark_processed', {}, wait=False)
+    bus.send_rpc('unlock', {}, wait=False)
+    # linger timeout sends the batch
+    [(deadline, callback)] = bus.connection.timeouts.values()
+    assert deadline == bus.rpc_linger
+    callback()
+    assert [body for _, body in bus.rpc_channel.published] == \
+        [{'calls': [('mark_processed', {}), ('unlock', {})]}]
+
+    # switching routing key sends the batch
+    bus.send_rpc('mark_processed', {}, wait=False)
+    push = bus.send_rpc('push', {}, False, wait=False)
+    assert bus.rpc_channel.published[1] == \
+        ('rebus_master_rpc_highprio', {'calls': [('mark_processed', {})]})
+    assert len(bus.pending_rpcs) == 2
+    # waited for RPCs are sent alone, after the current batch
+    assert bus.send_rpc('get', {}) == 'get'
+    assert bus.rpc_channel.published[2:] == [
+        ('rebus_master_rpc_lowprio', {'calls': [('push', {})]}),
+        ('rebus_master_rpc_highprio', {'func_name': 'get', 'args': {}})]
+    # replies to RPCs sent to the other queue have been waited for before
+    # switching queues
+    assert push.done
+    assert push.result() == 'push'
+
+
+def test_rpc_window():
+    bus = new_bus(rpc_window=2)
+    replies = [bus.send_rpc('mark_processed', {}, wait=False)
+               for _ in range(3)]
+    assert len(bus.pending_rpcs) == 2
+    # the oldest reply had to be received before sending the third RPC
+    assert [reply.done for reply in replies] == [True, False, False]
+    bus.flush_rpcs()
+    assert all(reply.done for reply in replies)
+
+
+def test_master_rpc_batch():
+    class FakeChannel(object):
+        def __init__(self):
+            self.published = []
+            self.acked = []
+
+        def basic_publish(self, exchange, routing_key, body, properties):
+            self.published.append((routing_key, properties.correlation_id,
+                                   serializer.loads(body)))
+
+        def basic_ack(self, delivery_tag):
+            self.acked.append(delivery_tag)
+
+    class FakeMethod(object):
+        delivery_tag = 7
+
+    class Properties(object):
+        reply_to = 'rpc_ret_test'
+        correlation_id = 'corr'
+
+    master = RabbitBusMaster.__new__(RabbitBusMaster)
+    calls = []
+
+    def call_rpc_func(name, args):
+        calls.append(name)
+        return args['x'] * 2
+    master.call_rpc_func = call_rpc_func
+    ch = FakeChannel()
+    body = serializer.dumps({'calls': [('a', {'x': 1}), ('b', {'x': 2})]})
+    master.rpc_callback(ch, FakeMethod(), Properties(), body)
+    body = serializer.dumps({'func_name': 'c', 'args': {'x': 3}})
+    master.rpc_callback(ch, FakeMethod(), Properties(), body)
+    # calls are executed in order
+    assert calls == ['a', 'b', 'c']
+    assert ch.published == [('rpc_ret_test', 'corr', [2, 4]),
+                            ('rpc_ret_test', 'corr', 6)]
+    assert ch.acked == [7, 7]
+
+
+def test_routing_key():
+    from rebus.buses.rabbitbus.routing import routing_key, MAX_KEY_LENGTH
+    assert routing_key('/binary/elf/%1234') == 'binary.elf'
+    assert routing_key('/signature/md5%ab/cd') == 'signature.md5'
+    assert routing_key('/link/a/b%1234') == 'link.a.b'
+    long_key = routing_key('/' + '/'.join(['word'] * 100) + '%1234')
+    assert len(long_key) <= MAX_KEY_LENGTH
+    assert long_key.startswith('word.word')
+    assert not long_key.endswith('.')
+
+
+def test_binding_keys():
+    from rebus.buses.rabbitbus.routing import binding_keys, prefix_words
+    assert prefix_words('/binary/') == ['binary']
+    # incomplete last word is dropped
+    assert prefix_words('/binary/el') == ['binary']
+    assert prefix_words('/bin') == []
+    assert binding_keys(None) == ['#']
+    assert binding_keys(()) == []
+    assert binding_keys(['/archive/', '/compressed/', '/archive/zip']) == \
+        ['archive.#', 'compressed.#']
+    assert binding_keys(['/bin']) == ['#']
+
+
+def test_is_routed():
+    from rebus.buses.rabbitbus.routing import is_routed
+    assert is_routed(None, '/binary/elf%1234')
+    assert not is_routed((), '/binary/elf%1234')
+    assert is_routed(['/binary/'], '/binary/elf%1234')
+    assert not is_routed(['/binary/'], '/binaryx/elf%1234')
+    assert not is_routed(['/graph/dot/'], '/graph/svg/a%1234')
+    # routing is word-based: the agent's selector_filter makes the decision
+    assert is_routed(['/bin'], '/text/x%1234')
+
+
+def test_work_queue_name():
+    from rebus.buses.rabbitbus.routing import work_queue_name
+    name = work_queue_name('hasher', '{}')
+    assert name.startswith('work_hasher_')
+    assert name == work_queue_name('hasher', '{}')
+    assert name != work_queue_name('hasher', '{"a": 1}')
+    assert name != work_queue_name('strings', '{}')
+
+
+def test_selector_filter_matches_routing():
+    """
+    Agents that declare selector prefixes accept every selector that is
+    routed to them, and only those.
+    """
+    from rebus.agent import Agent
+    from rebus.buses.rabbitbus.routing import is_routed
+    from rebus.agents.link_finder import LinkFinder
+
+    class Archives(Agent):
+        _selector_prefixes_ = ("/archive/", "/compressed/")
+
+    class Nothing(Agent):
+        _selector_prefixes_ = ()
+
+    selectors = ['/graph/dot/qum/minhash%1', '/archive/zip%3',
+                 '/compressed/gzip%4', '/binary/elf%5', '/signature/md5%6']
+    link_finder = LinkFinder.__new__(LinkFinder)
+    link_finder.config = {'selector_prefix': '/signature/'}
+    agents = [cls.__new__(cls) for cls in (Agent, Archives, Nothing)] + \
+        [link_finder]
+    for agent in agents:
+        prefixes = agent.selector_prefixes()
+        for selector in selectors:
+            if agent.selector_filter(selector):
+                assert is_routed(prefixes, selector)
+    accepted = [[s for s in selectors if agent.selector_filter(s)]
+                for agent in agents]
+    assert accepted == [selectors, selectors[1:3], [], [selectors[4]]]
+
+
+def test_lock_waits_for_master():
+    bus = new_bus(rpc_batch_size=10)
+    bus.rpc_channel.master = lambda body: False
+    # a lock held by another instance is refused, even for work items
+    assert not bus.lock('agent-1', 'lockid', 'default', '/binary/elf%1')
+    assert bus.rpc_channel.published[-1][1]['func_name'] == 'lock'
+
+
+def test_register_purges_work_queue_once():
+    class FakeStore(object):
+        def list_unprocessed_by_agent(self, agent_name, options):
+            return [('default', 'uuid', '/binary/elf%1')]
+
+        def count_unprocessed_by_agent(self, agent_name, options):
+            return 1
+
+    master = RabbitBusMaster.__new__(RabbitBusMaster)
+    master.session_id = 'session'
+    master.store = FakeStore()
+    master.descriptor_count = 1
+    master.agentnames = {}
+    master.agent_serializers = {}
+    master.uniq_conf_clients = defaultdict(list)
+    master.selector_prefixes = {}
+    master.descriptor_handled_count = {}
+    master.clients = {}
+    master.agents_output_altering_options = {}
+    master.agents_full_config_txts = {}
+    master.publish_ids = lambda amount: None
+    purged = []
+    targeted = []
+    master.purge_work_queue = lambda *args: purged.append(args)
+    master.targeted_descriptor = lambda *args: targeted.append(args)
+    config_txt = '{"output_altering_options": []}'
+    for agent_id in ('hasher-session-1', 'hasher-session-2'):
+        master.register(agent_id, 'default', '/agent/' + agent_id, config_txt,
+                        work_queue=True)
+    # the second instance shares the work queue of the running one
+    assert len(purged) == 1
+    assert len(targeted) == 1
+    assert master.descriptor_handled_count == {('hasher', '{}'): 0}
+
+
+def test_work_item_redelivered():
+    """
+    A work item whose first consumer dies while processing it is processed
+    by the instance it is redelivered to.
+    """
+    class Killed(Exception):
+        pass
+
+    class FakeChannel(object):
+        def __init__(self):
+            self.acked = []
+
+        def basic_ack(self, delivery_tag):
+            self.acked.append(delivery_tag)
+
+    class Delivery(object):
+        def __init__(self, redelivered):
+            self.delivery_tag = 1
+            self.redelivered = redelivered
+
+    class Worker(object):
+        name = 'hasher'
+
+        def __init__(self, bus, agent_id, crash=False):
+            self.bus = bus
+            self.agent_id = agent_id
+            self.crash = crash
+            self.processed = []
+
+        def on_idle(self):
+            pass
+
+        def on_new_descriptor(self, sender_id, desc_domain, uuid, selector,
+                              user_request):
+            if not self.bus.lock(self.agent_id, 'hasher{}', desc_domain,
+                                 selector):
+                return
+            if self.crash:
+                raise Killed()
+            self.processed.append(selector)
+
+    bus_master = RabbitBusMaster.__new__(RabbitBusMaster)
+    bus_master.session_id = 'session'
+    bus_master.clients = {'hasher-session-1': '/agent/hasher',
+                          'hasher-session-2': '/agent/hasher',
+                          'hasher-session-3': '/agent/hasher'}
+    bus_master.locks = defaultdict(dict)
+
+    def call_master(body):
+        body = serializer.loads(body)
+        return bus_master.call_rpc_func(body['func_name'], body['args'])
+
+    workers = []
+    for i, crash in enumerate((True, False, False)):
+        bus = new_bus()
+        bus.rpc_channel.master = call_master
+        bus.agent = Worker(bus, 'hasher-session-%d' % (i + 1), crash)
+        workers.append(bus.agent)
+    body = serializer.dumps({
+        'signal_name': 'new_descriptor',
+        'args': {'sender_id': 'inject', 'desc_domain': 'default',
+                 'uuid': 'uuid', 'selector': '/binary/elf%1'}})
+
+    ch = FakeChannel()
+    with pytest.raises(Killed):
+        workers[0].bus.work_handler(ch, Delivery(False), None, body)
+    assert ch.acked == []
+    assert workers[0].bus.work_item is None
+    # rabbitmq redelivers the unacknowledged item to another instance
+    workers[1].bus.work_handler(ch, Delivery(True), None, body)
+    assert workers[1].processed == ['/binary/elf%1']
+    assert ch.acked == [1]
+    # the lock is held: the same selector is not processed again
+    workers[2].bus.targeted_wrapper('storage', 'default', 'uuid',
+                                    '/binary/elf%1', ['hasher'], False)
+    assert workers[2].processed == []
+
+
+def test_descriptors_from_master_trusted(monkeypatch):
+    from rebus.descriptor import Descriptor
+    desc = Descriptor('a.bin', '/binary/pe', 'MZ', 'default')
+    bus = new_bus()
+    bus.rpc_channel.master = lambda body: [desc.serialize_meta(serializer)]
+    trusted = []
+
+    def from_trusted(cls, **kwargs):
+        trusted.append(kwargs['selector'])
+        return Descriptor(**kwargs)
+    monkeypatch.setattr(Descriptor, 'from_trusted',
+                        classmethod(from_trusted))
+    [received] = bus.find_by_uuid('agent-1', 'default', desc.uuid)
+    assert trusted == [desc.selector]
+    assert received.selector == desc.selector
+    assert received.bus is bus
+
+
+def test_get_descriptors():
+    from rebus.descriptor import Descriptor
+    d1 = Descriptor('a.bin', '/binary/pe', 'MZ', 'default')
+    d2 = d1.spawn_descriptor('/link/x', {'linktype': 'x'}, 'linker')
+
+    class FakeStore(object):
+        def get_descriptor(self, domain, selector):
+            return {d1.selector: d1, d2.selector: d2}.get(selector)
+
+    bus_master = RabbitBusMaster.__new__(RabbitBusMaster)
+    bus_master.session_id = 'session'
+    bus_master.store = FakeStore()
+    bus_master.agent_serializers = {}
+
+    def call_master(body):
+        body = serializer.loads(body)
+        return bus_master.call_rpc_func(body['func_name'], body['args'])
+    bus = new_bus()
+    bus.rpc_channel.master = call_master
+    descs = bus.get_descriptors('agent-session-1', 'default',
+                                [d2.selector, '/unknown/%1234', d1.selector])
+    # a single round-trip
+    assert len(bus.rpc_channel.published) == 1
+    assert [d and d.selector for d in descs] == \
+        [d2.selector, None, d1.selector]
+    assert descs[0].precursors == [d1.selector]
+
+
+def test_link_grapher_round_trips():
+    import logging
+    from rebus.descriptor import Descriptor
+    from rebus.agents.link_grapher import LinkGrapher
+    d1 = Descriptor('a.bin', '/binary/pe', 'MZ', 'default')
+    d2 = Descriptor('b.bin', '/binary/pe', 'MZ', 'default')
+    links = d1.create_links(d2, 'link_finder', 'x', 'same value', True)
+
+    class CountingBus(object):
+        def __init__(self):
+            self.calls = []
+            self.pushed = []
+
+        def find(self, agent_id, desc_domain, selector_regex, limit):
+            self.calls.append('find')
+            return [link.selector for link in links]
+
+        def get_descriptors(self, agent_id, desc_domain, selectors):
+            self.calls.append('get_descriptors')
+            return [Descriptor.unserialize(
+                serializer, link.serialize_meta(serializer), bus=self)
+                for link in links]
+
+        def get_values(self, agent_id, desc_domain, selectors):
+            self.calls.append('get_values')
+            return [link.value for link in links]
+
+        def push(self, agent_id, descriptor):
+            self.pushed.append(descriptor)
+
+    grapher = LinkGrapher.__new__(LinkGrapher)
+    grapher.bus = CountingBus()
+    grapher.id = 'link_grapher-session-1'
+    grapher.domain = 'default'
+    grapher.config = {'selectors': ['/link/'], 'limit': 0}
+    grapher.log = logging.getLogger('test')
+    grapher.run()
+    assert grapher.bus.calls == ['find', 'get_descriptors', 'get_values']
+    [graph] = grapher.bus.pushed
+    assert d1.uuid in graph.value and d2.uuid in graph.value
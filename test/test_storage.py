@@ -0,0 +1,816 @@
+import argparse
+import os
+import shutil
+import tempfile
+import pytest
+
+from rebus.descriptor import Descriptor
+from rebus.storage import StorageRegistry
+from rebus.tools.serializer import picklev2 as store_serializer
+import rebus.storage_backends
+
+rebus.storage_backends.import_all()
+
+
+# This file implements unit tests for storage backends - descriptors are added
+# directly to the storage, without running any bus.
+
+
+@pytest.fixture(scope='function',
+                params=['diskstorage', 'ramstorage', 'segmentstorage',
+                        'spillstorage'])
+def store(request):
+    """
+    Returns an empty storage instance.
+    Perform setup & teardown for storage.
+    """
+    args = []
+    if request.param in ('diskstorage', 'segmentstorage'):
+        tmpdir = tempfile.mkdtemp('rebus-test-%s' % request.param)
+        args = ['--path', tmpdir]
+    elif request.param == 'spillstorage':
+        # tiny budget: most values get spilled
+        tmpdir = tempfile.mkdtemp('rebus-test-%s' % request.param)
+        args = ['--memory-budget', '16', '--spill-dir', tmpdir]
+    if args:
+        def fin():
+            shutil.rmtree(tmpdir)
+        request.addfinalizer(fin)
+
+    return new_storage(request.param, args)
+
+
+def new_storage(name, args):
+    storage_class = StorageRegistry.get(name)
+    parser = argparse.ArgumentParser()
+    storage_class.add_arguments(parser)
+    return storage_class(parser.parse_args(args))
+
+
+def new_desc(label, selector, value, **kwargs):
+    return Descriptor(label, selector, value, 'default', **kwargs)
+
+
+def test_find_by_uuid(store):
+    d1 = new_desc('a.bin', '/binary/elf', 'value1')
+    d2 = new_desc('b.bin', '/binary/pe', 'value2')
+    child = d1.spawn_descriptor('/signature/md5', 'md5', 'hasher')
+    for desc in (d1, d2, child):
+        assert store.add(desc)
+    assert not store.add(d1)
+
+    found = store.find_by_uuid('default', d1.uuid)
+    assert sorted(d.selector for d in found) == \
+        sorted([d1.selector, child.selector])
+    assert [d.selector for d in store.find_by_uuid('default', d2.uuid)] == \
+        [d2.selector]
+    assert store.find_by_uuid('default', 'unknown-uuid') == []
+    assert store.find_by_uuid('otherdomain', d1.uuid) == []
+
+
+def test_list_uuids(store):
+    d1 = new_desc('a.bin', '/binary/elf', 'value1')
+    child = d1.spawn_descriptor('/signature/md5', 'md5', 'hasher',
+                                label='child label')
+    d2 = new_desc('b.bin', '/binary/pe', 'value2')
+    for desc in (d1, child, d2):
+        store.add(desc)
+
+    # label of the descriptor having no precursor is preferred
+    assert store.list_uuids('default') == {d1.uuid: 'a.bin',
+                                           d2.uuid: 'b.bin'}
+    assert store.list_uuids('otherdomain') == {}
+
+
+def test_find_by_selector(store):
+    descs = [new_desc('f%d' % i, sel, 'value%d' % i) for i, sel in
+             enumerate(['/binary/pe', '/link/a', '/binary/elf', '/binary/pe',
+                        '/binaryfoo', '/binary/elf'])]
+    for desc in descs:
+        store.add(desc)
+
+    def selectors(*args):
+        return [d.selector for d in store.find_by_selector('default', *args)]
+
+    # results are sorted from oldest to newest
+    binaries = [descs[i].selector for i in (0, 2, 3, 4, 5)]
+    assert selectors('/binary') == binaries
+    assert selectors('/binary/') == [descs[i].selector for i in (0, 2, 3, 5)]
+    assert selectors('/binary', 2) == binaries[:2]
+    assert selectors('/binary', 2, 2) == binaries[2:4]
+    assert selectors('/binary', 0, 3) == binaries[3:]
+    assert selectors('/') == [d.selector for d in descs]
+    assert selectors('/', 1, 1) == [descs[1].selector]
+    assert selectors('/unknown') == []
+    assert store.find_by_selector('otherdomain', '/') == []
+
+
+def test_find(store):
+    descs = [new_desc('f%d' % i, sel, 'value%d' % i) for i, sel in
+             enumerate(['/binary/pe', '/link/a', '/binary/elf', '/link/b',
+                        '/binary/elf'])]
+    for desc in descs:
+        store.add(desc)
+    sels = [d.selector for d in descs]
+
+    # results are sorted from newest to oldest
+    assert store.find('default', '/binary/.*') == [sels[4], sels[2], sels[0]]
+    assert store.find('default', '^/link/') == [sels[3], sels[1]]
+    assert store.find('default', '/binary/elf', 1) == [sels[4]]
+    assert store.find('default', '/binary', 1, 1) == [sels[2]]
+    assert store.find('default', '/link/a|/binary/pe') == [sels[1], sels[0]]
+    assert store.find('default', '.*/elf') == [sels[4], sels[2]]
+    # global inline flags apply to the whole pattern
+    assert store.find('default', '/LINK/.*(?i)') == [sels[3], sels[1]]
+    assert store.find('default', '/unknown') == []
+    assert store.find('otherdomain', '/') == []
+
+
+def test_regex_literal_prefix():
+    from rebus.tools.selector_index import regex_literal_prefix
+    assert regex_literal_prefix('/link/.*') == '/link/'
+    assert regex_literal_prefix('^/binary/elf') == '/binary/elf'
+    assert regex_literal_prefix('/binary/pe?') == '/binary/p'
+    assert regex_literal_prefix('/binary/e+lf') == '/binary/e'
+    assert regex_literal_prefix('/binary/e{2}') == '/binary/'
+    assert regex_literal_prefix('/a\\-b\\d') == '/a-b'
+    assert regex_literal_prefix('/link/(a|b)') == '/link/'
+    assert regex_literal_prefix('/link/a|/binary') == ''
+    assert regex_literal_prefix('/link/[|]') == '/link/'
+    assert regex_literal_prefix('(?i)/link/') == ''
+    assert regex_literal_prefix('/link/.*(?i)') == ''
+
+
+def test_processed_stats(store):
+    d1 = new_desc('a.bin', '/binary/elf', 'value1')
+    d2 = new_desc('b.bin', '/binary/pe', 'value2')
+    store.add(d1)
+    store.add(d2)
+    assert store.processed_stats('default') == ([], 2)
+    assert store.mark_processed('default', d1.selector, 'hasher', 'conf1')
+    assert not store.mark_processed('default', d1.selector, 'hasher',
+                                    'conf1')
+    store.mark_processed('default', d2.selector, 'hasher', 'conf1')
+    store.mark_processed('default', d2.selector, 'hasher', 'conf2')
+    store.mark_processed('default', d2.selector, 'strings', 'conf1')
+    stats, total = store.processed_stats('default')
+    assert sorted(stats) == [('hasher', 3), ('strings', 1)]
+    assert total == 2
+    assert store.processed_stats('otherdomain') == ([], 0)
+    assert store.count_processed('default', 'hasher', 'conf1') == 2
+    assert store.count_processed('default', 'hasher', 'conf2') == 1
+    assert store.count_unprocessed_by_agent('hasher', 'conf2') == 1
+    assert store.count_unprocessed_by_agent('unknown', 'conf1') == 2
+
+
+def test_list_unprocessed_by_agent(store):
+    descs = [new_desc('f%d' % i, '/binary/elf', 'value%d' % i) for i in
+             range(5)]
+    for desc in descs:
+        store.add(desc)
+    expected = [('default', d.uuid, d.selector) for d in descs]
+    assert store.list_unprocessed_by_agent('hasher', 'conf') == expected
+    for desc in descs[:2] + descs[3:4]:
+        store.mark_processed('default', desc.selector, 'hasher', 'conf')
+    assert store.list_unprocessed_by_agent('hasher', 'conf') == \
+        [expected[2], expected[4]]
+    # other configurations are not affected
+    assert store.list_unprocessed_by_agent('hasher', 'conf2') == expected
+    store.mark_processed('default', descs[2].selector, 'hasher', 'conf')
+    assert store.list_unprocessed_by_agent('hasher', 'conf') == [expected[4]]
+    new = new_desc('new', '/binary/elf', 'newvalue')
+    store.add(new)
+    assert store.list_unprocessed_by_agent('hasher', 'conf') == \
+        [expected[4], ('default', new.uuid, new.selector)]
+
+
+@pytest.mark.parametrize('journal_max_size', ['0', '16777216'])
+def test_diskstorage_restart(journal_max_size):
+    """
+    Check that DiskStorage state is restored after a restart, with or without
+    journal compaction.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-restart')
+    try:
+        args = ['--path', tmpdir, '--journal-max-size', journal_max_size]
+        store = new_storage('diskstorage', args)
+        descs = [new_desc('f%d' % i, sel, 'value%d' % i) for i, sel in
+                 enumerate(['/binary/pe', '/link/a', '/binary/elf'])]
+        for desc in descs:
+            store.add(desc)
+        store.mark_processed('default', descs[0].selector, 'hasher', 'conf')
+        store.store_state()
+        store.mark_processed('default', descs[2].selector, 'hasher', 'conf')
+        store.store_state()
+
+        store2 = new_storage('diskstorage', args)
+        assert [d.selector for d in
+                store2.find_by_selector('default', '/')] == \
+            [d.selector for d in descs]
+        assert store2.find('default', '/binary') == \
+            [descs[2].selector, descs[0].selector]
+        assert store2.processed_stats('default') == ([('hasher', 2)], 3)
+        assert store2.list_unprocessed_by_agent('hasher', 'conf') == \
+            [('default', descs[1].uuid, descs[1].selector)]
+        assert store2.get_processed('default', descs[0].selector) == \
+            set([('hasher', 'conf')])
+        assert store2.list_uuids('default') == \
+            dict((d.uuid, d.label) for d in descs)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_add_interrupted():
+    """
+    Check that descriptors are only registered and journaled once their files
+    have been written.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-journal')
+    try:
+        store = new_storage('diskstorage', ['--path', tmpdir])
+        desc = new_desc('a.bin', '/binary/elf', 'value')
+
+        def write_value(fname, value_chunks):
+            raise IOError('disk full')
+        store.write_value = write_value
+        with pytest.raises(IOError):
+            store.add(desc)
+        assert store.find('default', '/binary/') == []
+        assert store.find_by_uuid('default', desc.uuid) == []
+        assert store.journal_buffer == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_truncated_journal():
+    """
+    Check that a truncated journal record does not prevent DiskStorage from
+    restarting, nor hide records that are appended afterwards.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-journal')
+    try:
+        args = ['--path', tmpdir]
+        store = new_storage('diskstorage', args)
+        descs = [new_desc('f%d' % i, '/binary/elf', 'value%d' % i) for i in
+                 range(2)]
+        store.add(descs[0])
+        store.mark_processed('default', descs[0].selector, 'hasher', 'conf')
+        store.store_state()
+        with open(store.journal_fname, 'ab') as fp:
+            fp.write('\x80\x02]q')
+
+        store2 = new_storage('diskstorage', args)
+        assert store2.processed_stats('default') == ([('hasher', 1)], 1)
+        store2.add(descs[1])
+        store2.mark_processed('default', descs[1].selector, 'hasher', 'conf')
+        store2.store_state()
+
+        store3 = new_storage('diskstorage', args)
+        assert store3.processed_stats('default') == ([('hasher', 2)], 2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_segmentstorage_restart():
+    """
+    Check that descriptors spread over several segments are found after a
+    restart, and that a truncated record is dropped.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-segments')
+    try:
+        args = ['--path', tmpdir, '--segment-size', '100',
+                '--max-open-segments', '2']
+        store = new_storage('segmentstorage', args)
+        descs = [new_desc('f%d' % i, '/binary/elf', 'value%d' % i * 20) for i
+                 in range(4)]
+        for desc in descs:
+            assert store.add(desc)
+        assert not store.add(descs[0])
+        assert store.writer_segment == 3
+        store.mark_processed('default', descs[1].selector, 'hasher', 'conf')
+        store.store_state()
+        with open(store.segment_path(store.writer_segment), 'ab') as fp:
+            fp.write('RBSG\x10')
+
+        store2 = new_storage('segmentstorage', args)
+        assert [d.selector for d in
+                store2.find_by_selector('default', '/binary')] == \
+            [d.selector for d in descs]
+        for desc in descs:
+            assert store2.get_value('default', desc.selector) == desc.value
+        # least recently used segments are closed
+        assert sorted(store2.readers) == [2, 3]
+        store2.store_state()
+        assert not store2.readers
+        assert store2.get_descriptor('default', descs[3].selector).label == \
+            'f3'
+        assert [d.selector for d in
+                store2.find_by_value('default', '/binary', 'value2')] == \
+            [descs[2].selector]
+        assert store2.processed_stats('default') == ([('hasher', 1)], 4)
+        new = new_desc('new', '/binary/pe', 'newvalue')
+        assert store2.add(new)
+
+        store3 = new_storage('segmentstorage', args)
+        assert store3.get_value('default', new.selector) == 'newvalue'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize('name', ['diskstorage', 'segmentstorage'])
+def test_index_snapshot(name):
+    """
+    Check that descriptor indexes are restored from the index snapshot, and
+    that descriptors added after it was taken are discovered.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-index')
+    try:
+        args = ['--path', tmpdir]
+        store = new_storage(name, args)
+        d1 = new_desc('a.bin', '/binary/elf', 'value1')
+        child = d1.spawn_descriptor('/signature/md5', 'md5', 'hasher')
+        for desc in (d1, child):
+            store.add(desc)
+        store.store_state()
+        # added after the snapshot, and absent from the processed journal
+        d2 = new_desc('b.bin', '/binary/pe', 'value2')
+        store.add(d2)
+
+        store2 = new_storage(name, args)
+        assert store2.list_uuids('default') == {d1.uuid: 'a.bin',
+                                                d2.uuid: 'b.bin'}
+        assert [d.selector for d in store2.find_by_selector('default', '/')] \
+            == [d1.selector, child.selector, d2.selector]
+        assert store2.edges['default'][d1.selector] == set([child.selector])
+        assert store2.get_value('default', d2.selector) == 'value2'
+        assert store2.list_unprocessed_by_agent('hasher', 'conf') == \
+            [('default', d.uuid, d.selector) for d in (d1, child, d2)]
+
+        # outdated snapshot format: full scan
+        marker, index = store_serializer.load(open(store.index_fname, 'rb'))
+        marker['format'] = -1
+        store_serializer.dump((marker, index), open(store.index_fname, 'wb'))
+        store3 = new_storage(name, args)
+        assert store3.list_uuids('default') == {d1.uuid: 'a.bin',
+                                                d2.uuid: 'b.bin'}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_index_skips_known_descriptors():
+    """
+    Check that metadata of descriptors present in the index snapshot is not
+    read again at startup.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-index')
+    try:
+        args = ['--path', tmpdir]
+        store = new_storage('diskstorage', args)
+        desc = new_desc('a.bin', '/binary/elf', 'value1')
+        store.add(desc)
+        store.store_state()
+        with open(store.pathFromSelector('default', desc.selector) + '.meta',
+                  'wb') as fp:
+            fp.write('garbage')
+        store2 = new_storage('diskstorage', args)
+        assert store2.list_uuids('default') == {desc.uuid: 'a.bin'}
+
+        os.remove(store.index_fname)
+        with pytest.raises(Exception):
+            new_storage('diskstorage', args)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_index_checkpoint():
+    """
+    Check that checkpoints save the index snapshot, so that it can be used
+    after a crash.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-index')
+    try:
+        args = ['--path', tmpdir, '--index-interval', '0']
+        store = new_storage('diskstorage', args)
+        store.checkpoint()
+        assert not os.path.isfile(store.index_fname)
+        desc = new_desc('a.bin', '/binary/elf', 'value1')
+        store.add(desc)
+        store.checkpoint()
+        assert os.path.isfile(store.index_fname)
+        assert not store.index_dirty
+        # no clean shutdown
+        with open(store.pathFromSelector('default', desc.selector) + '.meta',
+                  'wb') as fp:
+            fp.write('garbage')
+        store2 = new_storage('diskstorage', args)
+        assert store2.list_uuids('default') == {desc.uuid: 'a.bin'}
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_discovery():
+    """
+    Check that sequential and parallel discovery of stored descriptors
+    rebuild the same indexes.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-discovery')
+    try:
+        store = new_storage('diskstorage', ['--path', tmpdir])
+        d1 = new_desc('a.bin', '/binary/elf', 'value1')
+        child = d1.spawn_descriptor('/signature/md5', 'md5', 'hasher',
+                                    label='child label')
+        link = d1.spawn_descriptor('/link/a', 'link', 'linker')
+        d2 = Descriptor('b.bin', '/binary/pe', 'value2', 'otherdomain')
+        for desc in (d1, child, link, d2):
+            store.add(desc)
+        store.store_state()
+
+        stores = []
+        for workers in ('1', '4'):
+            os.remove(store.index_fname)
+            stores.append(new_storage('diskstorage', [
+                '--path', tmpdir, '--discovery-workers', workers]))
+            stores[-1].store_state()
+        for attr in ('version_cache', 'edges', 'uuids', 'labels',
+                     'selector_uuids', 'processed', 'existing_paths'):
+            assert getattr(stores[0], attr) == getattr(stores[1], attr)
+        for attr in ('version_cache', 'edges', 'uuids', 'labels'):
+            assert getattr(stores[1], attr) == getattr(store, attr)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize('name', ['diskstorage', 'segmentstorage'])
+def test_meta_cache(name):
+    tmpdir = tempfile.mkdtemp('rebus-test-cache')
+    try:
+        args = ['--path', tmpdir, '--meta-cache-size', '1']
+        store = new_storage(name, args)
+        d1 = new_desc('a.bin', '/binary/elf', 'value1')
+        d2 = new_desc('b.bin', '/binary/pe', 'value2')
+        store.add(d1)
+        # filled by add(), without value
+        desc = store.get_descriptor('default', d1.selector)
+        assert desc.label == 'a.bin'
+        assert desc.value is None
+        assert store.cache_stats()['meta']['hits'] == 1
+        # returned descriptors are copies
+        desc.label = 'modified'
+        desc.precursors.append('/binary/other%1234')
+        desc = store.get_descriptor('default', d1.selector)
+        assert desc.label == 'a.bin'
+        assert desc.precursors == d1.precursors
+        # nor does the cache share metadata with added descriptors
+        d1.precursors.append('/binary/other%1234')
+        assert store.get_descriptor('default', d1.selector).precursors == []
+
+        store.add(d2)
+        assert store.get_descriptor('default', d1.selector) == \
+            store.load_descriptor('default', d1.selector)
+        stats = store.cache_stats()['meta']
+        assert (stats['hits'], stats['misses'], stats['size']) == (3, 1, 1)
+        assert store.get_descriptor('default', '/binary/unknown') is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_get_value_range(store):
+    d1 = new_desc('a.bin', '/binary/elf', '0123456789')
+    d2 = new_desc('b.txt', '/text/unicode', u'unicode value')
+    d3 = new_desc('empty', '/binary/empty', '')
+    for desc in (d1, d2, d3):
+        store.add(desc)
+    assert store.get_value_range('default', d1.selector, 2, 3) == '234'
+    assert store.get_value_range('default', d1.selector, 8, 10) == '89'
+    assert store.get_value_range('default', d1.selector, 20, 10) == ''
+    assert store.get_value_range('default', d3.selector, 0, 10) == ''
+    assert store.get_value('default', d3.selector) == ''
+    # other values are returned whole
+    assert store.get_value_range('default', d2.selector, 2, 3) == \
+        u'unicode value'
+    assert store.get_value_range('default', '/binary/unknown', 0, 1) is None
+    assert [d.selector for d in
+            store.find_by_value('default', '/binary', '345')] == []
+    assert [d.selector for d in
+            store.find_by_value('default', '/binary', '^0.*9$')] == \
+        [d1.selector]
+
+
+def test_diskstorage_legacy_value():
+    """
+    Check that values stored by older versions, which were always pickled,
+    can still be read.
+    """
+    tmpdir = tempfile.mkdtemp('rebus-test-legacy')
+    try:
+        store = new_storage('diskstorage', ['--path', tmpdir])
+        desc = new_desc('a.bin', '/binary/elf', '0123456789')
+        store.add(desc)
+        fname = store.pathFromSelector('default', desc.selector) + '.value'
+        assert open(fname, 'rb').read() == 'r0123456789'
+        with open(fname, 'wb') as fp:
+            fp.write(desc.serialize_value(store_serializer))
+        assert store.get_value('default', desc.selector) == '0123456789'
+        assert store.get_value_range('default', desc.selector, 1, 2) == '12'
+        assert store.find_by_value('default', '/binary', '0') == \
+            [store.get_descriptor('default', desc.selector)]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_dedup():
+    tmpdir = tempfile.mkdtemp('rebus-test-dedup')
+    try:
+        args = ['--path', tmpdir, '--dedup']
+        store = new_storage('diskstorage', args)
+        d1 = new_desc('a.bin', '/binary/elf', 'value1')
+        d2 = new_desc('b.bin', '/binary/pe', 'value1')
+        d3 = Descriptor.new_with_randomhash('c.bin', '/binary/elf/', 'value1')
+        d4 = new_desc('d.bin', '/binary/elf', 'value2')
+        for desc in (d1, d2, d3, d4):
+            store.add(desc)
+
+        def value_stat(desc):
+            return os.stat(store.pathFromSelector('default', desc.selector) +
+                           '.value')
+        assert value_stat(d1).st_ino == value_stat(d2).st_ino == \
+            value_stat(d3).st_ino != value_stat(d4).st_ino
+        # blob + 3 descriptors
+        assert value_stat(d1).st_nlink == 4
+        assert value_stat(d4).st_nlink == 2
+        assert store.get_value('default', d3.selector) == 'value1'
+        assert store.get_value_range('default', d4.selector, 5, 1) == '2'
+        assert store.collect_blobs() == 0
+
+        os.remove(store.pathFromSelector('default', d4.selector) + '.meta')
+        os.remove(store.pathFromSelector('default', d4.selector) + '.value')
+        store.store_state()
+        os.remove(store.index_fname)
+        store2 = new_storage('diskstorage', args)
+        assert value_stat(d1).st_nlink == 4
+        assert store2.get_value('default', d2.selector) == 'value1'
+        # blob of d4 has been removed
+        assert sum(len(files) for _, _, files in
+                   os.walk(tmpdir + '/_blobs')) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize('name', ['diskstorage', 'segmentstorage'])
+def test_compression(name):
+    tmpdir = tempfile.mkdtemp('rebus-test-compression')
+    try:
+        args = ['--path', tmpdir, '--compress', 'zlib',
+                '--compress-min-size', '100', '--compress-prefix',
+                '/text/=bz2', '--compress-prefix', '/binary/elf=none']
+        store = new_storage(name, args)
+        descs = [new_desc('a.bin', '/binary/pe', 'A' * 100000),
+                 new_desc('b.txt', '/text/ascii', 'some text\n' * 1000),
+                 new_desc('c.bin', '/binary/elf', 'B' * 1000),
+                 new_desc('small', '/binary/pe', 'small value')]
+        descs.append(descs[0].spawn_descriptor('/list/x', range(1000),
+                                               'lister'))
+        for desc in descs:
+            store.add(desc)
+        assert store.compression_for('/binary/pe') == 'zlib'
+        assert store.compression_for('/text/ascii') == 'bz2'
+        assert store.compression_for('/binary/elf/foo') == 'none'
+        for desc in descs:
+            assert store.get_value('default', desc.selector) == desc.value
+        assert store.get_value_range('default', descs[0].selector,
+                                     99998, 10) == 'AA'
+        assert store.get_value_range('default', descs[1].selector, 5, 4) == \
+            'text'
+        assert store.get_value_range('default', descs[4].selector, 0, 1) == \
+            range(1000)
+        assert [d.selector for d in
+                store.find_by_value('default', '/text', 'some')] == \
+            [descs[1].selector]
+        if name == 'diskstorage':
+            def stored(desc):
+                fname = store.pathFromSelector('default', desc.selector)
+                return open(fname + '.value', 'rb').read()
+            assert [stored(desc)[:1] for desc in descs] == \
+                ['z', 'b', 'r', 'r', 'z']
+            assert len(stored(descs[0])) < 1000
+
+            # recompress using new settings
+            store2 = new_storage(name, ['--path', tmpdir, '--compress',
+                                        'bz2', '--compress-min-size', '100',
+                                        '--recompress'])
+            assert [stored(desc)[:1] for desc in descs] == \
+                ['b', 'b', 'b', 'r', 'b']
+            assert store2.recompress('default') == 0
+            for desc in descs:
+                assert store2.get_value('default', desc.selector) == \
+                    desc.value
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_diskstorage_recompress_interrupted(monkeypatch):
+    tmpdir = tempfile.mkdtemp('rebus-test-disk')
+    try:
+        store = new_storage('diskstorage', ['--path', tmpdir])
+        desc = new_desc('a.bin', '/binary/pe', 'A' * 100000)
+        store.add(desc)
+        store2 = new_storage('diskstorage', ['--path', tmpdir, '--compress',
+                                             'zlib'])
+
+        # crash before the recompressed value replaces the stored one
+        def rename(src, dst):
+            raise KeyboardInterrupt()
+        monkeypatch.setattr(os, 'rename', rename)
+        with pytest.raises(KeyboardInterrupt):
+            store2.recompress('default')
+        monkeypatch.undo()
+        assert len(os.listdir(tmpdir + '/_tmp')) == 1
+
+        store3 = new_storage('diskstorage', ['--path', tmpdir])
+        assert os.listdir(tmpdir + '/_tmp') == []
+        assert store3.get_value('default', desc.selector) == desc.value
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_compress_prefix_argument():
+    from rebus.storage_backends.diskstorage import compress_prefix
+    assert compress_prefix('/text/=bz2') == ('/text/', 'bz2')
+    assert compress_prefix('/a=b=zlib') == ('/a=b', 'zlib')
+    for invalid in ('/text/', '=zlib', '/text/=lzma'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            compress_prefix(invalid)
+
+
+def test_spillstorage_eviction():
+    tmpdir = tempfile.mkdtemp('rebus-test-spill')
+    try:
+        store = new_storage('spillstorage', ['--memory-budget', '250',
+                                             '--spill-dir', tmpdir])
+        d1 = new_desc('a.bin', '/binary/a', 'A' * 100)
+        d2 = new_desc('b.bin', '/binary/b', 'B' * 100)
+        d3 = new_desc('c.bin', '/binary/c', 'C' * 100)
+        for desc in (d1, d2):
+            assert store.add(desc)
+        assert store.cache_stats()['values'] == \
+            {'size': 200, 'budget': 250, 'count': 2, 'spilled': 0}
+        # d1 is least recently used
+        assert store.add(d3)
+        assert store.cache_stats()['values']['spilled'] == 1
+        assert not os.path.exists(store.spill_path('default', d2.selector))
+        assert store.get_value_range('default', d1.selector, 98, 5) == 'AA'
+
+        # reloading d1 evicts d2, reloading d2 evicts d3
+        desc = store.get_descriptor('default', d1.selector)
+        assert desc.value == d1.value
+        assert store.get_value('default', d2.selector) == d2.value
+        assert store.cache_stats()['values'] == \
+            {'size': 200, 'budget': 250, 'count': 2, 'spilled': 3}
+        assert [d.selector for d in
+                store.find_by_value('default', '/binary', 'C+$')] == \
+            [d3.selector]
+        # value kept by concurrent get_value calls is only counted once
+        store.keep_value('default', d3.selector, d3.value, 100)
+        assert store.cache_stats()['values']['size'] == 200
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_descriptor_slots():
+    import copy
+    import cPickle
+    parent = new_desc('a.bin', '/binary/elf', 'value1')
+    child = parent.spawn_descriptor('/signature/md5', 'md5', 'hasher')
+    assert not hasattr(child, '__dict__')
+    assert child.hash == child.selector.split('%')[1]
+    # precursors share the parent's selector string
+    assert child.precursors[0] is parent.selector
+    for protocol in (0, 2):
+        copied = cPickle.loads(cPickle.dumps(child, protocol))
+        assert copied == child
+        assert copied.domain is child.domain
+    assert copy.copy(child) == child
+    assert child != parent
+    assert child != child.selector
+
+
+def test_descriptor_trusted_construction():
+    import hashlib
+    parent = Descriptor('a.bin', '/binary/elf', 'value1', 'dom.ain')
+    assert parent.domain == 'domain'
+    assert parent.hash == hashlib.sha256('value1').hexdigest()
+    child = parent.spawn_descriptor('/signature/md5', 'md5', 'hasher')
+    assert child.hash == hashlib.sha256(
+        'hasher' + str([parent.selector]) + '/signature/md5' +
+        'md5').hexdigest()
+    for desc in (parent, child):
+        serialized = desc.serialize(store_serializer)
+        assert Descriptor.unserialize(store_serializer, serialized) == desc
+        assert Descriptor.unserialize(store_serializer, serialized,
+                                      trusted=True) == desc
+    meta = Descriptor.unserialize(store_serializer,
+                                  child.serialize_meta(store_serializer),
+                                  bus=object(), trusted=True)
+    assert meta.selector is child.selector
+    assert meta.precursors == child.precursors
+    # untrusted metadata is checked by default
+    fields = store_serializer.loads(parent.serialize(store_serializer))
+    fields['domain'] = 'dom.ain'
+    tampered = store_serializer.dumps(fields)
+    assert Descriptor.unserialize(store_serializer, tampered).domain == \
+        'domain'
+    assert Descriptor.unserialize(store_serializer, tampered,
+                                  trusted=True).domain == 'dom.ain'
+
+
+def test_compactmeta_serializer():
+    from rebus.tools.serializer import compactmeta, SerializerRegistry, \
+        get_bus_serializer, bus_serializer_names
+    assert SerializerRegistry.get('compactmeta') is compactmeta
+    # marshal must not be used on data received from the bus
+    assert get_bus_serializer('compactmeta') is None
+    assert 'compactmeta' not in bus_serializer_names()
+    assert 'picklev2' in bus_serializer_names()
+    parent = new_desc(u'\xe9t\xe9.bin', '/binary/elf', 'value1')
+    child = parent.spawn_descriptor('/link/x', {'a': [1, 2]}, 'linker')
+    for desc in (parent, child):
+        meta = desc.serialize_meta(compactmeta)
+        assert meta.startswith('M')
+        assert len(meta) < len(desc.serialize_meta(store_serializer))
+        unserialized = Descriptor.unserialize(compactmeta, meta, bus=object())
+        assert unserialized.meta_dict() == desc.meta_dict()
+        assert isinstance(unserialized.label, type(desc.label))
+        assert Descriptor.unserialize(
+            compactmeta, desc.serialize(compactmeta)) == desc
+        # metadata pickled by older versions
+        assert Descriptor.unserialize(
+            compactmeta, desc.serialize(store_serializer)) == desc
+    for obj in ('value', {'a': 1}, range(10), None):
+        assert compactmeta.loads(compactmeta.dumps(obj)) == obj
+
+
+def test_add_spooled(store):
+    from rebus.tools.spool import should_spool, spool_value, spooled_path, \
+        remove_spooled
+    spool_dir = tempfile.mkdtemp('rebus-test-spool')
+    try:
+        d1 = new_desc('a.bin', '/binary/elf', 'A' * 1000)
+        d2 = d1.spawn_descriptor('/link/x', {'a': 1}, 'linker')
+        assert should_spool(d1, 100)
+        assert not should_spool(d1, 1000)
+        assert not should_spool(d2, 0)
+        for desc in (d1, d2):
+            path = spooled_path(spool_dir, spool_value(spool_dir, desc))
+            inode = os.stat(path).st_ino
+            meta = Descriptor.unserialize(
+                store_serializer, desc.serialize_meta(store_serializer))
+            assert store.add_spooled(meta, path)
+            assert not os.path.exists(path)
+            assert store.get_value('default', desc.selector) == desc.value
+            if store._name_ == 'diskstorage':
+                # adopted without copy
+                fname = store.pathFromSelector('default', desc.selector)
+                assert os.stat(fname + '.value').st_ino == inode
+        name = spool_value(spool_dir, d1)
+        assert not store.add_spooled(d1, spooled_path(spool_dir, name))
+        assert os.listdir(spool_dir) == []
+        # removed by the storage
+        assert not remove_spooled(spool_dir, name)
+        # rejected by the bus master
+        name = spool_value(spool_dir, d1)
+        assert remove_spooled(spool_dir, name)
+        assert os.listdir(spool_dir) == []
+        assert store.find_by_uuid('default', d1.uuid)
+        for name in ('../x.spool', 'x.value', '/tmp/x.spool'):
+            with pytest.raises(ValueError):
+                spooled_path(spool_dir, name)
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+def test_get_values(store):
+    d1 = new_desc('a.bin', '/binary/elf', 'A' * 1000)
+    d2 = d1.spawn_descriptor('/link/x', {'a': 1}, 'linker')
+    d3 = d1.spawn_descriptor('/signature/md5', 'B' * 32, 'hasher')
+    for desc in (d1, d2, d3):
+        store.add(desc)
+    selectors = [d3.selector, '/unknown/%1234', d1.selector, d2.selector,
+                 '/binary/elf/~-1']
+    assert store.get_values('default', selectors) == \
+        [d3.value, None, d1.value, d2.value, d1.value]
+
+    class CountingBus(object):
+        calls = 0
+
+        def get_values(self, agent_id, desc_domain, selectors):
+            CountingBus.calls += 1
+            return store.get_values(desc_domain, selectors)
+
+    bus = CountingBus()
+    descs = [Descriptor.unserialize(store_serializer,
+                                    d.serialize_meta(store_serializer),
+                                    bus=bus) for d in (d1, d2, d3)]
+    assert Descriptor.prefetch_values(descs + [None]) == descs + [None]
+    assert CountingBus.calls == 1
+    assert [d.bus for d in descs] == [None] * 3
+    assert [d.value for d in descs] == [d1.value, d2.value, d3.value]